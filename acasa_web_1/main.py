@@ -12,10 +12,23 @@ import importlib
 import logging
 import os
 from pathlib import Path
+import shutil
+import sys
+import tempfile
+import unittest
 import yaml
 
 os.chdir(Path(__file__).parent)
 
+# The modules shared with the other applications (arango_pool, web, ..) reside in the repository root; it is on the
+# path when this package is imported from there, not when this script is started directly.
+ROOT_PATH = Path(__file__).resolve().parent.parent
+if str(ROOT_PATH) not in sys.path:
+    sys.path.append(str(ROOT_PATH))
+
+import arango_pool as ARANGO_POOL
+from web import CachingWebStore, WebStore
+
 SCRIPT_PATH = Path(__name__).parent.resolve()
 CONFIG_FILE = Path("{}{}application.yml".format(SCRIPT_PATH, os.sep))
 
@@ -24,6 +37,7 @@ config = None
 asgi_containers = []
 async_containers = []
 wsgi_containers = []
+batch_containers = []
 
 
 def load_config():
@@ -32,35 +46,144 @@ def load_config():
         global config
         config = yaml.safe_load(cfg_text)
 
-# External appliances (injectables)
+# External appliances (injectables): 'external.<type>.<name>' => configuration, e.g. 'external.db.arango-local-1';
+# modules name the ones they need in 'inject', s. inject()
+injectables = {}
+
+# 'external.db.<name>' => the user database on it, behind the session cache of this process (s. web.CachingWebStore)
+user_databases = {}
+
+# Shared by all modules of the process, e.g. catalogue and translations, s. web_portal.ContextCache
+global_cache = None
 
 
 LOG = logging.getLogger() # TODO
 
 
-def arango_client(timeout: int = 12, max_retries: int = 3) -> ArangoClient:
-    arango_url = "http://{}:{}".format(
-        config['arango']['host_name'], config['arango']['host_port'])  # closure
-    arango_client = ArangoClient(arango_url)
-    arango_client.request_timeout = timeout
-    return arango_client
+# Shared by the whole process, s. arango_pool.py
+def arango_client(db_cfg: dict, timeout: int = 12, max_retries: int = 3) -> ArangoClient:
+    return ARANGO_POOL.registry.get_client(
+        db_cfg['host_name'], db_cfg['host_port'],
+        timeout=timeout, max_retries=max_retries,
+        pool_size=db_cfg.get('pool_size', ARANGO_POOL.DEFAULT_POOL_SIZE))
+
+
+def arango_database(db_cfg: dict):
+    return ARANGO_POOL.registry.database(arango_client(db_cfg), db_cfg['db_name'], db_cfg['app_user'],
+                                         db_cfg['app_password'])
+
+
+class ArangoUserStore(WebStore):
+    """The user database of the web modules (s. web_portal.WebStore) in an Arango database: users and their sessions.
+    """
+
+    def __init__(self, acasa_db):
+        super().__init__()
+        self._db = acasa_db
+
+    def is_prepared(self):
+        return self._db.has_collection('WebUsers')
+
+    def prepare(self):
+        users = self._db.create_collection('WebUsers')
+        users.add_hash_index(fields=['name'], unique=False)
+        users.add_hash_index(fields=['session_id'], unique=True, sparse=True) # s. get_user_for_cookie()
+        return self
+
+    def get_user_for_cookie(self, cookie):
+        cursor = self._db.aql.execute('FOR u IN WebUsers FILTER u.session_id == @cookie LIMIT 1 RETURN u',
+                                      bind_vars={'cookie': cookie})
+        return next(cursor, None)
+
+    def create_user(self, name: str = "", email: str = ""):
+        return self._db.collection('WebUsers').insert({"name": name, "email": email})
+
+    def logout(self, cookie):
+        self._db.aql.execute('FOR u IN WebUsers FILTER u.session_id == @cookie UPDATE u WITH {session_id: null} '
+                             'IN WebUsers OPTIONS {keepNull: false}', bind_vars={'cookie': cookie})
 
 
 def install_injectables():
 
     if config is None:
-        raise "No configuration script provided!"
+        raise RuntimeError("No configuration script provided!")
+    for ext_type, entries in (config.get("external") or {}).items():
+        for entry in entries or []:
+            if isinstance(entry, dict): # named entry, e.g. {"arango-local-1": {"host_name": ..}}; else a file name
+                for name, ext_cfg in entry.items():
+                    injectables["external.{}.{}".format(ext_type, name)] = ext_cfg
+                    if ext_type == "db": # no connection yet, s. arango_pool.py
+                        user_databases["external.db.{}".format(name)] = user_database(ext_cfg)
+
+
+def user_database(db_cfg: dict) -> CachingWebStore:
+    """ArangoUserStore of an 'external.db' entry; resolved sessions are cached as configured in 'session_cache'.
+    """
+    session_cfg = db_cfg.get("session_cache") or {}
+    store = ArangoUserStore(arango_database(db_cfg))
+    return CachingWebStore(store, max_entries=session_cfg.get("max_entries", 10000),
+                           ttl=session_cfg.get("ttl_seconds", 300),
+                           negative_ttl=session_cfg.get("negative_ttl_seconds", 30))
+
+
+def inject(refs: list, **externals) -> dict:
+    """The externals of a module's init() for its 'inject' list: a database becomes the 'user_database' and supplies
+    the 'translations' (collection, edited by main.py in the root); every module gets the 'global_cache'. Given
+    'externals' are kept (e.g. tests).
+    """
+    externals = dict(externals)
+    for ref in refs or []:
+        if ref not in injectables:
+            raise RuntimeError("Unknown injectable '{}'; pls. check 'external' in {}".format(ref, CONFIG_FILE))
+        if ref in user_databases:
+            externals.setdefault("user_database", user_databases[ref])
+            externals.setdefault("translations", arango_database(injectables[ref]).collection('Translations'))
+    externals.setdefault("global_cache", global_cache)
+    return externals
 
 
 # Modules (containers)
 
-def load_web_module(config: dict = None):
-    mod_py = config["module_py"]
+# The deployed modules (e.g. web_portal) reside next to this script, shared ones (e.g. job_management) in the root;
+# imported as package 'acasa_web_1' (e.g. by pytest) the former are imported relative to it.
+def import_module(mod_py: str):
+    if __package__ and Path(Path(__file__).parent, mod_py + ".py").exists():
+        return importlib.import_module("." + mod_py, __package__)
+    return importlib.import_module(mod_py)
+
+def _module_entry(config: dict) -> dict:
+    if "module_py" not in config: # named entry, e.g. {"webportal-1": {"module_py": ..}}
+        config = next(iter(config.values()))
+    return config
+
+# Deployment steps writing files (s. web_portal.py); run once before the worker processes start, s. load_web_module()
+def build_web_module(config: dict):
+    config = _module_entry(config)
     mod_cfg = config["module_cfg"]
-    py_mod = importlib.import_module(mod_py)
-    web_app = py_mod.init(mod_cfg)
+    py_mod = import_module(config["module_py"])
+    if mod_cfg.get("asset_folder") and hasattr(py_mod, "build_assets"):
+        print("Static assets built:", len(py_mod.build_assets(mod_cfg)))
+    if mod_cfg.get("template_cache") and hasattr(py_mod, "precompile"):
+        print("Templates precompiled:", py_mod.precompile(mod_cfg))
+
+def load_web_module(config: dict = None, externals: dict = None, build: bool = True):
+    """Deploy a web module in this process; 'build' False: build_web_module() ran already, e.g. by 'main.py serve' in
+    the root for all its workers.
+    """
+    config = _module_entry(config)
+    mod_cfg = config["module_cfg"]
+    py_mod = import_module(config["module_py"])
+    global global_cache
+    if global_cache is None and hasattr(py_mod, "ContextCache"):
+        global_cache = py_mod.ContextCache()
+    if build:
+        build_web_module(config)
+    if mod_cfg.get("translations") and hasattr(py_mod, "install_translations"): # per process
+        print("Translations installed:", py_mod.install_translations(mod_cfg).languages())
+    web_app = py_mod.init(mod_cfg, **inject(config.get("inject"), **(externals or {})))
     global wsgi_containers
     wsgi_containers.append(web_app)
+    return web_app
 
 def load_service_module(config: dict = None):
     pass
@@ -68,6 +191,15 @@ def load_service_module(config: dict = None):
 def load_async_module(config: dict = None):
     pass
 
+# Batch modules run the long-lasting jobs in worker processes of their own, s. job_management.py; here they are only
+# started, the web modules merely enqueue jobs.
+def load_job_module(config: dict = None):
+    config = _module_entry(config)
+    py_mod = import_module(config["module_py"])
+    job_pool = py_mod.init(config.get("module_cfg"))
+    global batch_containers
+    batch_containers.append(job_pool)
+
 def load_modules():
     micro_module_list = config["container"]["asgi"]
     for micro_module in micro_module_list or []:
@@ -79,7 +211,7 @@ def load_modules():
 
     job_module_list = config["container"]["batch"]
     for job_module in job_module_list or []:
-        print("Job-Module", job_module)
+        load_job_module(job_module)
 
 
 # deployed (per import)
@@ -94,6 +226,72 @@ def test():
     # TODO execute tests
 
 
+class UnitTestDeployment(unittest.TestCase):
+
+    class _Store():
+        def is_prepared(self):
+            return True
+
+        def get_user_for_cookie(self, cookie):
+            return None
+
+    def setUp(self):
+        self._saved = config, dict(injectables), dict(user_databases), global_cache, list(wsgi_containers)
+        load_config()
+        install_injectables()
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        for folder in ("templates", "static"): # the deployment below 'portal', next to translations.json
+            shutil.copytree(Path(SCRIPT_PATH, folder), Path(self._tmp_dir.name, "portal", folder))
+        shutil.copy(Path(ROOT_PATH, "translations.json"), self._tmp_dir.name)
+
+    def tearDown(self):
+        global config, global_cache, wsgi_containers
+        config, saved_injectables, saved_user_databases, global_cache, wsgi_containers = self._saved
+        for registered, saved in ((injectables, saved_injectables), (user_databases, saved_user_databases)):
+            registered.clear()
+            registered.update(saved)
+        self._tmp_dir.cleanup()
+        import translation_management as TRANSL_MGMT
+        TRANSL_MGMT.install({})
+
+    def test_injectables(self):
+        self.assertEqual(injectables["external.db.arango-local-1"]["db_name"], "acasa_db")
+        with self.assertRaises(RuntimeError):
+            inject(["external.db.nowhere"])
+        store = self._Store()
+        self.assertIs(inject(["external.db.arango-local-1"], user_database=store)["user_database"], store)
+        user_database = inject(["external.db.arango-local-1"])["user_database"] # not connected before the first use
+        self.assertIsInstance(user_database, CachingWebStore)
+        self.assertIsInstance(user_database._delegate, ArangoUserStore)
+        self.assertIs(inject(["external.db.arango-local-1"])["user_database"], user_database) # one cache per process
+
+    def test_load_web_module(self):
+        import asyncio
+        web_module = config["container"]["wsgi"][0]
+        root_path = Path(self._tmp_dir.name, "portal")
+        mod_cfg = dict(web_module["webportal-1"]["module_cfg"], root_path=str(root_path)) # build output in tmp
+        web_module = {"webportal-1": dict(web_module["webportal-1"], module_cfg=mod_cfg)}
+        store = self._Store()
+        web_app = load_web_module(web_module, externals={"user_database": store}) # as loaded from the config
+        self.assertIn(web_app, wsgi_containers)
+        global_cache['prods'] = {"Pizza": [{"name": "Pizza Margarita", "price": "4.99", "image": None}]}
+        global_cache['user_settings'] = {}
+
+        async def get_pages():
+            async with web_app.test_app() as test_app: # warm-up renders all pages
+                client = test_app.test_client()
+                return [(response.status_code, await response.get_data(as_text=True)) for response in
+                        [await client.get("/"), await client.get("/menue"),
+                         await client.get("/menue", headers={"Accept-Language": "de-DE,de;q=0.9"})]]
+        (index_status, index), (menue_status, menue), (_, menue_de) = asyncio.run(get_pages())
+        self.assertEqual((index_status, menue_status), (200, 200))
+        self.assertIn("Welcome!", index)
+        self.assertIn("<h2>Menue: today</h2>", menue)
+        self.assertIn("Pizza Margarita", menue)
+        self.assertIn("<h2>Speisekarte: heute</h2>", menue_de)
+        self.assertTrue(Path(root_path, mod_cfg["asset_folder"]).is_dir())
+
+
 # started directly
 if __name__ == "__main__":
     print("Application started via main script.")
@@ -16,4 +16,25 @@ function(jq) {
       }).done(function() {
         jq( this ).addClass( "done" );
       });
+    // Live updates pushed by the server (s. web_portal '/events') instead of polling: the menu is reloaded when the
+    // catalogue changes, elements with 'data-order' show the status of their order.
+    if (window.EventSource) {
+        var topics = ['catalogue'];
+        jq('[data-order]').each(function() {
+            topics.push('order/' + jq(this).data('order'));
+        });
+        var events = new EventSource('/events?' + jq.param({topic: topics}, true));
+        events.addEventListener('catalogue', function(event) { // '?v=': the new version, not a stale page
+            jq('#menu').load('/menue?v=' + JSON.parse(event.data).version + ' #menu > *');
+        });
+        events.addEventListener('reset', function() { // missed events: start over
+            location.reload();
+        });
+        topics.slice(1).forEach(function(topic) {
+            events.addEventListener(topic, function(event) {
+                var order = JSON.parse(event.data);
+                jq('[data-order="' + order.order + '"] .order-status').text(order.status);
+            });
+        });
+    }
 });
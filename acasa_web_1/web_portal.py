@@ -1,14 +1,39 @@
 # A website using Quart
 # Shared web objects
 from abc import ABC, abstractmethod
-import importlib
+import asyncio
+from collections import namedtuple, OrderedDict
+import concurrent.futures
+import gzip
+import hashlib
+import importlib.util
+import logging
 import os
 from pathlib import Path
-from quart import Quart, session, render_template, request
+import re
+import shutil
+import tempfile
+from quart import Quart, Response, abort, redirect, session, render_template, request
+import threading
+import unittest
 import yaml
+import admission_control as ADMISSION
+import asset_pipeline as ASSET_PIPELINE
+import change_management as CHANGE_MGMT
+import event_broker as EVENT_BROKER
+import file_server as FILE_SERVER
+import image_management as IMAGE_MGMT
+import metrics as METRICS
+import single_flight as SINGLE_FLIGHT
+import translation_management as TRANSL_MGMT
+import web as WEB
 
 SCRIPT_PATH = Path(__name__).parent.resolve()
 
+LOG = logging.getLogger(__name__)
+
+SESSION_COOKIE_NAME = "acasa_session" # s. web.py
+
 DEFAULT_CONFIG = { # Defaults taken from Quart API
     "import_name": "DEFAULT",
     "static_url_path": "/",
@@ -33,7 +58,13 @@ class ContextCache(dict):
         self._protected_dict = dict()
 
     def __getitem__(self, key):
-        return self._protected_dict[key]
+        try:
+            value = self._protected_dict[key]
+        except KeyError:
+            METRICS.CACHE_LOOKUPS.inc("context", key, "miss")
+            raise
+        METRICS.CACHE_LOOKUPS.inc("context", key, "hit")
+        return value
     
     def __setitem__(self, key, value):
         self._protected_dict[key] = value
@@ -70,6 +101,301 @@ class WebStore(ABC):
     def create_user(self, name: str = "", email: str = ""):
         raise NotImplementedError("Should not happen..")
 
+    @abstractmethod
+    def logout(self, cookie):
+        """End the session belonging to the cookie (route '/logout').
+        """
+        raise NotImplementedError("Should not happen..")
+
+CachedPage = namedtuple("CachedPage", ["body", "gzip_body", "etag"]) # body, gzip_body: bytes (gzip_body may be None)
+
+class PageCache():
+    """
+        Fully rendered pages, keyed by (route, language, version of catalogue and translations, logged in): a cached
+        page is sent without invoking the template engine. The HTML is stored encoded, with a gzip variant compressed
+        once when the page is stored. Pages of other versions are dropped as soon as a new version is asked for; with
+        'stale_while_revalidate' those of the previous version stay available through stale(). Each worker process
+        has its own cache (like web.CachingWebStore).
+    Args:
+        max_entries (int): Size of the LRU.
+        precompress (bool): Keep a gzip variant of pages of at least 'min_compress_size' bytes.
+        min_compress_size (int): Smaller pages are not worth compressing.
+        stale_while_revalidate (bool): Keep the pages of the previous catalogue version, s. _cached_page().
+    """
+
+    def __init__(self, max_entries: int = 256, precompress: bool = True, min_compress_size: int = 512,
+                 stale_while_revalidate: bool = False):
+        self._max_entries = max_entries
+        self._precompress = precompress
+        self._min_compress_size = min_compress_size
+        self._stale_while_revalidate = stale_while_revalidate
+        self._pages = OrderedDict() # key => CachedPage
+        self._version = None
+        self._stale_pages = {} # pages of the previous version
+        self._stale_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _check_version(self, version):
+        if version != self._version: # catalogue changed: every cached page may show old data
+            if self._stale_while_revalidate:
+                self._stale_pages, self._stale_version = self._pages, self._version
+            self._pages = OrderedDict()
+            self._version = version
+
+    def get(self, key: tuple) -> CachedPage:
+        with self._lock:
+            self._check_version(key[2])
+            page = self._pages.get(key)
+            if page is None:
+                self.misses += 1
+                METRICS.CACHE_LOOKUPS.inc("page", key[0], "miss")
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            METRICS.CACHE_LOOKUPS.inc("page", key[0], "hit")
+            return page
+
+    def put(self, key: tuple, html: str) -> CachedPage:
+        body = html.encode("UTF-8")
+        gzip_body = None
+        if self._precompress and len(body) >= self._min_compress_size:
+            gzip_body = gzip.compress(body, mtime=0) # mtime=0: same bytes for the same page in every worker
+        page = CachedPage(body, gzip_body, '"{}"'.format(hashlib.blake2b(body, digest_size=12).hexdigest()))
+        with self._lock:
+            self._check_version(key[2])
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self._max_entries:
+                self._pages.popitem(last=False)
+        return page
+
+    def stale(self, key: tuple) -> CachedPage:
+        """The page of the previous catalogue version for the same route, language and login state, if kept.
+        """
+        with self._lock:
+            return self._stale_pages.get((key[0], key[1], self._stale_version, key[3]))
+
+    def invalidate(self):
+        with self._lock:
+            self._pages.clear()
+            self._stale_pages = {}
+
+# Templates are compiled into a bytecode cache at deployment time (precompile(), s. main.py), so workers only load the
+# compiled code; it must be compiled by an environment like Quart's (async rendering, autoescape rule), otherwise the
+# workers load code they cannot run.
+
+def _template_path(config: dict) -> str:
+    root_resolved = Path(config.get("root_path") or SCRIPT_PATH).resolve()
+    return "{}{}{}".format(root_resolved, str(os.sep), config["template_folder"]) # need abs. path for jinja2
+
+def _bytecode_cache(config: dict):
+    """The configured bytecode cache ('template_cache': directory below 'root_path') or None.
+    """
+    if not config.get("template_cache"):
+        return None
+    from jinja2 import FileSystemBytecodeCache
+    root_resolved = Path(config.get("root_path") or SCRIPT_PATH).resolve()
+    cache_path = Path(root_resolved, config["template_cache"])
+    os.makedirs(cache_path, exist_ok=True)
+    return FileSystemBytecodeCache(str(cache_path))
+
+def precompile(config: dict) -> int:
+    """Deployment step: compile all templates of 'template_folder' into the bytecode cache 'template_cache'.
+
+    Returns:
+        int: The number of templates compiled.
+    """
+    bytecode_cache = _bytecode_cache(config)
+    if bytecode_cache is None:
+        raise RuntimeError("No 'template_cache' configured!")
+    bytecode_cache.clear() # no stale code of deleted templates
+    web_app = Quart(config.get("import_name", DEFAULT_CONFIG["import_name"]),
+                    root_path=Path(config.get("root_path") or SCRIPT_PATH).resolve(),
+                    template_folder=_template_path(config))
+    web_app.jinja_options = dict(web_app.jinja_options, bytecode_cache=bytecode_cache) # s. init()
+    env = web_app.jinja_env
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name) # compiles and stores the bytecode
+    return len(names)
+
+# Texts of the templates ({{ t('key') }}): the configured 'messages' plus the translation 'files' (e.g.
+# translations.json, relative to 'root_path'), installed when the module is deployed; while serving, edited
+# translations are taken from the 'Translations' collection (external 'translations', s. main.py), s. init().
+
+def _translation_base(config: dict) -> dict:
+    transl_cfg = config["translations"]
+    root_resolved = Path(config.get("root_path") or SCRIPT_PATH).resolve()
+    return TRANSL_MGMT.merge_files(transl_cfg.get("messages") or {},
+                                   [Path(root_resolved, file_name) for file_name in transl_cfg.get("files") or []])
+
+def install_translations(config: dict) -> TRANSL_MGMT.TranslationTable:
+    """Deployment step: install the texts of 'translations' (messages, files, fallbacks) as the lookup table.
+    """
+    return TRANSL_MGMT.install(_translation_base(config), config["translations"].get("fallbacks"))
+
+def _translation_refresh(config: dict, ctx_cache, transl_coll):
+    """The refresh run while serving: 'refresh_translations' of the context cache, else a reload of 'transl_coll' (on
+    top of the configured texts) whenever its revision changed; None if there is nothing to refresh from.
+    """
+    refresh = _cached(ctx_cache, 'refresh_translations', None)
+    if refresh is not None or transl_coll is None or not config.get("translations"):
+        return refresh
+    base = _translation_base(config)
+    fallbacks = config["translations"].get("fallbacks")
+    return lambda: TRANSL_MGMT.refresh_if_changed(transl_coll, base, fallbacks)
+
+# Static files: with a build of the asset pipeline ('asset_folder', s. asset_pipeline.py) the build is served instead of
+# the static folder, precompressed variants where the browser accepts them; hashed names never change, so the browsers
+# may keep them forever and repeat page loads only fetch the (revalidated) page itself. Files are sent by the
+# file_server middleware (sendfile/memory mapped) before the request reaches Quart.
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+def _asset_path(config: dict) -> Path:
+    return Path(config.get("root_path") or SCRIPT_PATH, config["asset_folder"]).resolve()
+
+def build_assets(config: dict) -> dict:
+    """Deployment step: build the static folder into 'asset_folder'; returns the manifest.
+    """
+    static_path = Path(config.get("root_path") or SCRIPT_PATH, config["static_folder"]).resolve()
+    return ASSET_PIPELINE.build(static_path, _asset_path(config))
+
+def _serve_static(web_app: Quart, static_url_path: str, static_path: Path, manifest: dict, mounts: list = ()):
+    hashed = frozenset(manifest.values())
+    web_app.asgi_app = FILE_SERVER.FileServer(web_app.asgi_app, [FILE_SERVER.Mount( # in front of Quart's handler
+        static_url_path, static_path, cache_control=lambda name: IMMUTABLE if name in hashed else "no-cache",
+        precompressed=bool(manifest))] + list(mounts))
+
+# Generated files (e.g. receipts) are downloadable by logged-in users only: external 'downloads', [(URL prefix,
+# directory)], s. main.py in the root.
+def _download_mounts(downloads: list, doc_store) -> list:
+    async def logged_in(scope) -> bool:
+        cookie = FILE_SERVER.session_cookie(scope, SESSION_COOKIE_NAME)
+        return bool(cookie) and await WEB.user_for_cookie(doc_store, cookie) is not None
+    return [FILE_SERVER.Mount(prefix, Path(directory), "private, no-cache", logged_in)
+            for prefix, directory in downloads or []]
+
+# Request latency per route, time spent in SQLite/Arango, cache hits and misses, for Prometheus on 'metrics_path'
+# (default '/metrics'), s. metrics.py; outermost, so that files and rejected requests (503) are measured as well.
+def _serve_metrics(web_app: Quart, config: dict, admission: ADMISSION.AdmissionControl = None):
+    web_app.asgi_app = METRICS.MetricsMiddleware(web_app.asgi_app, config.get("metrics_path", "/metrics"),
+                                                 allow=config.get("metrics_allow", METRICS.LOOPBACK),
+                                                 untimed=ADMISSION.UNLIMITED_PATHS)
+    if admission is None:
+        return
+    for field, kind, help_text in (("active", "gauge", "Requests in progress."),
+                                   ("waiting", "gauge", "Requests waiting for admission."),
+                                   ("rejected", "counter", "Requests rejected with 503.")):
+        name = "acasa_admission_{}{}".format(field, "_total" if kind == "counter" else "")
+        METRICS.REGISTRY.callback(name, help_text, kind, lambda field=field: {
+            (route_class,): stats[field] for route_class, stats in admission.stats().items()}, ("class",))
+
+# Product pictures in the sizes the pages offer (srcset), derived on first request by worker processes, s.
+# image_management.py; needs 'images' in the configuration and an 'image_loader' in the context cache (s. main.py).
+def _serve_images(web_app: Quart, config: dict, ctx_cache):
+    image_cfg = config.get("images")
+    loader = _cached(ctx_cache, 'image_loader', None)
+    if not image_cfg or loader is None:
+        return
+    cache_path = Path(config.get("root_path") or SCRIPT_PATH, image_cfg["cache_folder"]).resolve()
+    variants = IMAGE_MGMT.ImageVariants(loader, cache_path, image_cfg.get("max_cache_mb", 200) * 1024 * 1024,
+                                        image_cfg.get("workers"))
+
+    @web_app.route("/images/<image_id>/<int:width>.<image_format>")
+    async def product_image(image_id, width, image_format):
+        if image_format not in IMAGE_MGMT.VARIANT_FORMATS or width != IMAGE_MGMT.variant_width(width):
+            abort(404) # only the offered sizes, so the cache cannot be flooded
+        data = await _variant_data(variants, image_id, width, image_format)
+        if data is None:
+            abort(404)
+        response = Response(data, mimetype="image/" + image_format)
+        response.set_etag(IMAGE_MGMT.VariantCache.file_name(image_id, IMAGE_MGMT.variant_width(width), image_format))
+        response.headers["Cache-Control"] = IMMUTABLE # the ID is the hash of the original
+        await response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+        return response
+
+    @web_app.after_serving
+    async def close_image_workers():
+        variants.close()
+
+async def _variant_data(variants: IMAGE_MGMT.ImageVariants, image_id: str, width: int, image_format: str) -> bytes:
+    """The variant's bytes, None for an unknown image. Read at once - variants are small - because the cache may evict
+    the file any time; evicted before it was read, it is derived again.
+    """
+    for attempt in range(3):
+        file_path = await asyncio.wrap_future(variants.get(image_id, width, image_format))
+        if file_path is None:
+            return None
+        try:
+            return await asyncio.to_thread(file_path.read_bytes)
+        except FileNotFoundError:
+            LOG.info("Image variant %s evicted before it was sent (attempt %s)", file_path.name, attempt + 1)
+    raise RuntimeError("Image variant cache too small for {}".format(file_path.name))
+
+# Push channel, s. event_broker.py: browsers subscribe with an EventSource to e.g. '/events?topic=catalogue&topic=order/5'
+# instead of polling. The change feed of this process ('change_feed' in the context cache, s. main.py) publishes; on a
+# catalogue change the cached catalogue is refreshed ('refresh_catalogue') before the clients are told to reload it.
+# All orders ("order/*", kitchen displays) only for logged-in users.
+_ORDER_TOPIC = re.compile(r"order/(\d+|\*)$")
+
+def _serve_events(web_app: Quart, config: dict, ctx_cache, doc_store):
+    push_cfg = config.get("push") or {}
+    broker = EVENT_BROKER.Broker(push_cfg.get("max_queued", 100), push_cfg.get("max_retained", 1024))
+    ctx_cache['broker'] = broker
+    METRICS.REGISTRY.callback("acasa_push_subscribers", "Open event streams.", "gauge",
+                              lambda: {(): broker.subscriber_count()})
+    feed = _cached(ctx_cache, 'change_feed', None)
+    refresh = _cached(ctx_cache, 'refresh_catalogue', None)
+
+    def publish(seq, topic, data): # in the thread of the feed
+        if topic == CHANGE_MGMT.CATALOGUE_TOPIC and refresh is not None:
+            refresh()
+        broker.publish(seq, topic, data)
+
+    @web_app.before_serving
+    async def start_change_feed():
+        broker.attach()
+        if feed is not None:
+            feed.poll_interval = push_cfg.get("poll_interval", feed.poll_interval)
+            feed.start(publish)
+
+    @web_app.after_serving
+    async def stop_change_feed():
+        if feed is not None:
+            await asyncio.to_thread(feed.stop)
+
+    @web_app.route("/events")
+    async def events():
+        topics = request.args.getlist("topic") or [CHANGE_MGMT.CATALOGUE_TOPIC]
+        if any(topic != CHANGE_MGMT.CATALOGUE_TOPIC and not _ORDER_TOPIC.match(topic) for topic in topics):
+            abort(400)
+        if "order/*" in topics and not await _logged_in(doc_store):
+            abort(403)
+        last_event_id = request.headers.get("Last-Event-ID", "")
+        stream = EVENT_BROKER.sse_stream(broker, topics, int(last_event_id) if last_event_id.isdigit() else None,
+                                         push_cfg.get("heartbeat_seconds", 15))
+        response = Response(stream, mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}) # no proxy buffering
+        response.timeout = None # open as long as the client stays
+        return response
+
+# Kitchen display API, s. kitchen_management.py: '/kitchen/orders' returns the open orders, '?since=<seq>' only the
+# orders changed after the 'seq' of the previous answer; screens ask again on "order/*" events (s. '/events').
+def _serve_kitchen(web_app: Quart, ctx_cache, doc_store):
+    kitchen_queue = _cached(ctx_cache, 'kitchen_queue', None)
+    if kitchen_queue is None:
+        return
+
+    @web_app.route("/kitchen/orders")
+    async def kitchen_orders():
+        if not await _logged_in(doc_store):
+            abort(403)
+        since = request.args.get("since", "")
+        queue = await asyncio.to_thread(kitchen_queue, int(since) if since.isdigit() else None)
+        return queue, 200, {"Cache-Control": "no-store"}
+
 def init(config: dict = None, **externals) -> Quart:
     """
         A deployment must have a predefined structure, e.g. the config file must be named 'config.yaml' and must have an
@@ -100,9 +426,8 @@ def init(config: dict = None, **externals) -> Quart:
     if global_cache is None:
         global_cache = ContextCache()
 
-    root = config[""]
-    root_resolved = root.resolve()
-    template_path = "{}{}{}".format(root_resolved, str(os.sep), config["template_folder"]) # need abs. path for jinja2
+    root_resolved = Path(config.get("root_path") or SCRIPT_PATH).resolve()
+    template_path = _template_path(config)
     static_path = "{}{}{}".format(root_resolved, str(os.sep), config["static_folder"]) # 
     static_url_path = config["static_url_path"]
     web_app = Quart(
@@ -114,20 +439,129 @@ def init(config: dict = None, **externals) -> Quart:
         template_folder = template_path
     )
     
+    bytecode_cache = _bytecode_cache(config)
+    if bytecode_cache is not None:
+        web_app.jinja_options = dict(web_app.jinja_options, bytecode_cache=bytecode_cache) # before first use of env
+
     _apply_configuration(web_app, config, doc_store)
+    # edited translations are picked up while running (started before serving), s. _translation_refresh()
+    refresh = _translation_refresh(config, global_cache, externals.get("translations"))
+    TRANSL_MGMT.refresh_while_serving(web_app, refresh, config.get("translation_refresh_seconds", 30))
+
+    admission = None
+    if config.get("admission") is not None: # excess requests get a 503 at once, s. admission_control.py
+        admission = web_app.asgi_app = ADMISSION.AdmissionControl(web_app.asgi_app,
+                                                                  **ADMISSION.from_config(config["admission"]))
 
+    manifest = {}
+    if config.get("asset_folder"):
+        manifest = ASSET_PIPELINE.load_manifest(_asset_path(config))
+    _serve_static(web_app, static_url_path, _asset_path(config) if manifest else Path(static_path), manifest,
+                  _download_mounts(externals.get("downloads"), doc_store))
+    _serve_metrics(web_app, config, admission)
+    # templates use {{ asset('css/single.css') }} and {% for script in bundle('js/bundle.js') %}
+    web_app.add_template_global(lambda name: ASSET_PIPELINE.asset_url(manifest, name), "asset")
+    web_app.add_template_global(lambda name: ASSET_PIPELINE.bundle_urls(manifest, name), "bundle")
+    # {{ srcset(prod['image'], 'webp') }}, {{ image_url(prod['image'], 320, 'jpeg') }}
+    web_app.add_template_global(IMAGE_MGMT.srcset, "srcset")
+    web_app.add_template_global(IMAGE_MGMT.image_url, "image_url")
+    _serve_images(web_app, config, global_cache)
+    _serve_events(web_app, config, global_cache, doc_store)
+    _serve_kitchen(web_app, global_cache, doc_store)
+
+    global_cache['page_cache'] = PageCache(**config.get("page_cache", {}))
     site_map = _apply_routes(web_app, render_template, global_cache)
 
+    # Render every page once before the server accepts requests: templates are loaded (from the bytecode cache), the
+    # page cache is filled, so the first customers do not wait longer than later ones.
+    @web_app.before_serving
+    async def warm_up():
+        client = web_app.test_client()
+        failed = []
+        for url in ["/"] + [page["url"] for page in site_map.values() if "GET" in page["methods"]]:
+            response = await client.get(url)
+            if response.status_code >= 500:
+                LOG.error("Warm-up %s: %s", url, response.status_code)
+                failed.append(url)
+            else:
+                LOG.info("Warm-up %s: %s", url, response.status_code)
+        if failed: # a worker that cannot render its pages must not accept requests
+            raise RuntimeError("Warm-up failed for {}".format(", ".join(failed)))
+
     return web_app
 
 # apply cross-cutting concerns, e.g. authentication against a database
 def _apply_configuration(web_app, config, app_store):
-    print("Applying the configuration  to the web_app instance.. (TODO)")
+    LOG.info("Applying the configuration to the web_app instance %s", web_app.name)
 
     #@web_app.route("/")
     def check_cookie():
         print("Req-Headers:", request.access_control_request_headers)
 
+    # ends the session: dropped from the session cache of this worker, too (s. web.CachingWebStore)
+    @web_app.route("/logout", methods=["POST"])
+    async def logout():
+        cookie = request.cookies.get(SESSION_COOKIE_NAME)
+        if cookie:
+            await asyncio.to_thread(app_store.logout, cookie)
+        response = redirect("/")
+        response.delete_cookie(SESSION_COOKIE_NAME)
+        return response
+
+    # templates use {{ t('key') }}, s. translation_management
+    web_app.add_template_global(TRANSL_MGMT.translator(_language), "t")
+
+def _language() -> str:
+    return TRANSL_MGMT.best_language(request.accept_languages)
+
+async def _logged_in(doc_store) -> bool:
+    cookie = request.cookies.get(SESSION_COOKIE_NAME)
+    return bool(cookie) and await WEB.user_for_cookie(doc_store, cookie) is not None # cached sessions: no thread
+
+async def _products(ctx_cache, flights: SINGLE_FLIGHT.AsyncSingleFlight) -> dict:
+    """The products by category; a cold cache is loaded once for all requests waiting for it (s. main.load_catalogue).
+    """
+    try:
+        return ctx_cache['prods']
+    except KeyError:
+        refresh = ctx_cache['refresh_catalogue']
+        await flights.do("catalogue", lambda: asyncio.to_thread(refresh))
+        return ctx_cache['prods']
+
+def _cached(ctx_cache, name: str, default):
+    try:
+        return ctx_cache[name]
+    except KeyError:
+        return default
+
+async def _cached_page(page_cache: PageCache, flights: SINGLE_FLIGHT.AsyncSingleFlight, ctx_cache, route: str,
+                       render) -> Response:
+    """Answer from the page cache; only on a miss 'render' (coroutine function returning the HTML) is awaited - once
+    for all requests missing the same page at the same time. With stale-while-revalidate (s. PageCache) the page of
+    the previous catalogue version is sent while the new one is rendered in the background - except to clients that
+    were told about the new version (push, '?v=<version>', s. app.js).
+    """
+    logged_in = SESSION_COOKIE_NAME in request.cookies
+    version = _cached(ctx_cache, 'catalogue_version', 0), TRANSL_MGMT.current().revision # new texts: new pages, too
+    key = (route, _language(), version, logged_in)
+    page = page_cache.get(key)
+    if page is None:
+        async def render_page():
+            return page_cache.put(key, await render())
+        page = page_cache.stale(key) if "v" not in request.args else None
+        if page is None:
+            page = await flights.do(key, render_page)
+        else:
+            flights.start(key, render_page)
+    headers = {"ETag": page.etag, "Vary": "Accept-Encoding, Accept-Language, Cookie",
+               "Cache-Control": "private, no-cache" if logged_in else "no-cache"} # revalidate with the ETag
+    if page.etag in request.headers.get("If-None-Match", ""):
+        return Response(b"", status=304, headers=headers)
+    if page.gzip_body is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(page.gzip_body, headers=headers, mimetype="text/html")
+    return Response(page.body, headers=headers, mimetype="text/html")
+
 site_map = {
     "Menue": {"url": "/menue", "template": "menue.html", "methods": ["GET"]},
     "My Acasa": {"url": "/settings", "template": "settings.html", "methods": ["GET"]}
@@ -145,14 +579,22 @@ def _apply_routes(asgi_RT, render_func, ctx_cache):
     Returns:
         _type_: _description_
     """
+    page_cache = _cached(ctx_cache, 'page_cache', None) or PageCache() # rendered pages, s. PageCache
+    flights = SINGLE_FLIGHT.AsyncSingleFlight() # page renders and catalogue loads in progress
+
     @asgi_RT.route('/', methods=['GET', 'POST', 'PUT'])
     async def index():
-        return await render_func(["index.html"], site_map=site_map) 
+        if request.method != "GET":
+            return await render_func(["index.html"], site_map=site_map)
+        return await _cached_page(page_cache, flights, ctx_cache, "/",
+                                  lambda: render_func(["index.html"], site_map=site_map))
     
     menue = site_map["Menue"]
     @asgi_RT.route(menue["url"], methods=menue["methods"])
     async def menue_func():
-        return await render_func([menue["template"]], site_map=site_map, prods=ctx_cache['prods'])
+        async def render():
+            return await render_func([menue["template"]], site_map=site_map, prods=await _products(ctx_cache, flights))
+        return await _cached_page(page_cache, flights, ctx_cache, menue["url"], render)
 
     settings = site_map["My Acasa"]
     @asgi_RT.route(settings["url"], methods=settings["methods"])
@@ -161,7 +603,168 @@ def _apply_routes(asgi_RT, render_func, ctx_cache):
     
     return site_map
 
+class _TestStore(WebStore):
+
+    def __init__(self):
+        super().__init__()
+        self.sessions = {}
+        self.lookups = 0
+
+    def is_prepared(self):
+        return True
+
+    def prepare(self):
+        pass
+
+    def get_user_for_cookie(self, cookie):
+        self.lookups += 1
+        return self.sessions.get(cookie)
+
+    def create_user(self, name: str = "", email: str = ""):
+        return None
+
+    def logout(self, cookie):
+        self.sessions.pop(cookie, None)
+
+class UnitTestWebPortal(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        shutil.copytree(Path(Path(__file__).parent, "templates"), Path(self._tmp_dir.name, "templates"))
+        self.config = {"import_name": "test-portal", "root_path": self._tmp_dir.name, "template_folder": "templates",
+                       "template_cache": "template_cache", "static_folder": "static", "static_url_path": "/static"}
+        self.store = _TestStore()
+        self._externals = {}
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+        TRANSL_MGMT.install({})
+
+    def _serve(self, *urls, **cached) -> list:
+        global_cache = ContextCache()
+        global_cache['prods'] = {"Pizza": [{"name": "Pizza Margarita", "price": "4.99", "image": None}]}
+        global_cache['user_settings'] = {}
+        for name, value in cached.items():
+            global_cache[name] = value
+        web_app = init(self.config, user_database=self.store, global_cache=global_cache, **self._externals)
+
+        async def requests() -> list:
+            async with web_app.test_app() as test_app: # runs the warm-up, too
+                client = test_app.test_client()
+                responses = []
+                for url in urls: # URL or (URL, keyword arguments of open(), e.g. method)
+                    url, options = url if isinstance(url, tuple) else (url, {})
+                    responses.append(await client.open(url, **options))
+                return responses
+        return asyncio.run(requests())
+
+    @unittest.skipUnless(importlib.util.find_spec("PIL"), "Pillow not installed")
+    def test_images(self):
+        import io
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 600), "red").save(buffer, "JPEG")
+        self.config["images"] = {"cache_folder": "image_cache", "max_cache_mb": 1, "workers": 1}
+        url = IMAGE_MGMT.image_url("abc", 320, "webp")
+        etag = '"{}"'.format(IMAGE_MGMT.VariantCache.file_name("abc", 320, "webp"))
+        revalidate = (url, {"headers": {"If-None-Match": etag}})
+        variant, unknown, revalidated = self._serve(url, "/images/xyz/320.webp", revalidate,
+                                                    image_loader={"abc": buffer.getvalue()}.get)
+        self.assertEqual((variant.status_code, variant.mimetype, variant.headers["ETag"]), (200, "image/webp", etag))
+        self.assertEqual(asyncio.run(variant.get_data())[8:12], b"WEBP")
+        self.assertEqual((unknown.status_code, revalidated.status_code), (404, 304))
+
+    def test_evicted_variant(self):
+        class Variants():
+            paths = [Path(self._tmp_dir.name, "evicted.webp"), Path(self._tmp_dir.name, "derived.webp")]
+            def get(self, image_id, width, image_format):
+                result = concurrent.futures.Future()
+                result.set_result(self.paths.pop(0) if self.paths else None)
+                return result
+        Path(self._tmp_dir.name, "derived.webp").write_bytes(b"RIFF")
+        variants = Variants()
+        self.assertEqual(asyncio.run(_variant_data(variants, "abc", 320, "webp")), b"RIFF")
+        self.assertIsNone(asyncio.run(_variant_data(variants, "abc", 320, "webp")))
+
+    def test_static_files(self):
+        static_path = Path(Path(__file__).parent, "static")
+        shutil.copytree(static_path, Path(self._tmp_dir.name, "static"))
+        picture, = self._serve("/static/waves-washing-off-the-beach.jpg") # through file_server, memory mapped
+        self.assertEqual(picture.status_code, 200)
+        self.assertEqual(asyncio.run(picture.get_data()),
+                         Path(static_path, "waves-washing-off-the-beach.jpg").read_bytes())
+
+    def test_downloads(self):
+        Path(self._tmp_dir.name, "receipts").mkdir()
+        Path(self._tmp_dir.name, "receipts", "receipt_1.pdf").write_bytes(b"%PDF")
+        self.store.sessions["c1"] = {"name": "Joe"}
+        self._externals = {"downloads": [("/files/receipts/", Path(self._tmp_dir.name, "receipts"))]}
+        anonymous, receipt = self._serve("/files/receipts/receipt_1.pdf",
+                                         ("/files/receipts/receipt_1.pdf",
+                                          {"headers": {"Cookie": "{}=c1".format(SESSION_COOKIE_NAME)}}))
+        self.assertEqual((anonymous.status_code, receipt.status_code), (403, 200))
+        self.assertEqual(asyncio.run(receipt.get_data()), b"%PDF")
+
+    def test_metrics_access(self):
+        local = ("/metrics", {"scope_base": {"client": ("127.0.0.1", 50123)}})
+        metrics, remote = self._serve(local, ("/metrics", {"scope_base": {"client": ("203.0.113.9", 50123)}}))
+        self.assertEqual((metrics.status_code, remote.status_code), (200, 403))
+        self.assertIn(b"acasa_http_request_duration_seconds", asyncio.run(metrics.get_data()))
+        self.config["metrics_allow"] = ["10.0.0.0/8"]
+        self.assertEqual(self._serve(local)[0].status_code, 403)
+
+    def test_session_cache_and_logout(self):
+        self.store = WEB.CachingWebStore(self.store)
+        self.store._delegate.sessions["c1"] = {"name": "Joe"}
+        session_cookie = {"headers": {"Cookie": "{}=c1".format(SESSION_COOKIE_NAME)}}
+        orders, again, logout, after_logout = self._serve(("/kitchen/orders", session_cookie),
+                                                          ("/kitchen/orders", session_cookie),
+                                                          ("/logout", dict(session_cookie, method="POST")),
+                                                          ("/kitchen/orders", session_cookie),
+                                                          kitchen_queue=lambda since=None: {"seq": 0, "orders": []})
+        self.assertEqual((orders.status_code, again.status_code), (200, 200))
+        self.assertEqual((logout.status_code, after_logout.status_code), (302, 403))
+        self.assertEqual(self.store._delegate.lookups, 2) # once before, once after the logout
+        self.assertIsNone(self.store.get_user_for_cookie("c1"))
+
+    def test_translations(self):
+        class Translations(): # the 'Translations' collection
+            def revision(self):
+                return "2"
+            def all(self):
+                return iter([{"language": "EN", "key": "welcome", "text": "Hello!"}])
+        texts = '{"EN": {"welcome": "Welcome!"}, "DE": {"menu_today": "Heute"}}'
+        Path(self._tmp_dir.name, "texts.json").write_text(texts, encoding="UTF-8")
+        self.config.update(translations={"files": ["texts.json"], "fallbacks": {"DE": ["EN"]}},
+                           translation_refresh_seconds=0.05)
+        self.assertEqual(install_translations(self.config).languages(), ["EN", "DE"])
+        global_cache = ContextCache()
+        global_cache['prods'] = {}
+        global_cache['user_settings'] = {}
+        web_app = init(self.config, user_database=self.store, global_cache=global_cache, translations=Translations())
+
+        async def requests() -> list:
+            async with web_app.test_app() as test_app:
+                client = test_app.test_client()
+                pages = [await client.get("/"), await client.get("/", headers={"Accept-Language": "de"})]
+                await asyncio.sleep(0.2) # refreshed from the collection meanwhile
+                pages.append(await client.get("/"))
+                return [await page.get_data(as_text=True) for page in pages]
+        welcome, fallback, refreshed = asyncio.run(requests())
+        self.assertIn("Welcome!", welcome)
+        self.assertIn("Welcome!", fallback)
+        self.assertIn("Hello!", refreshed) # not the page cached before
+
+    def test_render_precompiled(self):
+        self.assertEqual(precompile(self.config), 4)
+        self.assertTrue(os.listdir(Path(self._tmp_dir.name, "template_cache")))
+        index, menue = self._serve("/", "/menue")
+        self.assertEqual((index.status_code, menue.status_code), (200, 200))
+        self.assertIn(b"Pizza Margarita", asyncio.run(menue.get_data()))
+
+
 if __name__ == "__main__":
-    print("This is a module and cannot be invoked directly.")
-    # raise error?
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
     
\ No newline at end of file
@@ -0,0 +1,195 @@
+# ACASA Admission Control
+# ASGI middleware that bounds the requests worked on at the same time, so that a rush degrades into fast rejections
+# instead of every request getting slower (SQLite and Arango serve a few requests well, hundreds at once badly). Every
+# request is assigned a class - reads (menu browsing) or writes (order submissions) by default - with a concurrency
+# limit and a bounded wait queue of its own; a request finding the queue full, or waiting longer than 'max_wait', is
+# answered at once with 503 and 'Retry-After'. A free slot goes to the waiting request of the class with the highest
+# priority first, so orders get through while browsing is throttled. Long-lived streams (Server-Sent Events) are not
+# counted.
+import asyncio
+from collections import deque, namedtuple
+import time
+import unittest
+
+RouteClass = namedtuple("RouteClass", ["concurrency", "queue", "priority"], defaults=[0])
+RouteClass.__doc__ = """Limits of a class of requests: at most 'concurrency' in progress, 'queue' waiting; waiting
+    requests of the class with the higher 'priority' are admitted first.
+"""
+
+WRITE_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+DEFAULT_CLASSES = {"reads": RouteClass(32, 64, 0), "writes": RouteClass(8, 32, 1)}
+UNLIMITED_PATHS = ("/events",) # streams, s. event_broker.py
+
+
+def classify(scope: dict) -> str:
+    """'writes' for order submissions and other changes, 'reads' for the rest; None: not limited.
+    """
+    if scope["path"].startswith(UNLIMITED_PATHS):
+        return None
+    return "writes" if scope["method"] in WRITE_METHODS else "reads"
+
+
+def from_config(admission_config: dict) -> dict:
+    """Keyword arguments of AdmissionControl from a configuration like {"max_wait_seconds": 2, "retry_after_seconds":
+    1, "total": 32, "classes": {"reads": {"concurrency": 24, "queue": 48}, "writes": {.., "priority": 1}}}.
+    """
+    return {"classes": {name: RouteClass(**limits) for name, limits in admission_config.get("classes", {}).items()}
+            or DEFAULT_CLASSES, "total": admission_config.get("total"),
+            "max_wait": admission_config.get("max_wait_seconds", 2.0),
+            "retry_after": admission_config.get("retry_after_seconds", 1)}
+
+
+class _ClassState():
+
+    def __init__(self, name: str, limits: RouteClass):
+        self.name = name
+        self.limits = limits
+        self.active = 0
+        self.waiting = deque() # futures of the waiting requests, oldest first
+        self.admitted = 0
+        self.rejected = 0
+
+
+class AdmissionControl():
+    """ASGI middleware, e.g. web_app.asgi_app = AdmissionControl(web_app.asgi_app).
+    Args:
+        app: The wrapped ASGI application.
+        classes (dict, optional): Class name => RouteClass.
+        classify (optional): Function of the ASGI scope returning the class name (None: not limited).
+        total (int, optional): Limit of all classes together; the priorities decide who gets a free slot.
+        max_wait (float, optional): Seconds a request may wait for a slot.
+        retry_after (int, optional): Seconds sent in 'Retry-After' with a 503.
+    """
+
+    def __init__(self, app, classes: dict = None, classify=classify, total: int = None, max_wait: float = 2.0,
+                 retry_after: int = 1):
+        self.app = app
+        self._classes = {name: _ClassState(name, limits) for name, limits in (classes or DEFAULT_CLASSES).items()}
+        self._by_priority = sorted(self._classes.values(), key=lambda state: -state.limits.priority)
+        self._classify = classify
+        self.total = total
+        self.max_wait = max_wait
+        self._retry_after = str(retry_after).encode("latin-1")
+        self._active = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        name = self._classify(scope)
+        if name is None:
+            return await self.app(scope, receive, send)
+        state = self._classes[name]
+        if not await self._admit(state):
+            state.rejected += 1
+            return await self._reject(send)
+        state.admitted += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self._release(state)
+
+    def _free(self, state: _ClassState) -> bool:
+        return state.active < state.limits.concurrency and (self.total is None or self._active < self.total)
+
+    async def _admit(self, state: _ClassState) -> bool:
+        if self._free(state) and not state.waiting: # waiting requests of other classes cannot take the slot either
+            self._take(state)
+            return True
+        if len(state.waiting) >= state.limits.queue:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        state.waiting.append(future)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+            return True # the slot was taken for us, s. _wake()
+        except asyncio.TimeoutError:
+            if future.done(): # admitted just in time
+                return True
+            state.waiting.remove(future)
+            return False
+        except asyncio.CancelledError:
+            if future.done():
+                self._release(state)
+            else:
+                state.waiting.remove(future)
+            raise
+
+    def _take(self, state: _ClassState):
+        state.active += 1
+        self._active += 1
+
+    def _release(self, state: _ClassState):
+        state.active -= 1
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        for state in self._by_priority: # highest priority first
+            while state.waiting and self._free(state):
+                self._take(state)
+                state.waiting.popleft().set_result(True)
+
+    async def _reject(self, send):
+        await send({"type": "http.response.start", "status": 503,
+                    "headers": [(b"retry-after", self._retry_after), (b"content-type", b"text/plain"),
+                                (b"content-length", b"19")]})
+        await send({"type": "http.response.body", "body": b"Too many requests.\n"})
+
+    def stats(self) -> dict:
+        """E.g. {"reads": {"active": 32, "waiting": 10, "admitted": 1200, "rejected": 55}, ..}
+        """
+        return {name: {"active": state.active, "waiting": len(state.waiting), "admitted": state.admitted,
+                       "rejected": state.rejected} for name, state in self._classes.items()}
+
+
+class UnitTestAdmission(unittest.TestCase):
+
+    def _run(self, control: AdmissionControl, requests: list) -> list:
+        """Start the requests [(method, path)] in this order; returns [(path, status, finished at)]."""
+        results = []
+
+        async def request(method: str, path: str):
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+
+            scope = {"type": "http", "method": method, "path": path, "headers": []}
+            await control(scope, None, send)
+            results.append((path, messages[0]["status"], time.monotonic()))
+
+        async def scenario():
+            tasks = []
+            for method, path in requests:
+                tasks.append(asyncio.ensure_future(request(method, path)))
+                await asyncio.sleep(0) # arrive in this order
+            await asyncio.gather(*tasks)
+        asyncio.run(scenario())
+        return results
+
+    async def _app(self, scope, receive, send):
+        await asyncio.sleep(0.02)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    def test_limits(self):
+        control = AdmissionControl(self._app, {"reads": RouteClass(2, 1), "writes": RouteClass(1, 1, 1)})
+        results = self._run(control, [("GET", "/menue")] * 5 + [("GET", "/events")])
+        self.assertEqual(sorted(status for _, status, _ in results), [200, 200, 200, 200, 503, 503])
+        rejected = [finished for _, status, finished in results if status == 503] # fast, before any request is done
+        self.assertLess(max(rejected), min(finished for _, status, finished in results if status == 200))
+        self.assertEqual(control.stats()["reads"], {"active": 0, "waiting": 0, "admitted": 3, "rejected": 2})
+
+    def test_priority_and_wait(self):
+        control = AdmissionControl(self._app, {"reads": RouteClass(1, 5), "writes": RouteClass(1, 5, 1)}, total=1)
+        results = self._run(control, [("GET", "/menue"), ("GET", "/settings"), ("GET", "/"), ("POST", "/orders")])
+        self.assertEqual([path for path, _, _ in results], ["/menue", "/orders", "/settings", "/"]) # order first
+        control.max_wait = 0.01
+        results = self._run(control, [("GET", "/menue"), ("GET", "/")])
+        self.assertEqual([(path, status) for path, status, _ in results], [("/", 503), ("/menue", 200)])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
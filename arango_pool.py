@@ -0,0 +1,217 @@
+# Process-wide ArangoDB clients: one ArangoClient per server URL, sharing keep-alive HTTP connections (pooled per host),
+# retrying failed requests with exponential backoff and checking the server's health on demand.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+import time
+import unittest
+from urllib.parse import urlparse
+
+from arango import ArangoClient
+from arango.http import HTTPClient
+from arango.response import Response
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics as METRICS
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BACKOFF_FACTOR = 0.2  # sleeps 0.2, 0.4, 0.8.. seconds between retries
+
+HEALTH_CHECK_PATH = "/_admin/server/availability"  # answered without authentication
+
+
+class PooledHTTPClient(HTTPClient):
+    """HTTP client for python-arango that hands out the SAME requests session for a host every time a connection is
+    created (each ArangoClient.db() call creates one), so connections are kept alive across database handles.
+    """
+
+    def __init__(self, timeout: int = 12, max_retries: int = 3, pool_size: int = DEFAULT_POOL_SIZE,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR):
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._pool_size = pool_size
+        self._backoff_factor = backoff_factor
+        self.settings = {"timeout": timeout, "max_retries": max_retries, "pool_size": pool_size}
+        self._sessions = {}  # host => Session
+        self._lock = threading.Lock()
+
+    def create_session(self, host: str) -> Session:
+        with self._lock:
+            if host not in self._sessions:
+                # Non-idempotent requests (e.g. AQL via POST) are only retried if they did not reach the server
+                retry = Retry(total=self._max_retries, backoff_factor=self._backoff_factor,
+                              status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size, max_retries=retry)
+                session = Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def send_request(self, session: Session, method: str, url: str, headers=None, params=None, data=None,
+                     auth=None) -> Response:
+        start = time.perf_counter()
+        try:
+            response = session.request(method=method, url=url, params=params, data=data, headers=headers, auth=auth,
+                                       timeout=self._timeout)
+        finally:
+            METRICS.observe_call("arango", method.upper(), time.perf_counter() - start) # per request, s. metrics.py
+        return Response(method=method, url=response.url, headers=response.headers, status_code=response.status_code,
+                        status_text=response.reason, raw_body=response.text)
+
+    def is_healthy(self, host: str) -> bool:
+        try:
+            response = self.create_session(host).get(host + HEALTH_CHECK_PATH, timeout=self._timeout)
+            return response.status_code == 200
+        except Exception:
+            return False
+
+    def reset(self, host: str):
+        # Drop pooled (possibly dead) connections; the next request reconnects.
+        with self._lock:
+            session = self._sessions.pop(host, None)
+        if session is not None:
+            session.close()
+
+
+class ArangoClientRegistry():
+    """
+        Shared by the whole process (s. 'registry' below), thread-safe.
+        - get_client(): one ArangoClient per URL; asking for it with other settings is an error
+        - database(): cached database handles per (URL, database, user)
+        - check_health(): ping all known servers, reset the connections of unhealthy ones
+    """
+
+    def __init__(self):
+        self._clients = {}  # url => (ArangoClient, PooledHTTPClient)
+        self._databases = {}  # (url, db_name, user) => StandardDatabase
+        self._lock = threading.Lock()
+
+    def get_client(self, host_name: str, host_port: int, timeout: int = 12, max_retries: int = 3,
+                   pool_size: int = DEFAULT_POOL_SIZE) -> ArangoClient:
+        url = "http://{}:{}".format(host_name, host_port)
+        settings = {"timeout": timeout, "max_retries": max_retries, "pool_size": pool_size}
+        with self._lock:
+            if url not in self._clients:
+                http_client = PooledHTTPClient(timeout=timeout, max_retries=max_retries, pool_size=pool_size)
+                self._clients[url] = ArangoClient(hosts=url, http_client=http_client), http_client
+            elif self._clients[url][1].settings != settings: # would silently be ignored otherwise
+                raise ValueError("Client for {} exists with other settings: {} (asked for: {})".format(
+                    url, self._clients[url][1].settings, settings))
+            return self._clients[url][0]
+
+    def database(self, client: ArangoClient, db_name: str, username: str, password: str):
+        key = (client.hosts[0], db_name, username)
+        with self._lock:
+            if key not in self._databases:
+                self._databases[key] = client.db(db_name, username=username, password=password)
+            return self._databases[key]
+
+    def check_health(self) -> dict:
+        health = {}
+        for url, (client, http_client) in list(self._clients.items()):
+            health[url] = http_client.is_healthy(url)
+            if not health[url]:
+                http_client.reset(url)
+        return health
+
+    def clear(self):
+        with self._lock:
+            for client, http_client in self._clients.values():
+                for host in client.hosts:
+                    http_client.reset(host)
+            self._clients = {}
+            self._databases = {}
+
+
+registry = ArangoClientRegistry()
+
+
+class _ArangoStandIn(BaseHTTPRequestHandler):
+    """Local HTTP stand-in for an Arango server: answers the version and availability endpoints, optionally failing
+    the first 'failures' requests with 503.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive
+    failures = 0
+    connections = 0
+
+    def setup(self):
+        _ArangoStandIn.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        path = urlparse(self.path).path # without the query, e.g. '?details=0'
+        if _ArangoStandIn.failures > 0:
+            _ArangoStandIn.failures -= 1
+            self._answer(503, {"error": True, "code": 503, "errorNum": 503, "errorMessage": "unavailable"})
+        elif path.endswith("/_api/version"):
+            self._answer(200, {"server": "arango", "version": "3.10.0", "license": "community"})
+        elif path == HEALTH_CHECK_PATH:
+            # not kept alive: the handler thread of a pooled connection would outlive the server's shutdown
+            self._answer(200, {"mode": "default"}, keep_alive=False)
+        else:
+            self._answer(404, {"error": True, "code": 404, "errorNum": 404, "errorMessage": "not found"})
+
+    def _answer(self, status: int, body: dict, keep_alive: bool = True):
+        raw = json.dumps(body).encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        if not keep_alive:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass  # keep test output clean
+
+
+class UnitTestArangoPool(unittest.TestCase):
+
+    def setUp(self):
+        _ArangoStandIn.failures = 0
+        _ArangoStandIn.connections = 0
+        self._server = ThreadingHTTPServer(("localhost", 0), _ArangoStandIn)
+        self._port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self._registry = ArangoClientRegistry()
+
+    def tearDown(self):
+        self._registry.clear()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _sys_db(self, max_retries: int = 3):
+        client = self._registry.get_client("localhost", self._port, timeout=2, max_retries=max_retries)
+        return self._registry.database(client, "_system", "root", "")
+
+    def test_client_shared_and_connection_kept_alive(self):
+        self.assertIs(self._registry.get_client("localhost", self._port),
+                      self._registry.get_client("localhost", self._port))
+        with self.assertRaises(ValueError):
+            self._registry.get_client("localhost", self._port, timeout=1)
+        self._registry.clear()
+        for _ in range(5):
+            self.assertEqual(self._sys_db().version(), "3.10.0")
+        self.assertEqual(_ArangoStandIn.connections, 1)
+
+    def test_retry_with_backoff(self):
+        _ArangoStandIn.failures = 2
+        start = time.perf_counter()
+        self.assertEqual(self._sys_db(max_retries=3).version(), "3.10.0")
+        self.assertGreater(time.perf_counter() - start, DEFAULT_BACKOFF_FACTOR)
+
+    def test_health_check(self):
+        self._registry.get_client("localhost", self._port)
+        self.assertEqual(list(self._registry.check_health().values()), [True])
+        self._server.shutdown()
+        self._server.server_close()
+        self.assertEqual(list(self._registry.check_health().values()), [False])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
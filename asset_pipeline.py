@@ -0,0 +1,223 @@
+# ACASA static asset pipeline
+# Build step (at deployment, s. web_portal.build_assets()): the files of the static folder are copied into an output
+# folder; JS is bundled, JS and CSS are minified, every asset gets a content-hashed name (e.g. 'css/single.3f2a..css')
+# and text files get precompressed '.gz' (and '.br', if the 'brotli' package is installed) siblings. 'manifest.json'
+# maps the logical names to the hashed ones; pages refer to assets through it (s. asset_url(), bundle_urls()), so a
+# hashed file never changes and can be cached by the browsers forever. The original names are copied as well, for
+# URLs that cannot be rewritten (e.g. '/favicon.ico').
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import unittest
+
+MANIFEST_FILE = "manifest.json"
+
+# Scripts loaded together, in this order; require.js first, so that jQuery registers itself as AMD module 'jquery'
+BUNDLES = {
+    "js/bundle.js": ("js/require.js", "js/lib/jquery-3.6.3.min.js", "js/app.js")
+}
+
+COMPRESSIBLE = (".js", ".css", ".html", ".ico", ".svg", ".json", ".txt")
+NOT_HASHED = (".html",) # fetched by fixed URLs, e.g. from scripts
+
+_CSS_COMMENT = re.compile(r"/\*(?!!).*?\*/", re.DOTALL) # /*! ... */ (licenses) are kept
+_CSS_SPACE = re.compile(r"\s+")
+_CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*")
+_CSS_COLON = re.compile(r":\s+") # never remove the space BEFORE ':', 'a :hover' is not 'a:hover'
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def minify_css(text: str) -> str:
+    text = _CSS_COMMENT.sub("", text)
+    text = _CSS_SPACE.sub(" ", text)
+    text = _CSS_PUNCTUATION.sub(r"\1", text)
+    text = _CSS_COLON.sub(":", text)
+    return text.replace(";}", "}").strip()
+
+
+def _minify_js_fallback(text: str) -> str:
+    """Conservative: drops indentation, blank lines and comment-only lines (but not license comments), keeps the line
+    breaks (automatic semicolon insertion) and never touches the line after a line ending with a backslash.
+    """
+    lines = []
+    comment = None # lines of the block comment being read
+    continued = False
+    for line in text.splitlines():
+        stripped = line.strip()
+        if continued:
+            lines.append(line)
+        elif comment is not None:
+            comment.append(stripped)
+            if "*/" in stripped:
+                if comment[0].startswith("/*!") or any("@license" in comment_line for comment_line in comment):
+                    lines.extend(comment)
+                comment = None
+        elif stripped.startswith("/*") and ("*/" not in stripped or stripped.endswith("*/")):
+            comment = [stripped]
+            if "*/" in stripped[2:]: # one-line comment
+                if stripped.startswith("/*!") or "@license" in stripped:
+                    lines.append(stripped)
+                comment = None
+        elif stripped and not stripped.startswith("//"):
+            lines.append(stripped)
+        continued = line.endswith("\\")
+    return "\n".join(lines)
+
+
+def minify_js(text: str) -> str:
+    """With 'rjsmin', if installed; otherwise only whitespace and comment lines are removed.
+    """
+    try:
+        from rjsmin import jsmin
+    except ImportError:
+        return _minify_js_fallback(text)
+    return jsmin(text, keep_bang_comments=True)
+
+
+def hashed_name(logical_name: str, data: bytes) -> str:
+    """E.g. 'css/single.css' => 'css/single.3f2a0c9e1b7d.css'
+    """
+    path = Path(logical_name)
+    return path.with_name("{}.{}{}".format(path.stem, hashlib.sha256(data).hexdigest()[:12], path.suffix)).as_posix()
+
+
+def _rewrite_css_urls(text: str, css_name: str, manifest: dict) -> str:
+    def replace(match):
+        ref = match.group(2)
+        if ref.startswith(("data:", "http:", "https:", "//")):
+            return match.group(0)
+        logical = ref.lstrip("/") if ref.startswith("/") else \
+            os.path.normpath(os.path.join(os.path.dirname(css_name), ref)).replace(os.sep, "/")
+        return "url('/{}')".format(manifest[logical]) if logical in manifest else match.group(0)
+    return _CSS_URL.sub(replace, text)
+
+
+def _write(output_path: Path, name: str, data: bytes):
+    file_path = Path(output_path, name)
+    os.makedirs(file_path.parent, exist_ok=True)
+    file_path.write_bytes(data)
+    if file_path.suffix not in COMPRESSIBLE:
+        return
+    variants = [(".gz", gzip.compress(data, 9, mtime=0))]
+    try:
+        import brotli
+        variants.append((".br", brotli.compress(data)))
+    except ImportError:
+        pass
+    for suffix, compressed in variants:
+        if len(compressed) < 0.9 * len(data): # else the plain file is served
+            Path(output_path, name + suffix).write_bytes(compressed)
+
+
+def build(static_path: Path, output_path: Path) -> dict:
+    """Build the assets of 'static_path' into 'output_path' (replaced as a whole, the static folder is not changed).
+
+    Returns:
+        dict: The manifest, e.g. {"css/single.css": "css/single.3f2a0c9e1b7d.css", "js/bundle.js": ..}
+    """
+    static_path, output_path = Path(static_path), Path(output_path)
+    sources = {file_path.relative_to(static_path).as_posix(): file_path.read_bytes()
+               for file_path in sorted(static_path.rglob("*")) if file_path.is_file()}
+    build_path = Path(tempfile.mkdtemp(prefix=output_path.name + ".", dir=output_path.parent))
+    manifest = {}
+    try:
+        for name, data in sources.items(): # originals and everything the CSS/JS may refer to
+            _write(build_path, name, data)
+            if not name.endswith((".css", ".js") + NOT_HASHED):
+                manifest[name] = hashed_name(name, data)
+                _write(build_path, manifest[name], data)
+        for name, data in sources.items():
+            if name.endswith(".css"):
+                css = minify_css(_rewrite_css_urls(data.decode("UTF-8"), name, manifest)).encode("UTF-8")
+                manifest[name] = hashed_name(name, css)
+                _write(build_path, manifest[name], css)
+            elif name.endswith(".js") and not name.endswith(".min.js"):
+                js = minify_js(data.decode("UTF-8")).encode("UTF-8")
+                manifest[name] = hashed_name(name, js)
+                _write(build_path, manifest[name], js)
+            elif name.endswith(".js"):
+                manifest[name] = hashed_name(name, data)
+                _write(build_path, manifest[name], data)
+        for bundle_name, members in BUNDLES.items():
+            if all(member in sources for member in members):
+                bundle = b";\n".join(Path(build_path, manifest[member]).read_bytes() for member in members)
+                manifest[bundle_name] = hashed_name(bundle_name, bundle)
+                _write(build_path, manifest[bundle_name], bundle)
+        Path(build_path, MANIFEST_FILE).write_text(json.dumps(manifest, indent=1, sort_keys=True), encoding="UTF-8")
+        if output_path.exists():
+            shutil.rmtree(output_path)
+        os.replace(build_path, output_path)
+    except BaseException:
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise
+    return manifest
+
+
+def load_manifest(output_path: Path) -> dict:
+    """The manifest of a build; empty without a build (the static folder is served as is).
+    """
+    try:
+        return json.loads(Path(output_path, MANIFEST_FILE).read_text(encoding="UTF-8"))
+    except FileNotFoundError:
+        return {}
+
+
+def asset_url(manifest: dict, name: str) -> str:
+    """URL of a static file, e.g. 'css/single.css' => '/css/single.3f2a0c9e1b7d.css' (without build: '/css/single.css')
+    """
+    name = name.lstrip("/")
+    return "/" + manifest.get(name, name)
+
+
+def bundle_urls(manifest: dict, bundle_name: str) -> list:
+    """The script URLs of a bundle: the bundle itself if built, otherwise its members one by one.
+    """
+    if bundle_name in manifest:
+        return [asset_url(manifest, bundle_name)]
+    return [asset_url(manifest, member) for member in BUNDLES[bundle_name]]
+
+
+class UnitTestAssets(unittest.TestCase):
+
+    def test_minify(self):
+        self.assertEqual(minify_css("/* menu */\n.menu-1 a:hover ,p > b {\n    color: #fff;\n    top : 0;\n}\n"),
+                         ".menu-1 a:hover,p>b{color:#fff;top :0}")
+        self.assertEqual(minify_css("div :first-child { }"), "div :first-child{}")
+        self.assertEqual(_minify_js_fallback("/**\n * @license MIT\n */\n// comment\n\n    var a = 1;\n/* x */\nb();"),
+                         "/**\n* @license MIT\n*/\nvar a = 1;\nb();")
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            static_path = Path(tmp_dir, "static")
+            for name, text in (("css/single.css", "body {\n    background: url('/beach.jpg');\n}\n"),
+                               ("beach.jpg", "JPEG"), ("test.html", "<html></html>"),
+                               ("js/require.js", "var define;\n" * 100), ("js/lib/jquery-3.6.3.min.js", "jq()"),
+                               ("js/app.js", "    requirejs(['jquery']);\n")):
+                Path(static_path, name).parent.mkdir(parents=True, exist_ok=True)
+                Path(static_path, name).write_text(text, encoding="UTF-8")
+            output_path = Path(tmp_dir, "static_build")
+            build(static_path, output_path)
+            manifest = build(static_path, output_path) # replaces the first build
+            self.assertEqual(load_manifest(output_path), manifest)
+            self.assertNotIn("test.html", manifest)
+            css = Path(output_path, manifest["css/single.css"]).read_text(encoding="UTF-8")
+            self.assertEqual(css, "body{background:url('/" + manifest["beach.jpg"] + "')}")
+            self.assertTrue(Path(output_path, manifest["js/require.js"] + ".gz").exists())
+            self.assertTrue(Path(output_path, "beach.jpg").exists()) # original names, too
+            self.assertEqual(Path(output_path, manifest["js/bundle.js"]).read_text(encoding="UTF-8"),
+                             "var define;\n" * 99 + "var define;;\njq();\nrequirejs(['jquery']);")
+            self.assertEqual(bundle_urls(manifest, "js/bundle.js"), ["/" + manifest["js/bundle.js"]])
+            self.assertEqual(bundle_urls({}, "js/bundle.js"),
+                             ["/js/require.js", "/js/lib/jquery-3.6.3.min.js", "/js/app.js"])
+            self.assertEqual(sorted(path.name for path in Path(tmp_dir).iterdir()), ["static", "static_build"])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -0,0 +1,381 @@
+# ACASA Benchmarks
+# Usage: python benchmarks.py [benchmark_name ...]; without names, all benchmarks are run. Every benchmark works on its
+# own synthetic database in a temporary directory, the productive database is never touched.
+import datetime
+from pathlib import Path
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from db import create_analytics_proxy, create_proxy
+import import_management as IMPORT_MGMT
+
+SCRIPT_PATH = Path(__file__).parent.resolve()
+SQL_PATH = SCRIPT_PATH / "products_db.sql"
+
+
+def make_sample_db(db_path: Path, n_orders: int = 100000, items_per_order: int = 3, n_products: int = 200,
+                   n_categories: int = 10, seed: int = 4711):
+    """Create a database from products_db.sql filled with random orders over one year.
+    """
+    rnd = random.Random(seed)
+    first_day = datetime.date(2023, 1, 1)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SQL_PATH.read_text(encoding="UTF-8"))
+    conn.executemany("INSERT INTO categories (id, name) VALUES (?, ?)",
+                     [(cat_id, "Category {}".format(cat_id)) for cat_id in range(1, n_categories + 1)])
+    conn.executemany("INSERT INTO products (id, name, price, category_id) VALUES (?, ?, ?, ?)",
+                     [(prod_id, "Product {}".format(prod_id), rnd.randint(100, 3000),
+                       rnd.randint(1, n_categories)) for prod_id in range(1, n_products + 1)])
+    conn.executemany("INSERT INTO orders (id, customer, status, order_date) VALUES (?, ?, ?, ?)",
+                     [(order_id, "Customer {}".format(rnd.randint(1, 5000)), rnd.randint(0, 3),
+                       (first_day + datetime.timedelta(days=rnd.randint(0, 364))).isoformat())
+                      for order_id in range(1, n_orders + 1)])
+    conn.executemany("INSERT INTO order_items (order_id, item_id, amount) VALUES (?, ?, ?)",
+                     [(order_id, item_id, rnd.randint(1, 5))
+                      for order_id in range(1, n_orders + 1)
+                      for item_id in rnd.sample(range(1, n_products + 1), items_per_order)])
+    conn.commit()
+    conn.close()
+
+
+def _timed(func, repeat: int = 3) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _print_results(title: str, header: tuple, rows: list):
+    print()
+    print(title)
+    print(len(title) * "~")
+    print("".join("{:>28}".format(col) for col in header))
+    for row in rows:
+        print("".join("{:>28}".format(col if isinstance(col, str) else "{:.4f}".format(col)) for col in row))
+
+
+# Same SQL for both stores; only functions available in SQLite and DuckDB are used.
+ANALYTIC_QUERIES = {
+    "revenue per category/month": """SELECT c.name, substr(CAST(o.order_date AS VARCHAR), 1, 7) AS month,
+                SUM(i.amount * p.price) AS revenue
+            FROM order_items i, orders o, products p, categories c
+            WHERE i.order_id = o.id AND i.item_id = p.id AND p.category_id = c.id
+            GROUP BY c.name, month""",
+    "top 10 products": """SELECT p.name, SUM(i.amount) AS quantity
+            FROM order_items i, products p
+            WHERE i.item_id = p.id
+            GROUP BY p.name
+            ORDER BY quantity DESC
+            LIMIT 10""",
+    "orders per day": """SELECT o.order_date, COUNT(DISTINCT o.id), SUM(i.amount)
+            FROM orders o, order_items i
+            WHERE i.order_id = o.id
+            GROUP BY o.order_date"""
+}
+
+
+def bench_analytics(n_orders: int = 200000):
+    """Run the same aggregate queries on SQLite and on the embedded analytical store (DuckDB).
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "bench.db3")
+        make_sample_db(db_path, n_orders=n_orders)
+        sqlite_db = create_proxy(db_path)
+        analytics_db = create_analytics_proxy()
+        load_time = _timed(lambda: analytics_db.load_from_sqlite(
+            sqlite_db, ["categories", "products", "orders", "order_items"]), repeat=1)
+        results = [("load from SQLite", 0.0, load_time, "-")]
+        for query_name, sql in ANALYTIC_QUERIES.items():
+            sqlite_time = _timed(lambda: sqlite_db.query(sql))
+            analytics_time = _timed(lambda: analytics_db.query(sql))
+            results.append((query_name, sqlite_time, analytics_time, "{:.1f}x".format(sqlite_time / analytics_time)))
+        analytics_db.close()
+    _print_results("Aggregates on {} orders (best of 3, seconds)".format(n_orders),
+                   ("query", "SQLite", "DuckDB", "speed-up"), results)
+
+
+def make_sample_csv_files(csv_dir: Path, n_products: int = 1000000, n_categories: int = 1000, seed: int = 4711) -> dict:
+    """Write 'categories.csv' and 'products.csv' in the format of the shipped files; returns the 'files' argument for
+    import_management.import_files().
+    """
+    rnd = random.Random(seed)
+    files = {"categories": (["ID", "NAME"], Path(csv_dir, "categories.csv")),
+             "products": (["ID", "NAME", "PRICE", "CATEGORY_ID"], Path(csv_dir, "products.csv"))}
+    with open(files["categories"][1], mode="w", encoding="UTF-8") as csv_file:
+        csv_file.write("ID|NAME\n")
+        csv_file.writelines("{}|'Category {}'\n".format(cat_id, cat_id) for cat_id in range(1, n_categories + 1))
+    with open(files["products"][1], mode="w", encoding="UTF-8") as csv_file:
+        csv_file.write("ID|NAME|PRICE|CATEGORY_ID\n")
+        csv_file.writelines("{}|'Product {}'|{:.2f}|{}\n".format(prod_id, prod_id, rnd.uniform(1, 30),
+                                                                  rnd.randint(1, n_categories))
+                            for prod_id in range(1, n_products + 1))
+    return files
+
+
+def bench_parallel_import(n_products: int = 1000000, worker_counts: tuple = (1, 2, 4, 8)):
+    """Import the same CSV files with 1, 2, 4, 8 parser processes (single writer) into fresh databases.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = make_sample_csv_files(Path(tmp_dir), n_products=n_products)
+        base_time = None
+        for workers in worker_counts:
+            db_path = Path(tmp_dir, "import_{}.db3".format(workers))
+            conn = sqlite3.connect(db_path)
+            conn.executescript(SQL_PATH.read_text(encoding="UTF-8"))
+            conn.close()
+            db = create_proxy(db_path)
+            elapsed = _timed(lambda: IMPORT_MGMT.import_files(db, files, workers=workers, batch_size=5000,
+                                                              shard_bytes=4 * 1024 * 1024), repeat=1)
+            base_time = base_time or elapsed
+            results.append(("{} worker(s)".format(workers), elapsed, "{:.0f}".format(n_products / elapsed),
+                            "{:.2f}x".format(base_time / elapsed)))
+    _print_results("CSV import of {} products (seconds)".format(n_products),
+                   ("workers", "time", "rows/s", "speed-up"), results)
+
+
+def bench_convert(n_products: int = 1000000):
+    """Parse and type-convert a 'products.csv' shaped file in one process (one core), without writing.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = make_sample_csv_files(Path(tmp_dir), n_products=n_products, n_categories=10)
+        db_path = Path(tmp_dir, "convert.db3")
+        conn = sqlite3.connect(db_path)
+        conn.executescript(SQL_PATH.read_text(encoding="UTF-8"))
+        conn.close()
+        attrs, file_path = files["products"]
+        columns = IMPORT_MGMT.column_spec(create_proxy(db_path), "products", attrs)
+        shards = IMPORT_MGMT.plan_shards("products", file_path, columns, shard_bytes=file_path.stat().st_size)
+        elapsed = _timed(lambda: IMPORT_MGMT.parse_shard(shards[0]))
+    _print_results("CSV parse + convert of {} products (best of 3, seconds)".format(n_products),
+                   ("rows", "time", "rows/s"), [(str(n_products), elapsed, "{:.0f}".format(n_products / elapsed))])
+
+
+def bench_receipts(n_receipts: int = 500, worker_counts: tuple = (1, 2, 4)):
+    """Render the same PDF receipts with 1, 2, 4 processes (needs reportlab).
+    """
+    import output_management as OUTPUT_MGMT
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "receipts.db3")
+        make_sample_db(db_path, n_orders=n_receipts)
+        receipts = OUTPUT_MGMT.receipt_data(create_proxy(db_path), list(range(1, n_receipts + 1)))
+        base_time = None
+        for workers in worker_counts:
+            renderer = OUTPUT_MGMT.ReceiptRenderer({"output_file_directory": Path(tmp_dir, str(workers)),
+                                                    "receipt_workers": workers})
+            renderer.render_batch(receipts[:workers])  # start the workers, register fonts
+            elapsed = _timed(lambda: renderer.render_batch(receipts), repeat=1)
+            renderer.close()
+            base_time = base_time or elapsed
+            results.append(("{} worker(s)".format(workers), elapsed, "{:.0f}".format(n_receipts / elapsed),
+                            "{:.2f}x".format(base_time / elapsed)))
+    _print_results("PDF receipts, {} orders (seconds)".format(n_receipts),
+                   ("workers", "time", "receipts/s", "speed-up"), results)
+
+
+def bench_settlement(n_orders: int = 200000):
+    """Settle a year of orders: receipt by receipt in Python vs. integer array operations (needs numpy).
+    """
+    import billing_management as BILLING_MGMT
+    import output_management as OUTPUT_MGMT
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "settlement.db3")
+        make_sample_db(db_path, n_orders=n_orders)
+        db = create_proxy(db_path)
+
+        def per_receipt():
+            receipts = OUTPUT_MGMT.receipt_data(db, list(range(1, n_orders + 1)))
+            return [BILLING_MGMT.receipt_totals(receipt["items"], 1900) for receipt in receipts]
+
+        loop_time = _timed(per_receipt, repeat=1)
+        array_time = _timed(lambda: BILLING_MGMT.settlement(db, "2023-01-01", "2023-12-31", 1900), repeat=1)
+    _print_results("Settlement of {} orders (seconds)".format(n_orders), ("variant", "time", "speed-up"),
+                   [("per receipt (Python)", loop_time, "1.0x"),
+                    ("arrays (numpy)", array_time, "{:.1f}x".format(loop_time / array_time))])
+
+
+def bench_order_sessions(n_sessions: int = 5000, threads: int = 8, n_products: int = 200):
+    """Concurrent simulated order sessions (search, pick 3 items): catalogue fetched and menu rebuilt per session vs.
+    one shared MenuIndex.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from main import ProductDbMapper
+    import order_management as ORDER_MGMT
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "sessions.db3")
+        make_sample_db(db_path, n_orders=10, n_products=n_products)
+        mapper = ProductDbMapper(create_proxy(db_path))
+
+        def session_per_fetch(seed: int) -> dict:
+            rnd = random.Random(seed)
+            avail = {str(dish["id"]): (dish["name"], dish["price"])  # like print_menu() before
+                     for dishes in mapper.get_products().values() for dish in dishes}
+            found = [item_id for item_id, (name, _) in avail.items() if name.lower().startswith("product 1")]
+            selection = {}
+            for item_id in [rnd.choice(found)] + [str(rnd.randint(1, n_products)) for _ in range(2)]:
+                selection[(*avail[item_id], item_id)] = rnd.randint(1, 3)
+            return selection
+
+        def session_shared(seed: int) -> dict:
+            rnd = random.Random(seed)
+            menu = ORDER_MGMT.shared_menu(mapper)
+            found = menu.search("product 1")
+            selection = {}
+            for item_id in [rnd.choice(found)] + [str(rnd.randint(1, n_products)) for _ in range(2)]:
+                ORDER_MGMT.select_item(selection, menu, item_id, rnd.randint(1, 3))
+            return selection
+
+        results = []
+        for variant, session in (("fetch per session", session_per_fetch), ("shared MenuIndex", session_shared)):
+            ORDER_MGMT.reset_menu()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                elapsed = _timed(lambda: list(executor.map(session, range(n_sessions))), repeat=1)
+            results.append((variant, elapsed, "{:.0f}".format(n_sessions / elapsed)))
+        ORDER_MGMT.reset_menu()
+    _print_results("{} order sessions, {} threads, {} products (seconds)".format(n_sessions, threads, n_products),
+                   ("variant", "time", "sessions/s"), results)
+
+
+def bench_kitchen(n_orders: int = 200000, n_open: int = 5000, screens: int = 8, n_changes: int = 50):
+    """Kitchen displays following a busy evening: thousands of open orders among a long history, every status change
+    followed by a refresh of all screens - whole queue without / with the partial index vs. changes since the last
+    refresh (s. kitchen_management.py).
+    """
+    import kitchen_management as KITCHEN_MGMT
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "kitchen.db3")
+        make_sample_db(db_path, n_orders=n_orders)
+        rnd = random.Random(4711)
+        conn = sqlite3.connect(db_path)
+        conn.execute("UPDATE orders SET status = ? WHERE id <= ?", (KITCHEN_MGMT.ORDER_SERVED, n_orders - n_open))
+        conn.execute("UPDATE orders SET status = status % ? WHERE id > ?", (KITCHEN_MGMT.ORDER_SERVED,
+                                                                           n_orders - n_open))
+        conn.commit()
+        conn.close()
+        db = create_proxy(db_path)
+        db.enable_change_log(KITCHEN_MGMT.KITCHEN_TABLES)
+
+        def evening(refresh) -> int:
+            orders_sent = 0
+            for _ in range(n_changes):
+                order_id = rnd.randint(n_orders - n_open + 1, n_orders)
+                KITCHEN_MGMT.set_status(db, order_id, rnd.randint(KITCHEN_MGMT.ORDER_NEW, KITCHEN_MGMT.ORDER_READY))
+                orders_sent += sum(refresh(screen) for screen in range(screens))
+            return orders_sent
+
+        def full_queue(screen: int) -> int:
+            return len(KITCHEN_MGMT.kitchen_queue(db)["orders"])
+
+        seqs = {}
+
+        def incremental(screen: int) -> int:
+            queue = KITCHEN_MGMT.kitchen_queue(db, seqs.get(screen))
+            seqs[screen] = queue["seq"]
+            return len(queue["orders"]) + len(queue["removed"])
+
+        results = []
+        db._execute_sql("DROP INDEX orders_open")
+        for variant, refresh in (("whole queue, no index", full_queue), ("whole queue, partial index", full_queue),
+                                 ("changes since last seq", incremental)):
+            if variant.endswith("partial index"):
+                db._execute_sql("CREATE INDEX orders_open ON orders (id) WHERE status < {}".format(
+                    KITCHEN_MGMT.ORDER_SERVED))
+            for screen in range(screens): # screens are up and running
+                refresh(screen)
+            sent = [0]
+            elapsed = _timed(lambda: sent.__setitem__(0, evening(refresh)), repeat=1)
+            results.append((variant, elapsed, "{:.2f}".format(elapsed / (n_changes * screens) * 1000),
+                            "{:.1f}".format(sent[0] / (n_changes * screens))))
+    _print_results("{} status changes, {} screens, {} open of {} orders (seconds)".format(n_changes, screens, n_open,
+                                                                                          n_orders),
+                   ("variant", "time", "ms/refresh", "orders/refresh"), results)
+
+
+def bench_overload(n_orders: int = 20000, overload: float = 2.0, seconds: float = 5.0, write_share: float = 0.1):
+    """Open-loop load test of an ASGI app answering from SQLite: requests arrive at 'overload' times the measured
+    capacity, 'write_share' of them order submissions. Without admission control the backlog - and every request's
+    latency - grows for as long as the rush lasts; with it (s. admission_control.py) the excess is rejected at once
+    and the admitted requests keep their latency, order submissions first.
+    """
+    import asyncio
+    import admission_control as ADMISSION
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = Path(tmp_dir, "overload.db3")
+        make_sample_db(db_path, n_orders=n_orders)
+        db = create_proxy(db_path)
+        sql = ANALYTIC_QUERIES["top 10 products"]
+
+        async def app(scope, receive, send):
+            await asyncio.to_thread(db.query, sql)
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        async def request(asgi_app, method: str, latencies: dict):
+            status = []
+
+            async def send(message):
+                status.append(message.get("status"))
+
+            start = time.perf_counter()
+            await asgi_app({"type": "http", "method": method, "path": "/menue", "headers": []}, None, send)
+            latencies.setdefault((method, status[0]), []).append(time.perf_counter() - start)
+
+        async def rush(asgi_app, rate: float) -> dict:
+            rnd = random.Random(4711)
+            latencies = {}
+            tasks = []
+            start = time.perf_counter()
+            for arrival in range(int(rate * seconds)):
+                await asyncio.sleep(max(0.0, start + arrival / rate - time.perf_counter()))
+                method = "POST" if rnd.random() < write_share else "GET"
+                tasks.append(asyncio.ensure_future(request(asgi_app, method, latencies)))
+            await asyncio.gather(*tasks)
+            return latencies
+
+        def percentile(values: list, fraction: float) -> float:
+            return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+        service_time = _timed(lambda: db.query(sql))
+        rate = overload / service_time
+        results = []
+        control = ADMISSION.AdmissionControl(app, {"reads": ADMISSION.RouteClass(4, 8),
+                                                   "writes": ADMISSION.RouteClass(4, 8, 1)}, total=4, max_wait=0.5)
+        for variant, asgi_app in (("unlimited", app), ("admission control", control)):
+            latencies = asyncio.run(rush(asgi_app, rate))
+            for method in ("GET", "POST"):
+                done = latencies.get((method, 200), [])
+                results.append(("{} {}".format(variant, method), percentile(done, 0.5), percentile(done, 0.99),
+                                str(len(done)), str(len(latencies.get((method, 503), [])))))
+    _print_results("{:.0f} requests/s for {} s, {:.1f}x capacity (latency in seconds)".format(rate, seconds, overload),
+                   ("variant", "p50", "p99", "ok", "503"), results)
+
+
+BENCHMARKS = {
+    "analytics": bench_analytics,
+    "import": bench_parallel_import,
+    "convert": bench_convert,
+    "receipts": bench_receipts,
+    "settlement": bench_settlement,
+    "sessions": bench_order_sessions,
+    "kitchen": bench_kitchen,
+    "overload": bench_overload
+}
+
+
+def run(names: list = None):
+    for name in names or BENCHMARKS.keys():
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: {} (available: {})".format(name, ", ".join(BENCHMARKS)))
+            continue
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,207 @@
+# ACASA Billing Management
+# Money is kept in integer minor units (cents) - columns declared as MONEY in products_db.sql - so sums are exact; it is
+# converted from text only at the edges (CSV import: to_cents()) and formatted only for output (format_cents()). Prices
+# are gross prices, the VAT they include is computed per receipt with integer arithmetic. The settlement of a period
+# computes all receipts at once with integer array operations (numpy) instead of a Python loop per receipt.
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import importlib.util
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+
+from db import SQLCode, SQLCodes, SQLiteInstance
+
+CENTS_PER_UNIT = 100
+BASIS_POINTS = 10000  # 100 % = 10000 bp, so that rates like 7.7 % stay integers
+
+_SETTLEMENT_SQL = """SELECT i.order_id, p.category_id, i.amount, p.price
+            FROM orders o, order_items i, products p
+            WHERE i.order_id = o.id AND i.item_id = p.id AND o.order_date BETWEEN ? AND ?"""
+
+# One-time migration of databases created before prices were kept in cents (products.price REAL)
+_MIGRATE_SQLS = [
+    """CREATE TABLE products_cents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        price MONEY,
+        category_id INTEGER,
+        FOREIGN KEY (category_id) REFERENCES categories(id)
+    )""",
+    """INSERT INTO products_cents (id, name, price, category_id)
+        SELECT id, name, CAST(ROUND(price * 100) AS INTEGER), category_id FROM products""",
+    "DROP TABLE products",
+    "ALTER TABLE products_cents RENAME TO products",
+    "DROP TABLE IF EXISTS daily_sales",
+    """CREATE TABLE daily_sales (
+        sales_day DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        category_id INTEGER,
+        quantity INTEGER NOT NULL DEFAULT 0,
+        revenue MONEY NOT NULL DEFAULT 0,
+        PRIMARY KEY (sales_day, product_id)
+    )"""
+]
+
+
+def to_cents(value) -> int:
+    """Exact conversion of a decimal amount - text like "4.99" or "4,99", int or float - to cents, rounded half up.
+
+    Raises:
+        ValueError: 'value' is not a number.
+    """
+    if isinstance(value, int):
+        return value * CENTS_PER_UNIT
+    text = str(value).strip()
+    units, _, fraction = text.partition(".")
+    if units.lstrip("-").isdigit() and len(fraction) <= 2 and (fraction.isdigit() or not fraction):
+        cents = abs(int(units)) * CENTS_PER_UNIT + int(fraction.ljust(2, "0"))  # fast path, e.g. "4.99" (CSV import)
+        return -cents if units.startswith("-") else cents
+    try:
+        amount = Decimal(text.replace(",", "."))
+    except InvalidOperation:
+        raise ValueError("not an amount of money: {}".format(value))
+    if not amount.is_finite():
+        raise ValueError("not an amount of money: {}".format(value))
+    return int((amount * CENTS_PER_UNIT).to_integral_value(ROUND_HALF_UP))
+
+
+def format_cents(cents: int, currency: str = None) -> str:
+    """E.g. 499 => "4.99", with currency "4.99 €".
+    """
+    sign = "-" if cents < 0 else ""
+    units, rest = divmod(abs(cents), CENTS_PER_UNIT)
+    text = "{}{}.{:02d}".format(sign, units, rest)
+    return "{} {}".format(text, currency) if currency else text
+
+
+def vat_basis_points(billing_config: dict) -> int:
+    """config.yaml 'billing.vat_percent' (e.g. 19 or 7.7) in basis points.
+    """
+    return int((Decimal(str(billing_config.get("vat_percent", 0))) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def included_vat(gross_cents: int, vat_bp: int) -> int:
+    """VAT contained in a gross amount, rounded half up to whole cents: gross * rate / (100 % + rate).
+    """
+    divisor = BASIS_POINTS + vat_bp
+    return (2 * gross_cents * vat_bp + divisor) // (2 * divisor)
+
+
+def receipt_totals(items: list, vat_bp: int = 0) -> dict:
+    """Totals of one receipt; items like [("Pizza Margarita", 499, 2)] (name, price in cents, amount).
+    """
+    gross = sum(price * amount for _, price, amount in items)
+    vat = included_vat(gross, vat_bp)
+    return {"gross": gross, "vat": vat, "net": gross - vat}
+
+
+def settlement(db: SQLiteInstance, from_day: str, to_day: str, vat_bp: int = 0) -> dict:
+    """End-of-day (or any period) settlement over all orders, computed as integer array operations: line amounts,
+    per-order totals and the VAT of every receipt (rounded per receipt, like printed), per-category subtotals.
+
+    Returns:
+        dict: All amounts in cents, e.g. {"from": "2023-02-24", "to": "2023-02-24", "orders": 2, "items": 5,
+              "gross": 2495, "vat": 398, "net": 2097, "categories": {2000: {"items": 5, "gross": 2495}}}
+    """
+    import numpy as np  # only needed here
+    rows = db.query(_SETTLEMENT_SQL, (from_day, to_day))
+    if isinstance(rows, Exception):
+        raise rows
+    result = {"from": from_day, "to": to_day, "orders": 0, "items": 0, "gross": 0, "vat": 0, "net": 0,
+              "categories": {}}
+    if not rows:
+        return result
+    order_ids, category_ids, amounts, prices = np.array(rows, dtype=np.int64).T
+    lines = amounts * prices
+    order_keys, order_pos = np.unique(order_ids, return_inverse=True)
+    order_gross = np.zeros(len(order_keys), dtype=np.int64)
+    np.add.at(order_gross, order_pos, lines)
+    divisor = BASIS_POINTS + vat_bp
+    order_vat = (2 * order_gross * vat_bp + divisor) // (2 * divisor)  # included_vat() for all receipts
+    category_keys, category_pos = np.unique(category_ids, return_inverse=True)
+    category_gross = np.zeros(len(category_keys), dtype=np.int64)
+    category_items = np.zeros(len(category_keys), dtype=np.int64)
+    np.add.at(category_gross, category_pos, lines)
+    np.add.at(category_items, category_pos, amounts)
+    result.update({"orders": len(order_keys), "items": int(amounts.sum()), "gross": int(order_gross.sum()),
+                   "vat": int(order_vat.sum())})
+    result["net"] = result["gross"] - result["vat"]
+    result["categories"] = {int(category_id): {"items": int(items), "gross": int(gross)}
+                            for category_id, items, gross in zip(category_keys, category_items, category_gross)}
+    return result
+
+
+def needs_migration(db: SQLiteInstance) -> bool:
+    price_types = [col_type for name, col_type, _, _ in db.table_columns("products") if name == "price"]
+    return bool(price_types) and price_types[0].name != "MONEY"
+
+
+def migrate_to_cents(db: SQLiteInstance) -> SQLCode:
+    """Convert 'products.price' to cents (type MONEY) and recreate 'daily_sales' - rebuild the aggregates afterwards,
+    s. report_management.rebuild_daily_sales(). Nothing happens for databases already in cents.
+    """
+    if not needs_migration(db):
+        return SQLCodes.SUCCESS
+    return db._execute_sql_list(_MIGRATE_SQLS)
+
+
+class UnitTestBilling(unittest.TestCase):
+
+    def test_cents(self):
+        self.assertEqual([to_cents(value) for value in ("4.99", " 0,1", "1.005", "-2.50", 3, 0.29)],
+                         [499, 10, 101, -250, 300, 29])
+        with self.assertRaises(ValueError):
+            to_cents("abc")
+        self.assertEqual([format_cents(cents) for cents in (499, 5, -1050)], ["4.99", "0.05", "-10.50"])
+        self.assertEqual(format_cents(1000, "€"), "10.00 €")
+
+    def test_vat(self):
+        self.assertEqual(vat_basis_points({"vat_percent": 7.7}), 770)
+        self.assertEqual(receipt_totals([("Pizza Margarita", 499, 2), ("Wasser", 199, 1)], 1900),
+                         {"gross": 1197, "vat": 191, "net": 1006})
+
+    def _db(self, tmp_dir: str) -> SQLiteInstance:
+        db_path = Path(tmp_dir, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT);
+                CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, price REAL,
+                    category_id INTEGER);
+                CREATE TABLE orders (id INTEGER PRIMARY KEY, customer TEXT, status INTEGER, order_date DATE);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    PRIMARY KEY (order_id, item_id));
+                INSERT INTO products VALUES (1001, 'Wasser', 1.99, 1000), (2001, 'Pizza Margarita', 4.99, 2000);
+                INSERT INTO orders VALUES (1, 'Joe', 0, '2023-02-24'), (2, 'Ann', 0, '2023-02-24'),
+                    (3, 'Bob', 0, '2023-02-25');
+                INSERT INTO order_items VALUES (1, 2001, 2), (1, 1001, 1), (2, 2001, 1), (3, 2001, 5);
+            """)
+        conn.close()
+        return SQLiteInstance(db_path)
+
+    def test_migration(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = self._db(tmp_dir)
+            self.assertTrue(needs_migration(db))
+            self.assertIs(migrate_to_cents(db), SQLCodes.SUCCESS)
+            self.assertIs(migrate_to_cents(db), SQLCodes.SUCCESS)  # no-op
+            self.assertEqual(db.query("SELECT id, price, typeof(price) FROM products ORDER BY id"),
+                             [(1001, 199, "integer"), (2001, 499, "integer")])
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy not installed")
+    def test_settlement(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = self._db(tmp_dir)
+            migrate_to_cents(db)
+            result = settlement(db, "2023-02-24", "2023-02-24", 1900)
+            # per receipt: 1197 (VAT 191) and 499 (VAT 80)
+            self.assertEqual({key: result[key] for key in ("orders", "items", "gross", "vat", "net")},
+                             {"orders": 2, "items": 4, "gross": 1696, "vat": 271, "net": 1425})
+            self.assertEqual(result["categories"],
+                             {1000: {"items": 1, "gross": 199}, 2000: {"items": 3, "gross": 1497}})
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
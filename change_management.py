@@ -0,0 +1,285 @@
+# ACASA Change Management
+# Consumers of the change log (change data capture, s. SQLiteInstance.enable_change_log() in db.py): cache invalidation,
+# aggregate maintenance, exports etc. learn about committed changes without re-querying the data tables. Every consumer
+# has a name and a saved offset (the last 'seq' it has processed) and tails the log from there; a handler that fails
+# leaves the offset unchanged, so every change is delivered at least once.
+from pathlib import Path
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from db import DataObject, DbAccessException, SQLCode, SQLCodes, SQLiteInstance
+
+OFFSETS_TABLE = "change_log_offsets"
+DEFAULT_POLL_INTERVAL = 1.0  # seconds
+
+_OFFSETS_DDL = """CREATE TABLE IF NOT EXISTS change_log_offsets (
+    consumer TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL DEFAULT 0
+)"""
+
+_OFFSET_SQL = "SELECT seq FROM change_log_offsets WHERE consumer = ?"
+
+_PRUNE_SQL = "DELETE FROM change_log WHERE seq <= (SELECT MIN(seq) FROM change_log_offsets)"
+
+
+class ChangeConsumer():
+    """Reads the change log from its saved offset.
+    Args:
+        db (SQLiteInstance): Database with the change log enabled.
+        name (str): Identifies the consumer (and its offset) across restarts, e.g. "export".
+        tables (list, optional): Only changes of these tables; default: all observed tables.
+    """
+
+    def __init__(self, db: SQLiteInstance, name: str, tables: list = None):
+        self._db = db
+        self.name = name
+        self._tables = tables
+        db._execute_sql(_OFFSETS_DDL)
+        res = db.query(_OFFSET_SQL, (name,))
+        self.offset = res[0][0] if isinstance(res, list) and res else 0
+
+    def poll(self, limit: int = 1000) -> list:
+        """Next changes after the offset (s. SQLiteInstance.changes()); the offset is not moved.
+        """
+        return self._db.changes(self.offset, limit, self._tables)
+
+    def commit(self, seq: int) -> SQLCode:
+        """Save 'seq' as processed: the next poll() - also after a restart - starts behind it.
+        """
+        res_code = self._db.upsert_many(OFFSETS_TABLE, ["consumer", "seq"], [(self.name, seq)], ("consumer",))
+        if res_code is SQLCodes.SUCCESS:
+            self.offset = seq
+        return res_code
+
+    def process(self, handler, limit: int = 1000) -> int:
+        """Hand the next changes to 'handler' (called with the list of changes) and commit them if it returns
+        normally.
+
+        Returns:
+            int: Number of changes processed, 0 if there were none.
+        """
+        changes = self.poll(limit)
+        if changes:
+            handler(changes)
+            self.commit(changes[-1]["seq"])
+        return len(changes)
+
+    def tail(self, handler, stop_event: threading.Event = None, poll_interval: float = DEFAULT_POLL_INTERVAL,
+             limit: int = 1000):
+        """Process changes until 'stop_event' is set; waits 'poll_interval' seconds whenever the log is exhausted.
+        """
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            if self.process(handler, limit) < limit:
+                stop_event.wait(poll_interval)
+
+
+# Live notifications (s. event_broker.py): what connected clients are told about
+CATALOGUE_TABLES = ["categories", "products", "product_images"]
+CATALOGUE_TOPIC = "catalogue"
+ORDER_TOPIC = "order/{}"
+
+
+class ChangeFeed():
+    """Turns the change log into events for the clients connected to this process: one "catalogue" event per batch
+    of catalogue changes and an "order/<id>" event per status transition of an order. Unlike a ChangeConsumer it saves
+    no offset - it starts at the end of the log, clients load the current state when they connect.
+    Args:
+        db (SQLiteInstance): Database with the change log enabled for the catalogue tables and 'orders'.
+        poll_interval (float, optional): Seconds between reads of the log while it is exhausted.
+    """
+
+    def __init__(self, db: SQLiteInstance, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        self._db = db
+        self.poll_interval = poll_interval
+        self.offset = last_change(db, CATALOGUE_TABLES + ["orders"])
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def poll(self, limit: int = 1000) -> list:
+        """Events of the changes after the offset, in log order, e.g. [(17, "catalogue", {"version": 17}),
+        (18, "order/5", {"order": 5, "status": 1})] (status None: the order was deleted); moves the offset.
+        """
+        changes = self._db.changes(self.offset, limit, CATALOGUE_TABLES + ["orders"])
+        if not changes:
+            return []
+        self.offset = changes[-1]["seq"]
+        events = []
+        catalogue = [change["seq"] for change in changes if change["table"] in CATALOGUE_TABLES]
+        if catalogue: # the version of the page caches, s. last_change()
+            events.append((catalogue[-1], CATALOGUE_TOPIC, {"version": catalogue[-1]}))
+        transitions = {change["key"]["id"]: change["seq"] for change in changes # latest change per order
+                       if change["table"] == "orders" and (change["operation"] == "delete" or "status" in
+                                                           change["columns"])}
+        if transitions:
+            res = self._db.query("SELECT id, status FROM orders WHERE id IN ({})".format(
+                ",".join(["?"] * len(transitions))), tuple(transitions))
+            statuses = dict(res) if isinstance(res, list) else {}
+            events.extend((seq, ORDER_TOPIC.format(order_id), {"order": order_id, "status": statuses.get(order_id)})
+                          for order_id, seq in transitions.items())
+        return sorted(events, key=lambda event: event[0])
+
+    def start(self, publish):
+        """Call 'publish(seq, topic, data)' for every event from a thread of its own, until stop().
+        """
+        def run():
+            while not self._stop_event.is_set():
+                try:
+                    events = self.poll()
+                except DbAccessException as e: # e.g. locked; try again later
+                    print("Change feed:", e)
+                    events = []
+                for event in events:
+                    publish(*event)
+                if not events:
+                    self._stop_event.wait(self.poll_interval)
+        self._thread = threading.Thread(target=run, name="change-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def offsets(db: SQLiteInstance) -> dict:
+    db._execute_sql(_OFFSETS_DDL)
+    return dict(db.query("SELECT consumer, seq FROM change_log_offsets ORDER BY consumer"))
+
+
+def last_change(db: SQLiteInstance, tables: list) -> int:
+    """'seq' of the latest recorded change of 'tables' (0: none), e.g. as version of cached data derived from them.
+    """
+    res = db.query("SELECT MAX(seq) FROM change_log WHERE table_name IN ({})".format(",".join(["?"] * len(tables))),
+                   tuple(tables))
+    return res[0][0] or 0 if isinstance(res, list) else 0
+
+
+def prune_change_log(db: SQLiteInstance) -> SQLCode:
+    """Delete the changes that every known consumer has processed; nothing is deleted as long as there is no consumer.
+    """
+    db._execute_sql(_OFFSETS_DDL)
+    return db._execute_sql(_PRUNE_SQL)
+
+
+class UnitTestChangeLog(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL, price REAL);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    PRIMARY KEY (order_id, item_id));
+            """)
+        conn.close()
+        self.db = SQLiteInstance(db_path)
+        self.assertIs(self.db.enable_change_log(["products", "order_items", "not_yet_created"]), SQLCodes.SUCCESS)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _product(self, price: float) -> DataObject:
+        return DataObject("products", {"id": 2001, "name": "Pizza Margarita", "price": price}, {"id"})
+
+    def test_changes_recorded(self):
+        self.db.insert(self._product(4.99))
+        self.assertEqual(self.db.update(self._product(5.49)), 1)
+        self.db.update(self._product(5.49))  # no value changed: not recorded
+        self.db.upsert_many("order_items", ["order_id", "item_id", "amount"], [(1, 2001, 2)], ("order_id", "item_id"))
+        self.assertIsInstance(self.db._execute_sql_list(["DELETE FROM products", "INSERT INTO nowhere VALUES (1)"]),
+                              SQLCode)  # rolled back: not recorded
+        self.assertEqual(self.db.delete(self._product(5.49)), 1)
+        changes = self.db.changes()
+        self.assertEqual([(change["table"], change["operation"], change["key"], change["columns"])
+                          for change in changes],
+                         [("products", "insert", {"id": 2001}, ["id", "name", "price"]),
+                          ("products", "update", {"id": 2001}, ["price"]),
+                          ("order_items", "insert", {"order_id": 1, "item_id": 2001},
+                           ["order_id", "item_id", "amount"]),
+                          ("products", "delete", {"id": 2001}, [])])
+        self.assertEqual([change["seq"] for change in changes], sorted(change["seq"] for change in changes))
+        self.assertEqual(last_change(self.db, ["products"]), changes[-1]["seq"])
+        self.assertEqual(last_change(self.db, ["order_items"]), changes[-2]["seq"])
+        self.assertEqual(last_change(self.db, ["categories"]), 0)
+
+    def test_enable_idempotent(self):
+        schema_version = self.db.query("PRAGMA schema_version")
+        self.assertIs(self.db.enable_change_log(["products", "order_items"]), SQLCodes.SUCCESS)
+        self.assertEqual(self.db.query("PRAGMA schema_version"), schema_version)  # no DDL executed
+        # added column: the triggers are replaced
+        self.db._execute_sql("ALTER TABLE products ADD COLUMN category TEXT")
+        self.assertIs(self.db.enable_change_log(["products", "order_items"]), SQLCodes.SUCCESS)
+        self.db.insert(DataObject("products", {"id": 2001, "name": "Pizza Margarita", "price": 4.99,
+                                               "category": "Pizza"}, {"id"}))
+        self.assertEqual(self.db.changes()[-1]["columns"], ["id", "name", "price", "category"])
+        plan = self.db.query("EXPLAIN QUERY PLAN SELECT MAX(seq) FROM change_log WHERE table_name IN (?)",
+                             ("products",))
+        self.assertIn("change_log_table_seq", " ".join(str(step[-1]) for step in plan))
+
+    def test_failed_ddl_rolled_back(self):
+        triggers = "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'products' ORDER BY name"
+        before = self.db.query(triggers)
+        self.assertEqual(len(before), 3)
+        res = self.db._execute_sql_list(["DROP TRIGGER products_change_log_insert",
+                                         "CREATE TRIGGER products_change_log_insert AFTER INSERT ON nowhere BEGIN "
+                                         "SELECT 1; END"])
+        self.assertIsInstance(res, SQLCode)
+        self.assertEqual(self.db.query(triggers), before)  # the DROP was rolled back, too
+        self.db.insert(self._product(4.99))
+        self.assertEqual([change["operation"] for change in self.db.changes()], ["insert"])
+
+    def test_consumer_offsets(self):
+        self.db.insert(self._product(4.99))
+        self.db.update(self._product(5.49))
+        received = []
+
+        def failing_handler(changes: list):
+            raise RuntimeError("handler failed")
+
+        consumer = ChangeConsumer(self.db, "test", tables=["products"])
+        self.assertEqual(consumer.process(received.extend, limit=1), 1)
+        with self.assertRaises(RuntimeError):
+            consumer.process(failing_handler)
+        # a new instance (restart) continues behind the committed change only
+        self.assertEqual(ChangeConsumer(self.db, "test").process(received.extend), 1)
+        self.assertEqual([change["operation"] for change in received], ["insert", "update"])
+        self.assertIs(prune_change_log(self.db), SQLCodes.SUCCESS)
+        self.assertEqual(self.db.changes(), [])
+        self.assertEqual(offsets(self.db), {"test": received[-1]["seq"]})
+
+    def test_feed(self):
+        self.db._execute_sql("CREATE TABLE orders (id INTEGER PRIMARY KEY, customer TEXT, status INTEGER)")
+        self.db.enable_change_log(["orders"])
+        self.db.insert(self._product(4.99)) # before the feed: not sent
+        feed = ChangeFeed(self.db)
+        self.assertEqual(feed.poll(), [])
+        self.db.update(self._product(5.49))
+        self.db.insert(DataObject("orders", {"id": 5, "customer": "Joe", "status": 0}, {"id"}))
+        self.db.update(DataObject("orders", {"id": 5, "customer": "Joe Doe", "status": 0}, {"id"})) # no transition
+        self.db.update(self._product(5.99))
+        self.db.update(DataObject("orders", {"id": 5, "customer": "Joe Doe", "status": 1}, {"id"}))
+        seqs = [change["seq"] for change in self.db.changes(feed.offset)]
+        self.assertEqual(feed.poll(), [(seqs[3], CATALOGUE_TOPIC, {"version": seqs[3]}),
+                                       (seqs[4], "order/5", {"order": 5, "status": 1})])
+        self.assertEqual(feed.poll(), [])
+        published = []
+        feed.poll_interval = 0.01
+        feed.start(lambda *event: published.append(event))
+        self.db.delete(DataObject("orders", {"id": 5}, {"id"}))
+        for _ in range(100):
+            if published:
+                break
+            time.sleep(0.01)
+        feed.stop()
+        self.assertEqual([event[1:] for event in published], [("order/5", {"order": 5, "status": None})])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
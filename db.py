@@ -2,13 +2,17 @@
 from abc import *
 from collections import namedtuple
 import copy
+from decimal import Decimal
 from enum import Enum
+import json
 from pathlib import Path
 from inspect import *
 import sqlite3
 from typing import Any
 import unittest
 
+import metrics as METRICS
+
 
 class SQLCode():
     """_summary_
@@ -34,12 +38,36 @@ class SQLCodes():
     WARN = SQLCode("General Warning!")
 
 
+class WriteOperations():
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+    UPSERT = "upsert"
+
+
 class ColumnTypes(Enum):  # At a first shot, these are SQLite data types ONLY..
     INTEGER = int
     REAL = float
     TEXT = str
     BLOB = object
     UNKNOWN = None
+    MONEY = Decimal  # declared as MONEY, stored as INTEGER cents, s. billing_management.py
+
+    # SQLite's type affinity rules (in this order) applied to a declared column type, e.g. "VARCHAR(20)" => TEXT
+    @classmethod
+    def of_declared_type(cls, declared_type: str):
+        declared_type = (declared_type or "").upper()
+        if declared_type == "MONEY":
+            return cls.MONEY
+        if "INT" in declared_type:
+            return cls.INTEGER
+        if any(text_type in declared_type for text_type in ("CHAR", "CLOB", "TEXT")):
+            return cls.TEXT
+        if not declared_type or "BLOB" in declared_type:
+            return cls.BLOB
+        if any(real_type in declared_type for real_type in ("REAL", "FLOA", "DOUB")):
+            return cls.REAL
+        return cls.UNKNOWN  # NUMERIC affinity (e.g. DATE): values are passed as they are
 
 
 class ImproperUsageException(RuntimeError):
@@ -161,6 +189,32 @@ class DataObject():
         return {**self._columns, **self._primary_keys}
                 
                 
+class WriteListener(ABC):
+    """Callback for writes going through a SQLiteInstance. It is invoked with the cursor of the writing transaction, so
+    everything the listener writes (e.g. aggregates) is committed - or rolled back - together with the data itself.
+    """
+
+    @abstractmethod
+    def on_write(self, cursor, operation: str, data_object: DataObject):
+        raise MissingImplementationError(
+            "Implementation of WriteListener ist missing required override: def on_write()")
+
+
+# Change data capture (CDC), s. SQLiteInstance.enable_change_log(): triggers append every committed change of the
+# observed tables to this table. SQLite has one writer at a time, so 'seq' order is commit order.
+CHANGE_LOG_TABLE = "change_log"
+_CHANGE_LOG_DDL = """CREATE TABLE IF NOT EXISTS change_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    table_name TEXT NOT NULL,
+    operation TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    changed_columns TEXT NOT NULL,
+    changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+)"""
+# latest change of some tables (s. change_management.last_change()) without scanning the log
+_CHANGE_LOG_INDEX_DDL = "CREATE INDEX IF NOT EXISTS change_log_table_seq ON change_log (table_name, seq)"
+
+
 class _ObjectStore(ABC):
 
     @abstractmethod
@@ -198,6 +252,7 @@ class SQLiteInstance(_ObjectStore):
 
     def __init__(self, db_file_path: Path):
         self._db_file_path = db_file_path
+        self._write_listeners = []
 
         # Check if DB is available..
         conn = None
@@ -210,7 +265,16 @@ class SQLiteInstance(_ObjectStore):
                 conn.close()
                 del conn
 
+    def add_write_listener(self, listener: WriteListener):
+        self._write_listeners.append(listener)
+
+    # Listeners run inside the caller's transaction; a DatabaseError raised here aborts the whole write.
+    def _notify_listeners(self, cur, operation: str, data_object: DataObject):
+        for listener in self._write_listeners:
+            listener.on_write(cur, operation, data_object)
+
     # Execute raw SQL string; client responsibility for correctness!
+    @METRICS.timed("sqlite", "execute")
     def _execute_sql(self, raw_sql: str) -> SQLCode:
         conn = sqlite3.connect(self._db_file_path)
         with self._TransactionalDbAccessor(conn) as cur:
@@ -220,27 +284,79 @@ class SQLiteInstance(_ObjectStore):
             except sqlite3.DatabaseError as sql_ex:
                 return SQLCode(sql_ex)
 
-    def create(self, data_object: DataObject):
-        all_col_dict = data_object.merge_columns()
+    # Execute several raw SQL strings in ONE transaction: either all of them are committed or none. The explicit
+    # BEGIN covers DDL, too - sqlite3 (legacy transaction control) only opens a transaction before DML by itself.
+    @METRICS.timed("sqlite", "execute")
+    def _execute_sql_list(self, raw_sqls: list) -> SQLCode:
+        conn = sqlite3.connect(self._db_file_path)
+        with self._TransactionalDbAccessor(conn) as cur:
+            try:
+                cur.execute("BEGIN")
+                for raw_sql in raw_sqls:
+                    cur.execute(raw_sql)
+                return SQLCodes.SUCCESS
+            except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
+                return SQLCode(sql_ex)
+
+    # Key columns set to None are left out, so SQLite assigns them (AUTOINCREMENT)
+    def _insert_row(self, cur, data_object: DataObject):
+        all_col_dict = {col: val for col, val in data_object.merge_columns().items() if val is not None}
         _res_sql = "INSERT INTO {} (".format(data_object.table_name())
         _res_sql += ",".join(all_col_dict.keys())
         _res_sql += ") VALUES ("
-        _res_sql += ",".join(['\'{}\''.format(val)  # simple string conversion
-                             for val in all_col_dict.values()])
+        _res_sql += ",".join(["?"] * len(all_col_dict))
         _res_sql += ");"
+        cur.execute(_res_sql, tuple(all_col_dict.values()))
+        pk = cur.lastrowid 
+        # Imagine: You put 0 as key in your object, but 1001 is returned as answer from the database! 
+        key_col_dict = data_object.key_columns()
+        for key_col in key_col_dict:
+            if key_col_dict[key_col] is None:
+                key_col_dict[key_col] = pk
+        self._notify_listeners(cur, WriteOperations.INSERT, data_object)
+
+    @METRICS.timed("sqlite", "create")
+    def create(self, data_object: DataObject):
         conn = sqlite3.connect(self._db_file_path)
         with self._TransactionalDbAccessor(conn) as cur:
             try:
-                cur.execute(_res_sql)
-                pk = cur.lastrowid 
-                # Imagine: You put 0 as key in your object, but 1001 is returned as answer from the database! 
-                key_col_dict = data_object.key_columns()
-                for key_col in key_col_dict:
-                    key_col_dict[key_col] = pk
+                self._insert_row(cur, data_object)
                 #return data_object not necessary
             except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
+                return SQLCode(sql_ex)
+
+    # Inserts 'master' and its 'details' in ONE transaction (e.g. an order with its items), so readers (exports,
+    # kitchen display) never see the master without its details; the key of 'master' is set into the column
+    # 'foreign_key' of every detail. Returns the key of 'master' or an SQLCode on error (nothing is written then).
+    @METRICS.timed("sqlite", "create")
+    def insert_with_details(self, master: DataObject, details: list, foreign_key: str):
+        conn = sqlite3.connect(self._db_file_path)
+        with self._TransactionalDbAccessor(conn) as cur:
+            try:
+                self._insert_row(cur, master)
+                master_key = next(iter(master.key_columns().values()))
+                for detail in details:
+                    detail_cols = detail.key_columns() if foreign_key in detail.key_columns() else detail.columns()
+                    detail_cols[foreign_key] = master_key
+                    self._insert_row(cur, detail)
+                return master_key
+            except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
                 return SQLCode(sql_ex)
 
+    # 'Facade' method: like create(), but returns the primary key (a dict for compound keys) or an SQLCode on error.
+    def insert(self, data_object: DataObject):
+        res = self.create(data_object)
+        if isinstance(res, SQLCode):
+            return res
+        key_col_dict = data_object.key_columns()
+        if len(key_col_dict) == 1:
+            return next(iter(key_col_dict.values()))
+        return key_col_dict
+
+    @METRICS.timed("sqlite", "read")
     def read(self, data_object: DataObject):
         col_value_dict = data_object.columns()
         key_col_dict = data_object.key_columns()
@@ -271,35 +387,68 @@ class SQLiteInstance(_ObjectStore):
             except sqlite3.DatabaseError as sql_ex:
                 return SQLCode(sql_ex)
 
+    # Returns the number of updated rows (0: no row with this key) or an SQLCode on error.
+    @METRICS.timed("sqlite", "update")
     def update(self, data_object: DataObject):
-        _res_sql = "UPDATE {}".format(self._entity_name)
-        _res_sql += " SET "
-        for col_item in self._columns:
-            _res_sql += col_item[0] + "=" + col_item[1]
-        _res_sql + " WHERE "
-        for prim_key in self._primary_keys:
-            _res_sql += prim_key + "=" + self._primary_keys[prim_key]
+        col_dict = data_object.columns()
+        key_col_dict = data_object.key_columns()
+        _res_sql = "UPDATE {} SET ".format(data_object.table_name())
+        _res_sql += ",".join(col_name + "=?" for col_name in col_dict)
+        _res_sql += " WHERE " + " AND ".join(key_col + "=?" for key_col in key_col_dict)
         conn = sqlite3.connect(self._db_file_path)
         with self._TransactionalDbAccessor(conn) as cur:
             try:
-                res = cur.execute(_res_sql)
-                return cur.lastrowid
+                cur.execute(_res_sql, tuple(col_dict.values()) + tuple(key_col_dict.values()))
+                row_count = cur.rowcount
+                self._notify_listeners(cur, WriteOperations.UPDATE, data_object)
+                return row_count
             except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
                 return SQLCode(sql_ex)
 
+    # Deletes by the key columns of 'data_object'; returns the number of deleted rows or an SQLCode on error.
+    @METRICS.timed("sqlite", "delete")
     def delete(self, data_object: DataObject):
-        _res_sql = "DELETE FROM {}".format(self._entity_name)
-        _res_sql += " WHERE "
+        key_col_dict = data_object.key_columns()
+        _res_sql = "DELETE FROM {}".format(data_object.table_name())
+        _res_sql += " WHERE " + " AND ".join(key_col + "=?" for key_col in key_col_dict)
         conn = sqlite3.connect(self._db_file_path)
         with self._TransactionalDbAccessor(conn) as cur:
             try:
-                res = cur.execute(_res_sql)
-                return cur.lastrowid
+                cur.execute(_res_sql, tuple(key_col_dict.values()))
+                row_count = cur.rowcount
+                self._notify_listeners(cur, WriteOperations.DELETE, data_object)
+                return row_count
             except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
                 return SQLCode(sql_ex)
 
     # 'Facade' method: Creates SQL 'INSERT .. ON CONFLICT (..) DO UPDATE"
     def upsert(self, table: str, data_set: dict, key_field: str = "ID") -> SQLCode:
+        return self._execute_sql(self._upsert_sql(table, data_set, key_field))
+
+    # Like 'upsert' for many data sets, all written in ONE transaction (all or nothing).
+    def upsert_batch(self, table: str, data_sets: list, key_field: str = "ID") -> SQLCode:
+        return self._execute_sql_list([self._upsert_sql(table, data_set, key_field) for data_set in data_sets])
+
+    # Upsert typed rows (tuples in the order of 'columns') with bound parameters, all in ONE transaction.
+    @METRICS.timed("sqlite", "upsert")
+    def upsert_many(self, table: str, columns: list, rows: list, key_fields: tuple = ("id",)) -> SQLCode:
+        columns = [str(column).lower() for column in columns]
+        updates = [column + "=excluded." + column for column in columns if column not in key_fields]
+        _res_sql = "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) ".format(
+            table, ",".join(columns), ",".join(["?"] * len(columns)), ",".join(key_fields))
+        _res_sql += "DO UPDATE SET " + ",".join(updates) if updates else "DO NOTHING"
+        conn = sqlite3.connect(self._db_file_path)
+        with self._TransactionalDbAccessor(conn) as cur:
+            try:
+                cur.executemany(_res_sql, rows)
+                return SQLCodes.SUCCESS
+            except sqlite3.DatabaseError as sql_ex:
+                conn.rollback()
+                return SQLCode(sql_ex)
+
+    def _upsert_sql(self, table: str, data_set: dict, key_field: str = "ID") -> str:
         keys = []
         values = []
         for attr_key in data_set:  # remember keys and values seperately for later
@@ -321,21 +470,128 @@ class SQLiteInstance(_ObjectStore):
                     sql += ","
             cnt += 1
         sql += ";"
-        return self._execute_sql(sql)
+        return sql
 
     # Similar to 'execute', the client is responsible for proper SQL!
     # Invoke 'fetchall' on result from cursor and return rows.
-    def query(self, sql_query) -> list:
+    @METRICS.timed("sqlite", "query")
+    def query(self, sql_query, params: tuple = ()) -> list:
         conn = sqlite3.connect(self._db_file_path)
         res = None
         with self._TransactionalDbAccessor(conn) as cur:
             try:
-                _temp_res = cur.execute(sql_query)
+                _temp_res = cur.execute(sql_query, params)
                 res = _temp_res.fetchall()
             except sqlite3.DatabaseError as ex:
                 res = ex
         return res
 
+    # Like 'query', but yields the rows in lists of at most 'chunk_size' rows, so that large results (exports) never
+    # have to be held in memory at once; errors are raised, not returned.
+    def query_chunks(self, sql_query, params: tuple = (), chunk_size: int = 10000):
+        conn = sqlite3.connect(self._db_file_path)
+        with self._TransactionalDbAccessor(conn) as cur:
+            cur.execute(sql_query, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def enable_change_log(self, tables: list) -> SQLCode:
+        """Record inserts, updates (of at least one column value) and deletes of 'tables' in the change log, whichever
+        way they are written (CRUD methods, upserts, raw SQL). The triggers write in the transaction of the change, so
+        rolled back changes are never recorded. Tables that do not exist (yet) are skipped; call again after schema
+        creation. Idempotent: only missing triggers are created and only outdated ones (e.g. after columns were added)
+        are replaced, so nothing is executed if the change log is up to date.
+        """
+        res = self.query("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'index', 'trigger')")
+        if isinstance(res, Exception):
+            return SQLCode(res)
+        existing = dict(res)
+        sqls = []
+        if CHANGE_LOG_TABLE not in existing:
+            sqls.append(_CHANGE_LOG_DDL)
+        if "change_log_table_seq" not in existing:
+            sqls.append(_CHANGE_LOG_INDEX_DDL)
+        for table in tables:
+            try:
+                trigger_sqls = self._change_log_trigger_sqls(table)
+            except InvalidMappingException:
+                continue
+            for trigger, create_sql in trigger_sqls:
+                if existing.get(trigger) == create_sql:
+                    continue
+                if trigger in existing:
+                    sqls.append("DROP TRIGGER IF EXISTS {}".format(trigger))
+                sqls.append(create_sql.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1))
+        return self._execute_sql_list(sqls) if sqls else SQLCodes.SUCCESS
+
+    def disable_change_log(self, tables: list) -> SQLCode:
+        return self._execute_sql_list(["DROP TRIGGER IF EXISTS {}_{}_{}".format(table, CHANGE_LOG_TABLE, operation)
+                                       for table in tables
+                                       for operation in (WriteOperations.INSERT, WriteOperations.UPDATE,
+                                                         WriteOperations.DELETE)])
+
+    def _change_log_trigger_sqls(self, table: str) -> list:
+        table_columns = self.table_columns(table)
+        col_names = [name for name, _, _, _ in table_columns]
+        key_names = [name for name, _, _, pk_pos in sorted(table_columns, key=lambda col: col[3]) if pk_pos]
+        key_names = key_names or ["rowid"]
+
+        def row_key(row: str) -> str:
+            return "json_object({})".format(",".join("'{}', {}.{}".format(key, row, key) for key in key_names))
+
+        differs = ["OLD.{} IS NOT NEW.{}".format(name, name) for name in col_names]
+        changed = {
+            WriteOperations.INSERT: "json_array({})".format(",".join("'{}'".format(name) for name in col_names)),
+            WriteOperations.UPDATE: "(SELECT json_group_array(name) FROM ({}))".format(" UNION ALL ".join(
+                "SELECT '{}' AS name WHERE {}".format(name, diff) for name, diff in zip(col_names, differs))),
+            WriteOperations.DELETE: "json_array()"
+        }
+        sqls = []
+        for operation, row, condition in ((WriteOperations.INSERT, "NEW", ""),
+                                          (WriteOperations.UPDATE, "NEW", " WHEN " + " OR ".join(differs)),
+                                          (WriteOperations.DELETE, "OLD", "")):
+            trigger = "{}_{}_{}".format(table, CHANGE_LOG_TABLE, operation)
+            # as stored in sqlite_master, s. enable_change_log()
+            sqls.append((trigger, """CREATE TRIGGER {} AFTER {} ON {}{} BEGIN
+                INSERT INTO {} (table_name, operation, row_key, changed_columns) VALUES ('{}', '{}', {}, {});
+                END""".format(trigger, operation.upper(), table, condition, CHANGE_LOG_TABLE, table, operation,
+                              row_key(row), changed[operation])))
+        return sqls
+
+    def changes(self, after_seq: int = 0, limit: int = 1000, tables: list = None) -> list:
+        """Changes recorded after 'after_seq' in commit order, e.g. {"seq": 17, "table": "products", "operation":
+        "update", "key": {"id": 2001}, "columns": ["price"], "changed_at": "2023-02-24T18:00:00.123"}.
+        """
+        _res_sql = "SELECT seq, table_name, operation, row_key, changed_columns, changed_at"
+        _res_sql += " FROM {} WHERE seq > ?".format(CHANGE_LOG_TABLE)
+        params = (after_seq,)
+        if tables:
+            _res_sql += " AND table_name IN ({})".format(",".join(["?"] * len(tables)))
+            params += tuple(tables)
+        _res_sql += " ORDER BY seq LIMIT ?"
+        res = self.query(_res_sql, params + (limit,))
+        if isinstance(res, Exception):
+            raise DbAccessException("Change log could not be read: {}".format(res))
+        return [{"seq": seq, "table": table, "operation": operation, "key": json.loads(row_key),
+                 "columns": json.loads(changed_columns), "changed_at": changed_at}
+                for seq, table, operation, row_key, changed_columns, changed_at in res]
+
+    def has_table(self, table: str) -> bool:
+        res = self.query("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        return isinstance(res, list) and bool(res)
+
+    # Column descriptions of a table from the schema: [(name, ColumnTypes, nullable, primary key position)]; the
+    # position is 0 for non-key columns.
+    def table_columns(self, table: str) -> list:
+        table_info = self.query("PRAGMA table_info({})".format(table))
+        if not isinstance(table_info, list) or not table_info:
+            raise InvalidMappingException("Table '{}' does not exist.".format(table))
+        return [(name, ColumnTypes.of_declared_type(declared_type), not not_null and not pk_pos, pk_pos)
+                for _, name, declared_type, not_null, _, pk_pos in table_info]
+
     def query_by_example(self, example) -> list:
         pass
 
@@ -369,6 +625,119 @@ class AQLInstance(_ObjectStore):
         self._client = aql_client
 
 
+class DuckDBInstance(_ObjectStore):
+    """
+        Encapsulate an embedded DuckDB database (file or in-memory), the columnar "big data" store for analytics.
+        - Provide DML operations (CRUD) and 'query' like SQLiteInstance, so reports can run against either store
+        - Aggregations run vectorized in-process, no Python loops over order items
+        - Bulk loading of SQLite tables via Arrow batches, s. load_from_sqlite()
+    """
+
+    # Declared SQLite column types (s. products_db.sql) => DuckDB types
+    _TYPE_MAPPING = {"INTEGER": "BIGINT", "REAL": "DOUBLE", "TEXT": "VARCHAR", "DATE": "DATE", "BLOB": "BLOB",
+                     "MONEY": "BIGINT"}
+
+    def __init__(self, db_file_path: Path = None):
+        import duckdb  # optional dependency; only needed when analytics are used
+        self._db_file_path = db_file_path
+        self._error_type = duckdb.Error
+        try:
+            self._conn = duckdb.connect(str(db_file_path) if db_file_path else ":memory:")
+        except duckdb.Error as db_ex:
+            raise DbAccessException("Analytical database could not be opened!", db_ex)
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, sql: str, params: tuple = ()):
+        try:
+            self._conn.execute(sql, params)
+            return SQLCodes.SUCCESS
+        except self._error_type as db_ex:
+            return SQLCode(str(db_ex))
+
+    def create(self, data_object: DataObject):
+        all_col_dict = data_object.merge_columns()
+        _res_sql = "INSERT INTO {} ({}) VALUES ({})".format(
+            data_object.table_name(), ",".join(all_col_dict.keys()), ",".join(["?"] * len(all_col_dict)))
+        return self._execute(_res_sql, tuple(all_col_dict.values()))
+
+    # Returns a new DataObject with the values read ('data_object' names the columns and holds the key; it is not
+    # changed), None if there is no such row, or an SQLCode on error.
+    def read(self, data_object: DataObject):
+        key_col_dict = data_object.key_columns()
+        col_names = list(data_object.columns().keys())  # order matters!
+        _res_sql = "SELECT {} FROM {} WHERE {}".format(
+            ",".join(col_names), data_object.table_name(), " AND ".join(key + "=?" for key in key_col_dict))
+        try:
+            res = self._conn.execute(_res_sql, tuple(key_col_dict.values())).fetchone()
+        except self._error_type as db_ex:
+            return SQLCode(str(db_ex))
+        if res is None:
+            return None
+        return DataObject(data_object.table_name(), {**dict(zip(col_names, res)), **key_col_dict}, set(key_col_dict))
+
+    def update(self, data_object: DataObject):
+        col_value_dict = data_object.columns()
+        key_col_dict = data_object.key_columns()
+        _res_sql = "UPDATE {} SET {} WHERE {}".format(
+            data_object.table_name(),
+            ",".join(col + "=?" for col in col_value_dict),
+            " AND ".join(key + "=?" for key in key_col_dict))
+        return self._execute(_res_sql, (*col_value_dict.values(), *key_col_dict.values()))
+
+    def delete(self, data_object: DataObject):
+        key_col_dict = data_object.key_columns()
+        _res_sql = "DELETE FROM {} WHERE {}".format(
+            data_object.table_name(), " AND ".join(key + "=?" for key in key_col_dict))
+        return self._execute(_res_sql, tuple(key_col_dict.values()))
+
+    # Like SQLiteInstance.query(): rows as list of tuples, the exception object on error.
+    def query(self, sql_query, params: tuple = ()) -> list:
+        try:
+            return self._conn.execute(sql_query, params).fetchall()
+        except self._error_type as db_ex:
+            return db_ex
+
+    def load_from_sqlite(self, sqlite_db: SQLiteInstance, tables: list, chunk_size: int = 100000) -> dict:
+        """(Re-)Load whole tables from SQLite; each table is replaced in one transaction, so queries running in the
+        meantime see either the old or the new content.
+
+        Args:
+            sqlite_db (SQLiteInstance): The source database.
+            tables (list): Table names, e.g. ["categories", "products", "orders", "order_items"]
+            chunk_size (int, optional): Rows transferred per Arrow batch. Defaults to 100000.
+
+        Returns:
+            dict: Number of rows loaded per table.
+        """
+        import pyarrow as pa
+        loaded = {}
+        for table in tables:
+            table_info = sqlite_db.query("PRAGMA table_info({})".format(table))
+            if not table_info or isinstance(table_info, Exception):
+                raise InvalidMappingException("Table not found in SQLite database: {}".format(table))
+            col_names = [col_info[1] for col_info in table_info]
+            col_defs = ["{} {}".format(col_info[1], self._TYPE_MAPPING.get(col_info[2].upper(), "VARCHAR"))
+                        for col_info in table_info]
+            self._conn.execute("BEGIN TRANSACTION")
+            try:
+                self._conn.execute("CREATE OR REPLACE TABLE {} ({})".format(table, ",".join(col_defs)))
+                loaded[table] = 0
+                for rows in sqlite_db.query_chunks("SELECT {} FROM {}".format(",".join(col_names), table),
+                                                   chunk_size=chunk_size):
+                    chunk = pa.Table.from_arrays([pa.array(col) for col in zip(*rows)], names=col_names)
+                    self._conn.register("_sqlite_chunk", chunk)
+                    self._conn.execute("INSERT INTO {} SELECT * FROM _sqlite_chunk".format(table))
+                    self._conn.unregister("_sqlite_chunk")
+                    loaded[table] += len(rows)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return loaded
+
+
 # wrapper for CQL (Cassandra Query Language)
 class CQLInstance(_ObjectStore):
     pass
@@ -407,10 +776,10 @@ class _PersistenceManager(ABC):
 
 # check the first (unkeyed) param for its type (class)
 def check_pc_param(clazz: type):
-        def wrapper(manager, func):
-            def check(args):
-                if isinstance(args[1], clazz):
-                    return func(args[1])
+        def wrapper(func):
+            def check(manager, pc):
+                if isinstance(pc, clazz):
+                    return func(manager, pc)
                 else:
                     raise TypeCastError("Submitted class not _PersistenceCapable.")
             return check
@@ -839,6 +1208,11 @@ def create_proxy(db_path: Path) -> SQLiteInstance:
     return SQLiteInstance(db_path)
 
 
+def create_analytics_proxy(db_path: Path = None) -> DuckDBInstance:
+    # None => in-memory database, e.g. for a reporting session fed from SQLite
+    return DuckDBInstance(db_path)
+
+
 class UnitTestSQLite(unittest.TestCase):
 
     def test_PersistentCapable_properties_added(self):
@@ -877,6 +1251,53 @@ class UnitTestSQLite(unittest.TestCase):
                         InvalidConfigurationWarning))
 
 
+class UnitTestDuckDB(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, price MONEY, category_id INTEGER);
+                INSERT INTO products VALUES (2001, 'Pizza Margarita', 499, 2000), (2002, 'Pizza Funghi', 599, 2000),
+                    (1001, 'Cola', 250, 1000);
+            """)
+        conn.close()
+        self.sqlite_db = SQLiteInstance(db_path)
+        self.db = create_analytics_proxy()
+
+    def tearDown(self):
+        self.db.close()
+        self._tmp_dir.cleanup()
+
+    def test_crud(self):
+        self.assertIs(self.db._execute("CREATE TABLE categories (id BIGINT PRIMARY KEY, name VARCHAR)"),
+                      SQLCodes.SUCCESS)
+        self.assertIs(self.db.create(DataObject("categories", {"id": 2000, "name": "Pizzas"}, {"id"})),
+                      SQLCodes.SUCCESS)
+        example = DataObject("categories", {"id": 2000, "name": None}, {"id"})
+        found = self.db.read(example)
+        self.assertEqual(found.merge_columns(), {"id": 2000, "name": "Pizzas"})
+        self.assertEqual(example.columns(), {"name": None}) # the caller's object is not changed
+        self.assertIsNone(self.db.read(DataObject("categories", {"id": 1, "name": None}, {"id"})))
+        self.db.update(DataObject("categories", {"id": 2000, "name": "Pizza"}, {"id"}))
+        self.assertEqual(self.db.query("SELECT name FROM categories WHERE id = ?", (2000,)), [("Pizza",)])
+        self.db.delete(DataObject("categories", {"id": 2000, "name": None}, {"id"}))
+        self.assertEqual(self.db.query("SELECT COUNT(*) FROM categories"), [(0,)])
+        self.assertIsInstance(self.db.create(DataObject("categories", {"id": 2000, "name": "x"}, {"id"})), SQLCode)
+        self.assertIsInstance(self.db.query("SELECT * FROM no_such_table"), Exception)
+
+    def test_load_from_sqlite(self):
+        self.assertEqual(self.db.load_from_sqlite(self.sqlite_db, ["products"], chunk_size=2), {"products": 3})
+        self.assertEqual(self.db.query("SELECT category_id, SUM(price) FROM products GROUP BY 1 ORDER BY 1"),
+                         [(1000, 250), (2000, 1098)]) # MONEY stays integer cents
+        self.sqlite_db._execute_sql("DELETE FROM products WHERE id = 1001")
+        self.assertEqual(self.db.load_from_sqlite(self.sqlite_db, ["products"]), {"products": 2}) # replaced
+        with self.assertRaises(InvalidMappingException):
+            self.db.load_from_sqlite(self.sqlite_db, ["no_such_table"])
+
+
 if __name__ == "__main__":
     print("This is a library and cannot be invoked directly; pls. use 'import' fom another program.")
     print("Will run unit test now..")
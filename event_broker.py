@@ -0,0 +1,189 @@
+# ACASA Event Broker
+# Pushes changes to the browsers instead of letting them poll: one broker per worker process fans every event out to
+# the clients subscribed to its topic, over Server-Sent Events (s. sse_stream() and web_portal '/events'). The events
+# come from the change log, read once per process (s. change_management.ChangeFeed), so the database is asked once per
+# change and not once per client and poll interval. An event is encoded once; the same bytes are queued for all of its
+# subscribers. Topics are e.g. "catalogue" or "order/17"; "order/*" subscribes to all orders (kitchen displays).
+# A client that falls behind (full queue) gets a "reset" event instead of the missed ones and reloads its state. The
+# last event of a topic is retained, so a reconnecting client (header 'Last-Event-ID') receives what it missed.
+import asyncio
+from collections import namedtuple, OrderedDict
+import json
+import unittest
+
+RESET_TOPIC = "reset"
+HEARTBEAT = b": keep-alive\n\n" # comment line, keeps proxies from closing idle connections
+RECONNECT = b"retry: 3000\n\n" # milliseconds the browser waits before reconnecting
+
+Event = namedtuple("Event", ["seq", "topic", "data", "frame"]) # frame: the encoded SSE message
+
+
+def sse_frame(seq: int, topic: str, data) -> bytes:
+    """E.g. b'id: 17\\nevent: catalogue\\ndata: {"version":17}\\n\\n'
+    """
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(seq, topic, json.dumps(data, separators=(",", ":"))).encode("UTF-8")
+
+
+def _wildcard(topic: str) -> str:
+    return topic.split("/", 1)[0] + "/*" if "/" in topic else None
+
+
+_RESET = Event(None, RESET_TOPIC, {}, b"event: reset\ndata: {}\n\n") # no id: the client keeps its Last-Event-ID
+
+
+class Subscription():
+    """Queue of the events of 'topics' for one client; s. Broker.subscribe().
+    """
+
+    def __init__(self, topics: frozenset, max_queued: int):
+        self.topics = topics
+        self._queue = asyncio.Queue(max_queued)
+        self.dropped = 0
+
+    def _offer(self, event: Event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull: # too slow: replace the backlog by a reset, the client reloads
+            self.dropped += self._queue.qsize()
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._queue.put_nowait(_RESET)
+
+    async def next(self, timeout: float = None) -> Event:
+        """The next event; None if there was none within 'timeout' seconds.
+        """
+        if not self._queue.empty():
+            return self._queue.get_nowait()
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker():
+    """In-process fan-out of events to subscriptions. Subscribing and dispatching happen on the event loop of the web
+    server; publish() may be called from any thread (e.g. the change feed).
+    Args:
+        max_queued (int, optional): Events queued per subscription before it is reset.
+        max_retained (int, optional): Topics whose last event is kept for reconnecting clients.
+    """
+
+    def __init__(self, max_queued: int = 100, max_retained: int = 1024):
+        self.max_queued = max_queued
+        self.max_retained = max_retained
+        self._subscriptions = {} # topic => set of Subscription
+        self._retained = OrderedDict() # topic => Event
+        self._loop = None
+        self.published = 0
+
+    def attach(self, loop: asyncio.AbstractEventLoop = None):
+        """Bind the broker to the loop of the web server (default: the running one), e.g. in 'before_serving'.
+        """
+        self._loop = loop or asyncio.get_running_loop()
+
+    def publish(self, seq: int, topic: str, data):
+        """Send an event to the subscribers of 'topic'; 'seq' orders the events (the change log sequence number).
+        """
+        event = Event(seq, topic, data, sse_frame(seq, topic, data)) # encoded in the calling thread
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self._loop is None or running is self._loop:
+            self._dispatch(event)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+
+    def _dispatch(self, event: Event):
+        self.published += 1
+        self._retained[event.topic] = event
+        self._retained.move_to_end(event.topic)
+        if len(self._retained) > self.max_retained:
+            self._retained.popitem(last=False)
+        for key in (event.topic, _wildcard(event.topic)):
+            for subscription in self._subscriptions.get(key, ()):
+                subscription._offer(event)
+
+    def subscribe(self, topics: list, last_seq: int = None) -> Subscription:
+        """Subscribe to 'topics'; with 'last_seq' (the last event the client has seen) the retained events after it
+        are queued first.
+        """
+        subscription = Subscription(frozenset(topics), self.max_queued)
+        if last_seq is not None:
+            missed = [event for event in self._retained.values() if event.seq > last_seq and
+                      (event.topic in subscription.topics or _wildcard(event.topic) in subscription.topics)]
+            for event in sorted(missed)[-self.max_queued:]:
+                subscription._offer(event)
+        for topic in subscription.topics:
+            self._subscriptions.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for topic in subscription.topics:
+            subscribers = self._subscriptions.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[topic]
+
+    def subscriber_count(self) -> int:
+        return len(set().union(*self._subscriptions.values()))
+
+
+async def sse_stream(broker: Broker, topics: list, last_seq: int = None, heartbeat: float = 15.0):
+    """Body of a 'text/event-stream' response: the events of 'topics' until the client disconnects (the server then
+    cancels the generator), a heartbeat after 'heartbeat' idle seconds.
+    """
+    subscription = broker.subscribe(topics, last_seq)
+    try:
+        yield RECONNECT
+        while True:
+            event = await subscription.next(heartbeat)
+            yield HEARTBEAT if event is None else event.frame
+    finally:
+        broker.unsubscribe(subscription)
+
+
+class UnitTestBroker(unittest.TestCase):
+
+    def test_fan_out(self):
+        async def scenario():
+            broker = Broker(max_queued=2)
+            broker.attach()
+            menu, kitchen, guest = (broker.subscribe(["catalogue"]), broker.subscribe(["order/*"]),
+                                    broker.subscribe(["order/5", "catalogue"]))
+            broker.publish(1, "catalogue", {"version": 1})
+            broker.publish(2, "order/5", {"order": 5, "status": 1})
+            broker.publish(3, "order/6", {"order": 6, "status": 0})
+            self.assertIs((await menu.next(0)).frame, (await guest.next(0)).frame) # encoded once
+            self.assertEqual([(await kitchen.next(0)).seq for _ in range(2)], [2, 3])
+            self.assertEqual((await guest.next(0)).frame, b'id: 2\nevent: order/5\ndata: {"order":5,"status":1}\n\n')
+            self.assertIsNone(await menu.next(0.01))
+            for seq in range(4, 7): # more than 'max_queued'
+                broker.publish(seq, "catalogue", {"version": seq})
+            self.assertEqual((await menu.next(0)).topic, RESET_TOPIC)
+            broker.unsubscribe(menu)
+            self.assertEqual(broker.subscriber_count(), 2)
+            late = broker.subscribe(["order/*"], last_seq=2) # reconnected after event 2
+            self.assertEqual((await late.next(0)).seq, 3)
+            self.assertIsNone(await late.next(0))
+        asyncio.run(scenario())
+
+    def test_publish_from_thread(self):
+        async def scenario():
+            broker = Broker()
+            broker.attach()
+            stream = sse_stream(broker, ["catalogue"], heartbeat=0.01)
+            self.assertEqual(await stream.__anext__(), RECONNECT)
+            self.assertEqual(await stream.__anext__(), HEARTBEAT)
+            await asyncio.to_thread(broker.publish, 7, "catalogue", {"version": 7})
+            self.assertEqual(await stream.__anext__(), sse_frame(7, "catalogue", {"version": 7}))
+            await stream.aclose()
+            self.assertEqual(broker.subscriber_count(), 0)
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
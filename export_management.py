@@ -0,0 +1,251 @@
+"""
+* ACASA Export Management
+* Batch export of 'orders' and 'order_items' into columnar Arrow IPC (or Parquet) files for offline analysis. The files
+* are partitioned by month of the order date, e.g. 'out/export/orders/month=2023-02/part-000000042.arrow', and every run
+* only exports orders added since the last run (s. 'export_state.json' in the export directory).
+"""
+import json
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+import pyarrow as pa
+import pyarrow.ipc
+
+from db import DataObject, SQLCode, SQLiteInstance
+
+STATE_FILE_NAME = "export_state.json"
+
+ORDERS_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("customer", pa.string()),
+    ("status", pa.int32()),
+    ("order_date", pa.date32())
+])
+
+ORDER_ITEMS_SCHEMA = pa.schema([
+    ("order_id", pa.int64()),
+    ("item_id", pa.int64()),
+    ("amount", pa.int32()),
+    ("order_date", pa.date32())  # denormalized, so items can be partitioned (and filtered) like their orders
+])
+
+# Both tables are read in order id sequence with the same bounds, so one run always exports complete orders - as long
+# as an order and its items are committed together (SQLiteInstance.insert_with_details()); items added to an order
+# after it was exported are not exported.
+_ORDERS_SQL = """SELECT o.id, o.customer, o.status, o.order_date
+            FROM orders o
+            WHERE o.id > ? AND o.id <= ?
+            ORDER BY o.id"""
+
+_ORDER_ITEMS_SQL = """SELECT i.order_id, i.item_id, i.amount, o.order_date
+            FROM order_items i, orders o
+            WHERE i.order_id = o.id AND o.id > ? AND o.id <= ?
+            ORDER BY i.order_id"""
+
+DEFAULT_CONFIG = {
+    "export_directory": "out/export",
+    "chunk_size": 50000,
+    "file_format": "arrow",  # 'arrow': memory-mappable IPC files; 'parquet': smallest files, needs decoding
+    "compression": None  # 'lz4' or 'zstd' shrink Arrow files, but they cannot be mapped zero-copy any more
+}
+
+
+class _PartitionWriters():
+    """Keeps one open writer per month partition during a run; files are written under a temporary name and only
+    renamed when the run succeeded, so readers never see half-written parts.
+    """
+
+    def __init__(self, table_dir: Path, schema: pa.Schema, part_name: str, file_format: str, compression):
+        self._table_dir = table_dir
+        self._schema = schema
+        self._part_name = part_name
+        self._file_format = file_format
+        self._compression = compression
+        self._writers = {}  # month => (writer, temp_path, final_path)
+
+    def _writer(self, month: str):
+        if month not in self._writers:
+            part_dir = self._table_dir / "month={}".format(month)
+            part_dir.mkdir(parents=True, exist_ok=True)
+            final_path = part_dir / "{}.{}".format(self._part_name, self._file_format)
+            temp_path = part_dir / "{}.{}.tmp".format(self._part_name, self._file_format)
+            if self._file_format == "parquet":
+                import pyarrow.parquet as pq  # only needed for this format
+                writer = pq.ParquetWriter(str(temp_path), self._schema, compression=self._compression or "zstd")
+            else:
+                options = pa.ipc.IpcWriteOptions(compression=self._compression)
+                writer = pa.ipc.new_file(str(temp_path), self._schema, options=options)
+            self._writers[month] = writer, temp_path, final_path
+        return self._writers[month][0]
+
+    def write_rows(self, rows: list, date_index: int) -> int:
+        by_month = {}
+        for row in rows:
+            month = (row[date_index] or "0000-00")[:7]
+            if month not in by_month:
+                by_month[month] = list()
+            by_month[month].append(row)
+        for month in by_month:
+            columns = list(zip(*by_month[month]))
+            arrays = [pa.array(columns[idx], type=pa.string() if field.type == pa.date32() else field.type)
+                      for idx, field in enumerate(self._schema)]
+            arrays[date_index] = arrays[date_index].cast(pa.date32())
+            batch = pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+            if self._file_format == "parquet":
+                self._writer(month).write_table(pa.Table.from_batches([batch]))
+            else:
+                self._writer(month).write_batch(batch)
+        return len(rows)
+
+    def commit(self) -> list:
+        written = []
+        for writer, temp_path, final_path in self._writers.values():
+            writer.close()
+            os.replace(temp_path, final_path)
+            written.append(final_path)
+        self._writers = {}
+        return written
+
+    def abort(self):
+        for writer, temp_path, final_path in self._writers.values():
+            writer.close()
+            temp_path.unlink(missing_ok=True)
+        self._writers = {}
+
+
+def _load_state(export_dir: Path) -> dict:
+    state_path = export_dir / STATE_FILE_NAME
+    if not state_path.exists():
+        return {"last_order_id": 0}
+    with open(state_path, mode="r", encoding="UTF-8") as state_file:
+        return json.load(state_file)
+
+
+def _save_state(export_dir: Path, state: dict):
+    temp_path = export_dir / (STATE_FILE_NAME + ".tmp")
+    with open(temp_path, mode="w", encoding="UTF-8") as state_file:
+        json.dump(state, state_file)
+    os.replace(temp_path, export_dir / STATE_FILE_NAME)
+
+
+def export_orders(db: SQLiteInstance, export_config: dict = None) -> dict:
+    """Export all orders (and their items) that were added since the last export.
+
+    Args:
+        db (SQLiteInstance): The order database.
+        export_config (dict, optional): The 'export_management' section of config.yaml. Defaults to DEFAULT_CONFIG.
+
+    Returns:
+        dict: Summary of the run, e.g. {"from_order_id": 0, "to_order_id": 42, "orders": 42, "order_items": 97,
+              "files": [...]}
+    """
+    cfg = {**DEFAULT_CONFIG, **(export_config or {})}
+    export_dir = Path(cfg["export_directory"])
+    export_dir.mkdir(parents=True, exist_ok=True)
+    state = _load_state(export_dir)
+    from_id = state["last_order_id"]
+    max_id = db.query("SELECT MAX(id) FROM orders")[0][0] or 0
+    summary = {"from_order_id": from_id, "to_order_id": max_id, "orders": 0, "order_items": 0, "files": []}
+    if max_id <= from_id:
+        return summary  # nothing new
+
+    part_name = "part-{:09d}".format(max_id)
+    writers = {
+        "orders": (_ORDERS_SQL, _PartitionWriters(export_dir / "orders", ORDERS_SCHEMA, part_name,
+                                                  cfg["file_format"], cfg["compression"])),
+        "order_items": (_ORDER_ITEMS_SQL, _PartitionWriters(export_dir / "order_items", ORDER_ITEMS_SCHEMA, part_name,
+                                                            cfg["file_format"], cfg["compression"]))
+    }
+    try:
+        for table_name, (sql, writer) in writers.items():
+            for rows in db.query_chunks(sql, (from_id, max_id), cfg["chunk_size"]):
+                summary[table_name] += writer.write_rows(rows, date_index=3)
+    except Exception:
+        for sql, writer in writers.values():
+            writer.abort()
+        raise
+    for sql, writer in writers.values():
+        summary["files"].extend(str(path) for path in writer.commit())
+    _save_state(export_dir, {"last_order_id": max_id})
+    return summary
+
+
+def read_export(export_dir: Path, table_name: str, month: str = None) -> pa.Table:
+    """Read exported parts of one table, optionally restricted to a month ('2023-02'). Uncompressed Arrow files are
+    memory-mapped, so the returned table references the file pages instead of copies in the Python heap.
+    """
+    table_dir = Path(export_dir) / table_name
+    pattern = "month={}/*".format(month) if month else "month=*/*"
+    tables = []
+    for part_path in sorted(table_dir.glob(pattern)):
+        if part_path.suffix == ".arrow":
+            tables.append(pa.ipc.open_file(pa.memory_map(str(part_path), "r")).read_all())
+        elif part_path.suffix == ".parquet":
+            import pyarrow.parquet as pq
+            tables.append(pq.read_table(str(part_path), memory_map=True))
+    if not tables:
+        schema = ORDERS_SCHEMA if table_name == "orders" else ORDER_ITEMS_SCHEMA
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+class UnitTestExport(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, price MONEY, category_id INTEGER);
+                CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, customer TEXT NOT NULL,
+                    status INTEGER NOT NULL DEFAULT 0, order_date DATE);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    FOREIGN KEY (item_id) REFERENCES products(id), PRIMARY KEY (order_id, item_id));
+                INSERT INTO products VALUES (2001, 'Pizza Margarita', 499, 2000), (2002, 'Pizza Funghi', 599, 2000);
+            """)
+        conn.close()
+        self.db = SQLiteInstance(db_path)
+        self.config = {"export_directory": str(Path(self._tmp_dir.name, "export")), "chunk_size": 2}
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _order(self, order_date: str, items: dict):
+        return self.db.insert_with_details(
+            DataObject("orders", {"id": None, "customer": "Joe", "order_date": order_date}, {"id"}),
+            [DataObject("order_items", {"order_id": None, "item_id": item_id, "amount": amount},
+                        {"order_id", "item_id"}) for item_id, amount in items.items()], "order_id")
+
+    def test_incremental(self):
+        self._order("2023-01-31", {2001: 1})
+        self._order("2023-02-24", {2001: 2, 2002: 1})
+        summary = export_orders(self.db, self.config)
+        self.assertEqual({key: summary[key] for key in ("from_order_id", "to_order_id", "orders", "order_items")},
+                         {"from_order_id": 0, "to_order_id": 2, "orders": 2, "order_items": 3})
+        self.assertEqual(export_orders(self.db, self.config)["orders"], 0) # nothing new
+        self._order("2023-02-25", {2002: 4})
+        self.assertEqual(export_orders(self.db, {**self.config, "file_format": "parquet"})["order_items"], 1)
+        export_dir = self.config["export_directory"]
+        self.assertEqual(read_export(export_dir, "orders")["id"].to_pylist(), [1, 2, 3])
+        february = read_export(export_dir, "order_items", "2023-02")
+        self.assertEqual(list(zip(february["order_id"].to_pylist(), february["amount"].to_pylist())),
+                         [(2, 2), (2, 1), (3, 4)])
+
+    def test_orders_complete(self):
+        self._order("2023-02-24", {2001: 1, 2002: 1})
+        item = {"order_id": None, "item_id": 2001, "amount": 1}
+        res = self.db.insert_with_details( # the second item violates the primary key
+            DataObject("orders", {"id": None, "customer": "Ann", "order_date": "2023-02-24"}, {"id"}),
+            [DataObject("order_items", dict(item), {"order_id", "item_id"}) for _ in range(2)], "order_id")
+        self.assertIsInstance(res, SQLCode)
+        self.assertEqual(self.db.query("SELECT COUNT(*) FROM orders")[0][0], 1) # nothing of the failed order
+        summary = export_orders(self.db, self.config)
+        self.assertEqual((summary["orders"], summary["order_items"]), (1, 2))
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
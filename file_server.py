@@ -0,0 +1,321 @@
+# ACASA File Server
+# ASGI middleware that answers GET/HEAD requests for files below mounted directories (static assets, receipts,
+# exports) before they reach the web framework, without reading the files into the worker's memory: servers supporting
+# the ASGI 'zero copy send' extension get the open file and send it with os.sendfile(); otherwise the file is memory
+# mapped and sent in chunks (slices of the mapping, no copies), so a 50 MB export never occupies 50 MB of the heap.
+# Single byte ranges (resuming downloads, PDF viewers) and conditional requests (ETag) are supported. Files are kept
+# open in a small LRU cache; a changed or replaced file (s. os.replace() in the writers) is detected by its inode/size/
+# modification time and opened again.
+import asyncio
+from collections import namedtuple, OrderedDict
+from email.utils import formatdate
+from http.cookies import SimpleCookie
+import mimetypes
+import mmap
+import os
+from pathlib import Path
+import tempfile
+import threading
+import tracemalloc
+import unittest
+
+CHUNK_SIZE = 256 * 1024
+ZERO_COPY_SEND = "http.response.zerocopysend"
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz")) # preferred first, s. asset_pipeline.py
+TEXT_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+Mount = namedtuple("Mount", ["prefix", "directory", "cache_control", "authorize", "precompressed"],
+                   defaults=["no-cache", None, False])
+Mount.__doc__ = """Files below 'directory' served at URL 'prefix' (e.g. "/receipts/").
+    cache_control: Header value, or a function of the file name (relative to 'directory') returning it.
+    authorize: Coroutine function called with the ASGI scope; the file is only sent if it returns True.
+    precompressed: Send '<file>.br'/'<file>.gz' siblings to browsers accepting them.
+"""
+
+
+def session_cookie(scope: dict, name: str) -> str:
+    """The value of cookie 'name' of the request, None if not sent.
+    """
+    for header, value in scope["headers"]:
+        if header == b"cookie":
+            cookie = SimpleCookie(value.decode("latin-1")).get(name)
+            if cookie is not None:
+                return cookie.value
+    return None
+
+
+def parse_range(header: str, size: int) -> tuple:
+    """(start, end) - end exclusive - of a single range 'bytes=..'; None for no/unsupported range (the whole file is
+    sent), () if the range cannot be satisfied.
+    """
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[6:].strip().partition("-")
+    try:
+        if not first: # suffix: the last n bytes
+            count = int(last)
+            return (max(0, size - count), size) if count > 0 else ()
+        start = int(first)
+        end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    return (start, end) if start < end else ()
+
+
+class _OpenFile():
+    """A cached open file: descriptor, memory mapping (created on first use) and validators; closed when evicted
+    from the cache and no response uses it any more.
+    """
+    __slots__ = ("path", "file", "identity", "size", "etag", "last_modified", "_mapping", "users", "evicted")
+
+    def __init__(self, path: Path, stat: os.stat_result):
+        self.path = path
+        self.file = open(path, "rb", buffering=0)
+        self.identity = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self.etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        self.last_modified = formatdate(stat.st_mtime, usegmt=True)
+        self._mapping = None
+        self.users = 0
+        self.evicted = False
+
+    def mapping(self) -> mmap.mmap:
+        if self._mapping is None:
+            self._mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mapping
+
+    def close(self):
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError: # a chunk is still referenced; the mapping goes with the last reference
+                pass
+        self.file.close()
+
+
+class FileServer():
+    """ASGI middleware, e.g. web_app.asgi_app = FileServer(web_app.asgi_app, [Mount("/", static_path)]); requests
+    for anything that is not a file below a mount are passed on to 'app'.
+    Args:
+        app: The wrapped ASGI application.
+        mounts (list): Mount entries; the first matching prefix wins.
+        max_open_files (int, optional): Size of the cache of open files.
+        chunk_size (int, optional): Bytes per message if the server cannot send files itself.
+    """
+
+    def __init__(self, app, mounts: list, max_open_files: int = 128, chunk_size: int = CHUNK_SIZE):
+        self.app = app
+        self.mounts = [mount._replace(directory=Path(mount.directory).resolve()) for mount in mounts]
+        self.max_open_files = max_open_files
+        self.chunk_size = chunk_size
+        self._files = OrderedDict() # path => _OpenFile
+        self._lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.app(scope, receive, send)
+        match = self._match(scope["path"])
+        if match is None:
+            return await self.app(scope, receive, send)
+        mount, file_path, name = match
+        if mount.authorize is not None and not await mount.authorize(scope):
+            return await self._send_status(send, 403)
+        headers = {key.decode("latin-1"): value.decode("latin-1") for key, value in scope["headers"]}
+        encoding = None
+        if mount.precompressed:
+            for candidate, suffix in PRECOMPRESSED:
+                if candidate in headers.get("accept-encoding", "") and Path(str(file_path) + suffix).is_file():
+                    file_path, encoding = Path(str(file_path) + suffix), candidate
+                    break
+        open_file = self._acquire(file_path)
+        if open_file is None:
+            return await self.app(scope, receive, send)
+        try:
+            await self._send_file(scope, send, open_file, name, mount, encoding, headers)
+        finally:
+            self._release(open_file)
+
+    def _match(self, url_path: str) -> tuple:
+        for mount in self.mounts:
+            if url_path.startswith(mount.prefix):
+                name = url_path[len(mount.prefix):].lstrip("/")
+                file_path = Path(mount.directory, name).resolve()
+                if name and file_path.is_relative_to(mount.directory) and file_path.is_file():
+                    return mount, file_path, name
+        return None
+
+    def _acquire(self, file_path: Path) -> _OpenFile:
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            open_file = self._files.get(file_path)
+            if open_file is not None and open_file.identity == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+                self._files.move_to_end(file_path)
+            else:
+                if open_file is not None: # changed or replaced
+                    self._evict(self._files.pop(file_path))
+                try:
+                    open_file = self._files[file_path] = _OpenFile(file_path, stat)
+                except FileNotFoundError: # deleted since os.stat()
+                    return None
+                while len(self._files) > self.max_open_files:
+                    self._evict(self._files.popitem(last=False)[1])
+            open_file.users += 1
+            return open_file
+
+    def _release(self, open_file: _OpenFile):
+        with self._lock:
+            open_file.users -= 1
+            if open_file.evicted and open_file.users == 0:
+                open_file.close()
+
+    def _evict(self, open_file: _OpenFile):
+        open_file.evicted = True
+        if open_file.users == 0:
+            open_file.close()
+
+    def close(self):
+        with self._lock:
+            while self._files:
+                self._evict(self._files.popitem()[1])
+
+    async def _send_file(self, scope, send, open_file: _OpenFile, name: str, mount: Mount, encoding: str,
+                         headers: dict):
+        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if mimetype.startswith(TEXT_TYPES):
+            mimetype += "; charset=utf-8"
+        cache_control = mount.cache_control(name) if callable(mount.cache_control) else mount.cache_control
+        response_headers = [(b"content-type", mimetype.encode()), (b"etag", open_file.etag.encode()),
+                            (b"last-modified", open_file.last_modified.encode()), (b"accept-ranges", b"bytes"),
+                            (b"cache-control", cache_control.encode())]
+        if mount.precompressed:
+            response_headers.append((b"vary", b"Accept-Encoding"))
+        if encoding is not None:
+            response_headers.append((b"content-encoding", encoding.encode()))
+        if open_file.etag in headers.get("if-none-match", ""):
+            return await self._send_status(send, 304, response_headers)
+        start, end, status = 0, open_file.size, 200
+        if encoding is None and headers.get("if-range", open_file.etag) == open_file.etag: # ranges of the file itself
+            byte_range = parse_range(headers.get("range"), open_file.size)
+            if byte_range == ():
+                return await self._send_status(send, 416, [(b"content-range",
+                                                            "bytes */{}".format(open_file.size).encode())])
+            if byte_range is not None:
+                (start, end), status = byte_range, 206
+                response_headers.append((b"content-range",
+                                         "bytes {}-{}/{}".format(start, end - 1, open_file.size).encode()))
+        response_headers.append((b"content-length", str(end - start).encode()))
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        if scope["method"] == "HEAD" or start == end:
+            return await send({"type": "http.response.body", "body": b""})
+        if ZERO_COPY_SEND in scope.get("extensions", {}):
+            return await send({"type": ZERO_COPY_SEND, "file": open_file.file, "offset": start, "count": end - start})
+        mapping = open_file.mapping()
+        for offset in range(start, end, self.chunk_size): # ASGI bodies are bytes: one chunk is copied at a time
+            chunk_end = min(offset + self.chunk_size, end)
+            await send({"type": "http.response.body", "body": mapping[offset:chunk_end], "more_body": chunk_end < end})
+
+    async def _send_status(self, send, status: int, headers: list = None):
+        await send({"type": "http.response.start", "status": status,
+                    "headers": (headers or []) + [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+
+class UnitTestFileServer(unittest.TestCase):
+
+    async def _fallback(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 404, "headers": []})
+        await send({"type": "http.response.body", "body": b"app"})
+
+    def _get(self, server: FileServer, path: str, method: str = "GET", extensions: dict = None, **headers) -> tuple:
+        messages = []
+
+        async def send(message):
+            if message["type"] == "http.response.body":
+                self.assertIs(type(message["body"]), bytes) # e.g. Quart's test client accepts nothing else
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "extensions": extensions or {},
+                 "headers": [(key.replace("_", "-").encode(), value.encode()) for key, value in headers.items()]}
+        asyncio.run(server(scope, None, send))
+        response_headers = dict(messages[0]["headers"])
+        body = b"".join(message.get("body", b"") for message in messages[1:] if message["type"] != ZERO_COPY_SEND)
+        return messages[0]["status"], response_headers, body, messages
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self._tmp_dir.name)
+        Path(self.root, "public").mkdir()
+        Path(self.root, "public", "app.js").write_text("var a = 1;", encoding="UTF-8")
+        Path(self.root, "public", "app.js.gz").write_bytes(b"GZ")
+        Path(self.root, "secret.txt").write_text("secret", encoding="UTF-8")
+        self.data = bytes(range(256)) * 4096 # 1 MB
+
+        async def staff_only(scope):
+            return session_cookie(scope, "acasa_session") == "staff"
+
+        Path(self.root, "exports").mkdir()
+        Path(self.root, "exports", "orders.arrow").write_bytes(self.data)
+        self.server = FileServer(self._fallback, [Mount("/exports/", Path(self.root, "exports"), authorize=staff_only),
+                                                  Mount("/", Path(self.root, "public"), precompressed=True)],
+                                 max_open_files=1, chunk_size=64 * 1024)
+
+    def tearDown(self):
+        self.server.close()
+        self._tmp_dir.cleanup()
+
+    def test_files(self):
+        status, headers, body, _ = self._get(self.server, "/app.js")
+        self.assertEqual((status, body, headers[b"content-type"]),
+                         (200, b"var a = 1;", b"text/javascript; charset=utf-8"))
+        _, gzip_headers, body, _ = self._get(self.server, "/app.js", accept_encoding="gzip, br")
+        self.assertEqual((body, gzip_headers[b"content-encoding"], gzip_headers[b"content-type"]),
+                         (b"GZ", b"gzip", headers[b"content-type"]))
+        self.assertNotEqual(gzip_headers[b"etag"], headers[b"etag"])
+        self.assertEqual(self._get(self.server, "/app.js", if_none_match=headers[b"etag"].decode())[0], 304)
+        self.assertEqual(self._get(self.server, "/app.js", method="HEAD")[1:3], (headers, b""))
+        for path in ("/menue", "/../secret.txt", "/"): # not below a mount: the app answers
+            self.assertEqual(self._get(self.server, path)[2], b"app")
+        Path(self.root, "public", "app.js").write_text("var b = 22;", encoding="UTF-8") # changed: opened again
+        self.assertEqual(self._get(self.server, "/app.js")[2], b"var b = 22;")
+
+    def test_ranges_and_authorization(self):
+        self.assertEqual(self._get(self.server, "/exports/orders.arrow")[0], 403)
+        cookie = {"cookie": "acasa_session=staff"}
+        status, headers, body, messages = self._get(self.server, "/exports/orders.arrow", **cookie)
+        self.assertEqual((status, body, len(messages)), (200, self.data, 1 + 16)) # 16 chunks
+        status, headers, body, _ = self._get(self.server, "/exports/orders.arrow", range="bytes=1000-1999", **cookie)
+        self.assertEqual((status, headers[b"content-range"], body),
+                         (206, b"bytes 1000-1999/1048576", self.data[1000:2000]))
+        self.assertEqual(self._get(self.server, "/exports/orders.arrow", range="bytes=-10", **cookie)[2],
+                         self.data[-10:])
+        self.assertEqual(self._get(self.server, "/exports/orders.arrow", range="bytes=2000000-", **cookie)[0], 416)
+        status, _, _, messages = self._get(self.server, "/exports/orders.arrow", extensions={ZERO_COPY_SEND: {}},
+                                           range="bytes=10-", **cookie)
+        self.assertEqual((status, messages[1]["offset"], messages[1]["count"]), (206, 10, len(self.data) - 10))
+
+    def test_memory(self):
+        big_file = Path(self.root, "exports", "big.arrow")
+        with open(big_file, "wb") as export_file:
+            export_file.truncate(20 * 1024 * 1024)
+        sent = [0]
+
+        async def send(message):
+            sent[0] += len(message.get("body", b""))
+
+        scope = {"type": "http", "method": "GET", "path": "/exports/big.arrow", "extensions": {},
+                 "headers": [(b"cookie", b"acasa_session=staff")]}
+        tracemalloc.start()
+        asyncio.run(self.server(scope, None, send))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(sent[0], 20 * 1024 * 1024)
+        self.assertLess(peak, 1024 * 1024)
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
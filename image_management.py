@@ -0,0 +1,346 @@
+# ACASA Image Management
+# Product pictures are stored once per content in the database (table 'images', the ID is the SHA-256 of the data;
+# 'product_images' assigns them to products). Pages never send the original: they offer a set of sizes (srcset) and the
+# browser picks the one that fits the device. A size/format variant is derived on its first request in a pool of
+# worker processes (Pillow, CPU bound) and kept in a disk cache with a size limit, least recently used variants are
+# deleted first.
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import importlib.util
+import io
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from db import SQLCode, SQLCodes, SQLiteInstance
+
+VARIANT_WIDTHS = (160, 320, 640, 1280) # pixels; the browser chooses, s. srcset()
+VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"} # file suffix => Pillow format; JPEG for browsers without WebP
+VARIANT_QUALITY = 80
+IMAGE_URL = "/images/{}/{}.{}" # image ID, width, format; content addressed, so cacheable forever
+
+_CONTENT_TYPES = ((b"\xff\xd8\xff", "image/jpeg"), (b"\x89PNG", "image/png"), (b"GIF8", "image/gif"))
+
+
+def content_type(data: bytes) -> str:
+    """Media type from the first bytes (JPEG, PNG, GIF, WebP); None for anything else.
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return next((media_type for magic, media_type in _CONTENT_TYPES if data.startswith(magic)), None)
+
+
+def store_image(db: SQLiteInstance, product_id: int, data: bytes) -> str:
+    """Assign a picture to a product; the same picture is stored only once. Returns the image ID.
+
+    Raises:
+        ValueError: 'data' is not a JPEG, PNG, GIF or WebP image.
+        RuntimeError: Database error.
+    """
+    media_type = content_type(data)
+    if media_type is None:
+        raise ValueError("not a supported image (JPEG, PNG, GIF, WebP)")
+    image_id = hashlib.sha256(data).hexdigest()
+    width = height = None
+    if importlib.util.find_spec("PIL"): # dimensions are informative only
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+    if not db.query("SELECT 1 FROM images WHERE id = ?", (image_id,)): # else: stored already, for another product
+        res_code = db.upsert_many("images", ["id", "content_type", "width", "height", "data"],
+                                  [(image_id, media_type, width, height, data)])
+        if res_code is not SQLCodes.SUCCESS:
+            raise RuntimeError("image not stored: {}".format(res_code))
+    res_code = db.upsert_many("product_images", ["product_id", "image_id"], [(product_id, image_id)], ("product_id",))
+    if res_code is not SQLCodes.SUCCESS:
+        raise RuntimeError("image not assigned: {}".format(res_code))
+    return image_id
+
+
+def load_image(db: SQLiteInstance, image_id: str) -> bytes:
+    """The original picture; None if unknown.
+    """
+    rows = db.query("SELECT data FROM images WHERE id = ?", (image_id,))
+    if isinstance(rows, Exception):
+        raise rows
+    return rows[0][0] if rows else None
+
+
+def product_images(db: SQLiteInstance) -> dict:
+    """{product_id: image_id} of all products having a picture.
+    """
+    rows = db.query("SELECT product_id, image_id FROM product_images")
+    return dict(rows) if isinstance(rows, list) else {}
+
+
+def remove_image(db: SQLiteInstance, product_id: int) -> SQLCode:
+    """Unassign the product's picture; pictures no product uses any more are deleted.
+    """
+    return db._execute_sql_list(["DELETE FROM product_images WHERE product_id = {}".format(int(product_id)),
+                                 "DELETE FROM images WHERE id NOT IN (SELECT image_id FROM product_images)"])
+
+
+def variant_width(width: int) -> int:
+    """The variant delivered for a requested width: the smallest one that is at least as wide (or the widest).
+    """
+    return next((variant for variant in VARIANT_WIDTHS if variant >= width), VARIANT_WIDTHS[-1])
+
+
+def image_url(image_id: str, width: int, image_format: str = "webp") -> str:
+    return IMAGE_URL.format(image_id, variant_width(width), image_format)
+
+
+def srcset(image_id: str, image_format: str = "webp") -> str:
+    """For <img srcset="..">/<source srcset="..">, e.g. "/images/3f2a../160.webp 160w, /images/3f2a../320.webp 320w, .."
+    """
+    return ", ".join("{} {}w".format(IMAGE_URL.format(image_id, width, image_format), width)
+                     for width in VARIANT_WIDTHS)
+
+
+def derive_variant(data: bytes, width: int, image_format: str, target: Path) -> int:
+    """Scale the picture down to 'width' (never up) and write it as 'image_format' into 'target' (atomically, via a
+    temporary file); runs in a worker process. Returns the file size.
+    """
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image) # photos taken upright on tablets
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        if VARIANT_FORMATS[image_format] == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        tmp_path = target.with_name(target.name + ".tmp{}".format(os.getpid()))
+        image.save(tmp_path, VARIANT_FORMATS[image_format], quality=VARIANT_QUALITY, optimize=True)
+    os.replace(tmp_path, target)
+    return target.stat().st_size
+
+
+class VariantCache():
+    """Derived variants on disk, at most 'max_bytes' in total; the least recently used files are deleted first. Files
+    of an earlier run are taken over (in the order of their modification time).
+    Args:
+        cache_path (Path): Directory of the variant files, created if missing.
+        max_bytes (int): Size limit of all files.
+    """
+
+    def __init__(self, cache_path: Path, max_bytes: int):
+        self.cache_path = Path(cache_path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_path, exist_ok=True)
+        files = sorted((file_path.stat().st_mtime, file_path.name, file_path.stat().st_size)
+                       for file_path in self.cache_path.iterdir()
+                       if file_path.is_file() and ".tmp" not in file_path.name) # no half-written files
+        self._files = OrderedDict((name, size) for _, name, size in files) # file name => size, least recent first
+        self._size = sum(self._files.values())
+        self._lock = threading.Lock()
+        self._evict()
+
+    @staticmethod
+    def file_name(image_id: str, width: int, image_format: str) -> str:
+        return "{}-{}.{}".format(image_id, width, image_format)
+
+    def get(self, file_name: str) -> Path:
+        """Path of a cached variant (marked as used), None if not cached.
+        """
+        with self._lock:
+            if file_name not in self._files:
+                return None
+            self._files.move_to_end(file_name)
+        file_path = Path(self.cache_path, file_name)
+        try:
+            os.utime(file_path) # the order survives a restart
+        except FileNotFoundError: # deleted behind our back
+            with self._lock:
+                self._size -= self._files.pop(file_name, 0)
+            return None
+        return file_path
+
+    def add(self, file_name: str, size: int) -> Path:
+        """Register a variant written into the cache directory.
+        """
+        with self._lock:
+            self._size += size - self._files.pop(file_name, 0)
+            self._files[file_name] = size
+            self._evict()
+        return Path(self.cache_path, file_name)
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._files) > 1: # the newest file stays
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(Path(self.cache_path, name))
+            except FileNotFoundError:
+                pass
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+
+class ImageVariants():
+    """Delivers variants: from the cache, or derived by a worker process (concurrent requests of the same missing
+    variant wait for one derivation). get() never blocks: originals are loaded by a thread of its own.
+    Args:
+        loader: Returns the original picture for an image ID (or None), e.g. functools.partial(load_image, db); called
+            in a loader thread.
+        cache_path (Path): Directory of the variant cache.
+        max_bytes (int): Size limit of the cache.
+        workers (int, optional): Processes deriving variants.
+    """
+
+    def __init__(self, loader, cache_path: Path, max_bytes: int, workers: int = None):
+        self._loader = loader
+        self.cache = VariantCache(cache_path, max_bytes)
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._loads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-loader") # database reads
+        self._pending = {} # file name => Future, derivations in progress
+        self._lock = threading.Lock()
+
+    def get(self, image_id: str, width: int, image_format: str = "webp") -> Future:
+        """The variant of at least 'width' pixels (s. variant_width()) as Future of its path; the result is None for an
+        unknown image. Usable from asyncio via asyncio.wrap_future().
+
+        Raises:
+            ValueError: Unknown format.
+        """
+        if image_format not in VARIANT_FORMATS:
+            raise ValueError("unknown image format: {}".format(image_format))
+        file_name = VariantCache.file_name(image_id, variant_width(width), image_format)
+        file_path = self.cache.get(file_name)
+        if file_path is not None:
+            result = Future()
+            result.set_result(file_path)
+            return result
+        with self._lock:
+            pending = self._pending.get(file_name)
+            if pending is not None:
+                return pending
+            pending = self._pending[file_name] = Future()
+        try:
+            loading = self._loads.submit(self._loader, image_id)
+        except BaseException as ex:
+            self._finish(file_name, pending, exception=ex)
+            return pending
+        loading.add_done_callback(lambda loaded: self._derive(loaded, file_name, pending, variant_width(width),
+                                                              image_format))
+        return pending
+
+    def _derive(self, loaded: Future, file_name: str, pending: Future, width: int, image_format: str):
+        try:
+            data = loaded.result()
+            if data is None:
+                self._finish(file_name, pending, None)
+                return
+            derivation = self._pool.submit(derive_variant, data, width, image_format,
+                                           Path(self.cache.cache_path, file_name))
+        except BaseException as ex:
+            self._finish(file_name, pending, exception=ex)
+            return
+
+        def derived(done: Future):
+            if done.exception() is not None:
+                self._finish(file_name, pending, exception=done.exception())
+            else:
+                self._finish(file_name, pending, self.cache.add(file_name, done.result()))
+        derivation.add_done_callback(derived)
+
+    def _finish(self, file_name: str, pending: Future, result: Path = None, exception: BaseException = None):
+        with self._lock:
+            self._pending.pop(file_name, None)
+        if exception is not None:
+            pending.set_exception(exception)
+        else:
+            pending.set_result(result)
+
+    def close(self):
+        self._loads.shutdown(wait=True)
+        self._pool.shutdown(wait=True)
+
+
+class UnitTestImages(unittest.TestCase):
+
+    PNG = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00\x90wS\xde"
+           b"\x00\x00\x00\x0cIDATx\x9cc\xf8\xcf\xc0\x00\x00\x03\x01\x01\x00\xc9\xfe\x92\xef"
+           b"\x00\x00\x00\x00IEND\xaeB`\x82")
+
+    def _db(self, tmp_dir: str) -> SQLiteInstance:
+        db_path = Path(tmp_dir, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE images (id TEXT PRIMARY KEY, content_type TEXT NOT NULL, width INTEGER, height INTEGER,
+                    data BLOB NOT NULL);
+                CREATE TABLE product_images (product_id INTEGER PRIMARY KEY, image_id TEXT NOT NULL);
+            """)
+        conn.close()
+        return SQLiteInstance(db_path)
+
+    def test_store(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db = self._db(tmp_dir)
+            image_id = store_image(db, 2001, self.PNG)
+            self.assertEqual(store_image(db, 2002, self.PNG), image_id) # same picture
+            self.assertEqual(db.query("SELECT COUNT(*), content_type FROM images"), [(1, "image/png")])
+            self.assertEqual(product_images(db), {2001: image_id, 2002: image_id})
+            self.assertEqual(load_image(db, image_id), self.PNG)
+            with self.assertRaises(ValueError):
+                store_image(db, 2003, b"<svg/>")
+            self.assertIs(remove_image(db, 2001), SQLCodes.SUCCESS)
+            self.assertEqual(db.query("SELECT COUNT(*) FROM images"), [(1,)]) # still used by 2002
+            remove_image(db, 2002)
+            self.assertIsNone(load_image(db, image_id))
+
+    def test_sizes(self):
+        self.assertEqual([variant_width(width) for width in (1, 160, 161, 5000)], [160, 160, 320, 1280])
+        self.assertEqual(image_url("abc", 300, "jpeg"), "/images/abc/320.jpeg")
+        self.assertTrue(srcset("abc").startswith("/images/abc/160.webp 160w, /images/abc/320.webp 320w"))
+
+    def test_cache_limit(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = VariantCache(tmp_dir, max_bytes=25)
+            for name in ("a", "b", "c"):
+                Path(tmp_dir, name).write_bytes(b"x" * 10)
+                cache.add(name, 10)
+                if name == "b":
+                    self.assertIsNotNone(cache.get("a")) # 'a' used: 'b' is the least recent now
+            self.assertIsNone(cache.get("b"))
+            self.assertFalse(Path(tmp_dir, "b").exists())
+            self.assertEqual((cache.size, sorted(os.listdir(tmp_dir))), (20, ["a", "c"]))
+            self.assertEqual(VariantCache(tmp_dir, max_bytes=15).size, 10) # restart with a smaller limit
+
+    @unittest.skipUnless(importlib.util.find_spec("PIL"), "Pillow not installed")
+    def test_variants(self):
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 600), "red").save(buffer, "JPEG")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            loaded = threading.Event()
+            loader_threads = []
+
+            def loader(image_id: str) -> bytes:
+                loaded.wait(10)
+                loader_threads.append(threading.current_thread())
+                return {"abc": buffer.getvalue()}.get(image_id)
+
+            variants = ImageVariants(loader, Path(tmp_dir, "cache"), 10 ** 6, workers=1)
+            try:
+                pending = variants.get("abc", 300)
+                self.assertFalse(pending.done()) # the caller (event loop) does not wait for the database
+                loaded.set()
+                file_path = pending.result()
+                self.assertNotIn(threading.current_thread(), loader_threads)
+                with Image.open(file_path) as image:
+                    self.assertEqual((image.format, image.size), ("WEBP", (320, 240)))
+                self.assertEqual(variants.get("abc", 320).result(), file_path)
+                self.assertIsNone(variants.get("unknown", 320).result())
+            finally:
+                variants.close()
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
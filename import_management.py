@@ -0,0 +1,312 @@
+# ACASA Import Management
+# Parallel CSV import: the files of all entities - large files cut into shards at line boundaries - are parsed and
+# validated in a process pool, while a single writer (this process) upserts the validated batches into SQLite. Entities
+# are written in foreign key order (e.g. 'categories' before 'products'), parsing of later entities overlaps writing.
+# Every row is coerced to the column types of its table by a converter function generated ('compiled') once per entity;
+# rows that cannot be converted are written to an error file next to the CSV file ('<name>.rejected.csv').
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
+import io
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+
+from billing_management import to_cents
+from db import ColumnTypes, InvalidMappingException, SQLCodes, SQLiteInstance
+
+DEFAULT_SHARD_BYTES = 8 * 1024 * 1024
+DEFAULT_BATCH_SIZE = 500
+CSV_DELIMITER = "|"
+CSV_QUOTE = "'"  # text values are SQL literals, e.g. 'Drinks' or 'Mamma''s Pizza'
+REJECT_REASON_HEADER = "REJECT_REASON"
+
+
+class _Shard():
+    """Lines of a CSV file whose first byte lies in [start, end); the header line is skipped by the first shard.
+    'columns' describes the CSV fields, s. column_spec().
+    """
+
+    def __init__(self, entity_name: str, file_path: Path, columns: tuple, start: int, end: int):
+        self.entity_name = entity_name
+        self.file_path = file_path
+        self.columns = columns
+        self.start = start
+        self.end = end
+
+
+def plan_shards(entity_name: str, file_path: Path, columns: tuple, shard_bytes: int = DEFAULT_SHARD_BYTES) -> list:
+    size = os.path.getsize(file_path)
+    return [_Shard(entity_name, file_path, columns, start, min(start + shard_bytes, size))
+            for start in range(0, max(size, 1), shard_bytes)]
+
+
+def column_spec(db: SQLiteInstance, entity_name: str, attrs: list) -> tuple:
+    """Types of the CSV fields 'attrs' (e.g. ["ID", "NAME"] from config.yaml 'csv_files') taken from the table schema.
+
+    Returns:
+        tuple: ((attr, ColumnTypes name, nullable), ..) in CSV field order; plain values, so it can be sent to workers.
+    """
+    table_columns = {name.lower(): (col_type, nullable)
+                     for name, col_type, nullable, _ in db.table_columns(entity_name)}
+    spec = []
+    for attr in attrs:
+        if attr.lower() not in table_columns:
+            raise InvalidMappingException("Table '{}' has no column '{}'.".format(entity_name, attr))
+        col_type, nullable = table_columns[attr.lower()]
+        spec.append((attr, col_type.name, nullable))
+    return tuple(spec)
+
+
+def key_columns(db: SQLiteInstance, entity_name: str) -> tuple:
+    return tuple(name for name, _, _, pk_pos in sorted(db.table_columns(entity_name), key=lambda col: col[3])
+                 if pk_pos)
+
+
+# others stay strings; money (e.g. "4.99") is converted to cents exactly: plain amounts with two decimals by an integer
+# split of the text, all others (e.g. "4,99", "-2.5") by to_cents()
+_CONVERSIONS = {ColumnTypes.INTEGER.name: "int({0})", ColumnTypes.REAL.name: "float({0})",
+                ColumnTypes.MONEY.name: "int({0}u + {0}c) if len({0}c) == 2 and {0}u.isdigit() and {0}c.isdigit() "
+                                        "else to_cents({0})"}
+_SPLITS = {ColumnTypes.MONEY.name: "{0}u, _, {0}c = {0}.partition(\".\")"}
+_CONVERTERS = {ColumnTypes.INTEGER.name: int, ColumnTypes.REAL.name: float, ColumnTypes.MONEY.name: to_cents}
+
+
+def _converter_source(columns: tuple, empty_as_null: bool) -> str:
+    fields = ["f{}".format(pos) for pos in range(len(columns))]
+    lines = ["{}, = row".format(", ".join(fields))]
+    values = []
+    for field, (_, type_name, nullable) in zip(fields, columns):
+        if type_name in _SPLITS:
+            lines.append(_SPLITS[type_name].format(field))
+        value = _CONVERSIONS.get(type_name, "{0}").format(field)
+        if empty_as_null and nullable and type_name in _CONVERSIONS:
+            value = "({}) if {} else None".format(value, field)
+        values.append(value)
+    # unpacking raises ValueError on a wrong field count, int()/float()/to_cents() on bad literals
+    lines.append("return ({},)".format(", ".join(values)))
+    return "def convert(row):\n    {}\n".format("\n    ".join(lines))
+
+
+@functools.lru_cache(maxsize=None)  # compiled once per entity and process
+def compile_converters(columns: tuple) -> tuple:
+    """Generate the row converters for a column spec (s. column_spec()), e.g. for products:
+        def convert(row):
+            f0, f1, f2, f3, = row
+            f2u, _, f2c = f2.partition(".")
+            return (int(f0), f1, int(f2u + f2c) if len(f2c) == 2 and f2u.isdigit() and f2c.isdigit() else to_cents(f2),
+                    int(f3),)
+    The first one ('fast') assumes a complete row, the second one ('careful') also maps empty fields of nullable
+    numeric columns to None; it is only used for batches in which the fast one failed.
+
+    Returns:
+        tuple: (fast, careful) converter functions: list of CSV fields => tuple of typed values
+    """
+    converters = []
+    for empty_as_null in (False, True):
+        namespace = {"to_cents": to_cents}
+        exec(_converter_source(columns, empty_as_null), namespace)
+        converters.append(namespace["convert"])
+    return tuple(converters)
+
+
+def _reject_reason(columns: tuple, fields: list) -> str:
+    if len(fields) != len(columns):
+        return "expected {} fields, got {}".format(len(columns), len(fields))
+    for (attr, type_name, nullable), field in zip(columns, fields):
+        if type_name not in _CONVERSIONS:
+            continue
+        if not field:
+            if not nullable:
+                return "{}: value missing".format(attr)
+            continue
+        try:
+            _CONVERTERS[type_name](field)
+        except ValueError:
+            return "{}: not a valid {} value ({})".format(attr, type_name, field)
+    return "unknown"
+
+
+def _read_shard_text(shard: _Shard) -> str:
+    with open(shard.file_path, mode="rb") as csv_file:
+        if shard.start == 0:
+            while not csv_file.readline().strip() and csv_file.tell() < shard.end:
+                pass  # blank lines before, then the headers
+        else:
+            csv_file.seek(shard.start - 1)
+            csv_file.readline()  # rest of a line that belongs to the previous shard (or just its line break)
+        start = csv_file.tell()
+        if start >= shard.end:
+            return ""
+        data = csv_file.read(shard.end - start)
+        data += csv_file.readline()  # complete the last line
+    return data.decode("UTF-8")
+
+
+def parse_shard(shard: _Shard) -> tuple:
+    """Worker function: parse, validate and convert one shard in a single pass.
+
+    Returns:
+        tuple: (rows as tuples of typed values in CSV field order, rejected rows as (fields, reason))
+    """
+    fast, careful = compile_converters(shard.columns)
+    text = _read_shard_text(shard).rstrip("\r\n")  # trailing empty lines
+    try:
+        return list(map(fast, csv.reader(io.StringIO(text), delimiter=CSV_DELIMITER, quotechar=CSV_QUOTE))), []
+    except (ValueError, TypeError):
+        pass  # at least one bad, incomplete or empty row: parse again and convert row by row
+    valid, rejected = [], []
+    for fields in csv.reader(io.StringIO(text), delimiter=CSV_DELIMITER, quotechar=CSV_QUOTE):
+        if not fields:
+            continue  # empty line
+        try:
+            valid.append(careful(fields))
+        except (ValueError, TypeError):
+            rejected.append((fields, _reject_reason(shard.columns, fields)))
+    return valid, rejected
+
+
+def dependency_order(db: SQLiteInstance, entity_names: list) -> list:
+    """Sort tables so that referenced tables (foreign keys) come first; references to tables outside the list are
+    ignored.
+    """
+    parents = {}
+    for entity_name in entity_names:
+        fk_list = db.query("PRAGMA foreign_key_list({})".format(entity_name))
+        parents[entity_name] = {fk[2] for fk in fk_list if fk[2] in entity_names and fk[2] != entity_name} \
+            if isinstance(fk_list, list) else set()
+    ordered = []
+    while len(ordered) < len(entity_names):
+        ready = [name for name in entity_names if name not in ordered and parents[name] <= set(ordered)]
+        if not ready:
+            raise RuntimeError("Cyclic foreign keys between: {}".format(set(entity_names) - set(ordered)))
+        ordered.extend(ready)
+    return ordered
+
+
+def reject_file_path(file_path: Path) -> Path:
+    return Path(file_path).with_suffix(".rejected.csv")
+
+
+def _write_rejects(reject_path: Path, attrs: list, rejected: list):
+    # Same format as the imported file plus the reason, so rows can be corrected and the file re-imported
+    with open(reject_path, mode="a", encoding="UTF-8", newline="") as reject_file:
+        writer = csv.writer(reject_file, delimiter=CSV_DELIMITER, quotechar=CSV_QUOTE, lineterminator="\n")
+        if reject_file.tell() == 0:
+            writer.writerow(list(attrs) + [REJECT_REASON_HEADER])
+        writer.writerows(list(fields) + [reason] for fields, reason in rejected)
+
+
+def import_files(db: SQLiteInstance, files: dict, workers: int = 1, batch_size: int = DEFAULT_BATCH_SIZE,
+                 shard_bytes: int = DEFAULT_SHARD_BYTES) -> list:
+    """Import CSV files, parsing in 'workers' processes and writing from this process only.
+
+    Args:
+        db (SQLiteInstance): Target database.
+        files (dict): {entity_name: (attrs, file_path)}, e.g. {"products": (["ID", "NAME", ..], Path("products.csv"))}
+        workers (int, optional): Parser processes; 1 parses in this process. Defaults to 1.
+        batch_size (int, optional): Rows per write transaction. Defaults to DEFAULT_BATCH_SIZE.
+        shard_bytes (int, optional): Files larger than this are parsed in several shards.
+
+    Returns:
+        list: One summary per entity (in write order), e.g. {"table": "products", "rows": 8, "batches": 1,
+              "rejected": 0, "reject_file": None, "errors": []}
+    """
+    order = dependency_order(db, list(files.keys()))
+    columns = {name: column_spec(db, name, files[name][0]) for name in order}
+    shards = {name: plan_shards(name, files[name][1], columns[name], shard_bytes) for name in order}
+    if workers > 1:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # submitted in write order, so the shards needed first are parsed first
+        results = {name: [pool.submit(parse_shard, shard) for shard in shards[name]] for name in order}
+        get_result = lambda future: future.result()
+    else:
+        pool = None
+        results = {name: shards[name] for name in order}
+        get_result = parse_shard
+    summaries = []
+    try:
+        for name in order:
+            attrs, file_path = files[name]
+            keys = key_columns(db, name)
+            reject_path = reject_file_path(file_path)
+            reject_path.unlink(missing_ok=True)  # from an earlier import
+            summary = {"table": name, "rows": 0, "batches": 0, "rejected": 0, "reject_file": None, "errors": []}
+            for shard_result in results[name]:  # shard order = file order
+                valid, rejected = get_result(shard_result)
+                if rejected:
+                    _write_rejects(reject_path, attrs, rejected)
+                    summary["rejected"] += len(rejected)
+                    summary["reject_file"] = str(reject_path)
+                for start in range(0, len(valid), batch_size):
+                    res_code = db.upsert_many(name, attrs, valid[start:start + batch_size], keys)
+                    summary["batches"] += 1
+                    if res_code is not SQLCodes.SUCCESS:
+                        summary["errors"].append(str(res_code))
+                summary["rows"] += len(valid)
+            summaries.append(summary)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    return summaries
+
+
+class UnitTestImport(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT NOT NULL, price MONEY, category_id INTEGER,
+                    FOREIGN KEY (category_id) REFERENCES categories(id));
+            """)
+        conn.close()
+        self.db = SQLiteInstance(db_path)
+        self.files = {"products": (["ID", "NAME", "PRICE", "CATEGORY_ID"], Path(self._tmp_dir.name, "products.csv")),
+                      "categories": (["ID", "NAME"], Path(self._tmp_dir.name, "categories.csv"))}
+        self.files["categories"][1].write_text("\nID|NAME\n1000|'Drinks'\n2000|'Mamma''s Pizzas'\n")
+        self.files["products"][1].write_text("ID|NAME|PRICE|CATEGORY_ID\n1001|'Water'|0.99|1000\n"
+                                             "1002|'Lemonade'||1000\n1003|'Bad price'|abc|1000\n"
+                                             "|'No key'|1.00|1000\n2001|'Margarita'|4.99\n2002|'Tonno'|7.99|2000\n\n")
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_typed_import(self):
+        for workers in (1, 2):
+            summaries = import_files(self.db, self.files, workers=workers, batch_size=2, shard_bytes=40)
+            self.assertEqual([summary["table"] for summary in summaries], ["categories", "products"])
+            self.assertEqual([summary["rows"] for summary in summaries], [2, 3])
+            self.assertEqual([summary["errors"] for summary in summaries], [[], []])
+        self.assertEqual(self.db.query("SELECT id, name FROM categories ORDER BY id"),
+                         [(1000, "Drinks"), (2000, "Mamma's Pizzas")])
+        self.assertEqual(self.db.query("SELECT id, name, price, typeof(price), category_id FROM products ORDER BY id"),
+                         [(1001, "Water", 99, "integer", 1000), (1002, "Lemonade", None, "null", 1000),
+                          (2002, "Tonno", 799, "integer", 2000)])
+
+    def test_money_conversion(self):
+        fast, careful = compile_converters((("ID", "INTEGER", False), ("PRICE", "MONEY", True)))
+        self.assertEqual([fast(["1", price])[1] for price in ("4.99", "0.05", "12", "-2.50", "4,99", "1.005", ".5")],
+                         [499, 5, 1200, -250, 499, 101, 50])
+        self.assertEqual(careful(["1", ""]), (1, None))
+        for price in ("", "4.-9", "abc"):
+            with self.assertRaises(ValueError):
+                fast(["1", price])
+
+    def test_rejected_rows(self):
+        summary = import_files(self.db, self.files)[1]
+        self.assertEqual(summary["rejected"], 3)
+        with open(summary["reject_file"], encoding="UTF-8") as reject_file:
+            reasons = [row[-1] for row in csv.reader(reject_file, delimiter=CSV_DELIMITER, quotechar=CSV_QUOTE)]
+        self.assertEqual(reasons, [REJECT_REASON_HEADER, "PRICE: not a valid MONEY value (abc)", "ID: value missing",
+                                   "expected 4 fields, got 3"])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -0,0 +1,462 @@
+# ACASA Job Management
+# Long-running work (receipts, exports, imports) does not run in the web or order process: it is enqueued into a durable
+# queue - a SQLite file of its own, e.g. 'jobs.db3' - and executed by worker processes, started as a 'batch' container
+# (s. acasa_web_1/application.yml) or by 'main.py jobs run'. Every queue has a fixed number of workers (concurrency
+# limit); failed jobs are retried with exponential backoff, jobs of crashed workers are handed out again after their
+# lease expired. Wait and run times are kept per job, s. JobQueue.metrics().
+import importlib
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import unittest
+
+import yaml
+
+SCRIPT_PATH = Path(__file__).parent.resolve()
+CONFIG_FILE = SCRIPT_PATH / "config.yaml"
+
+DEFAULT_QUEUE = "default"
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_BACKOFF = 5.0  # seconds before the 1st retry, doubled for every further one
+DEFAULT_LEASE = 600.0  # seconds a job may run before it is considered lost (worker crashed)
+DEFAULT_POLL_INTERVAL = 0.5  # seconds
+
+# Job kind => handler ('module:function', imported in the worker only) and queue; extended by the configuration
+JOB_HANDLERS = {
+    "receipt": "job_management:receipt_job",
+    "export": "job_management:export_job",
+    "import": "job_management:import_job"
+}
+JOB_QUEUES = {
+    "receipt": "receipts",
+    "export": "exports",
+    "import": "imports"
+}
+
+
+class JobStatus():
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+_JOBS_DDL = ["""CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    worker TEXT,
+    result TEXT,
+    error TEXT
+)""", "CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (queue, status, not_before, id)"]
+
+_CLAIM_SQL = """SELECT id FROM jobs WHERE queue = ? AND status = 'queued' AND not_before <= ?
+                AND attempts < max_attempts
+            ORDER BY id LIMIT 1"""
+
+# the job is still running on behalf of the claiming worker, s. complete(), fail()
+_OWNED_SQL = "id = ? AND status = 'running' AND worker = ? AND started_at = ?"
+
+_METRICS_SQL = """SELECT kind, status, COUNT(*), AVG(started_at - enqueued_at), AVG(finished_at - started_at),
+                MAX(finished_at - started_at), AVG(attempts)
+            FROM jobs
+            WHERE status IN ('done', 'failed') AND finished_at >= ?
+            GROUP BY kind, status
+            ORDER BY kind, status"""
+
+_COLUMNS = ("id", "queue", "kind", "payload", "status", "attempts", "max_attempts", "not_before", "enqueued_at",
+            "started_at", "finished_at", "worker", "result", "error")
+
+
+def _owner(job: dict) -> tuple:
+    return job["id"], job["worker"], job["started_at"]
+
+
+class JobQueue():
+    """Durable job queue in a SQLite file; can be used by any number of processes at the same time.
+    Args:
+        queue_file (Path): The SQLite file, created if missing.
+    """
+
+    def __init__(self, queue_file: Path):
+        self._queue_file = queue_file
+        # autocommit; transactions are explicit (BEGIN IMMEDIATE), s. claim()
+        self._conn = sqlite3.connect(queue_file, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")  # enqueueing never waits for readers
+        self._lock = threading.Lock()
+        for ddl in _JOBS_DDL:
+            self._conn.execute(ddl)
+
+    def close(self):
+        self._conn.close()
+
+    def enqueue(self, kind: str, payload: dict = None, queue: str = None, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                delay: float = 0.0) -> int:
+        """Add a job; returns its id. 'payload' must be JSON serializable (handlers run in other processes).
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO jobs (queue, kind, payload, status, max_attempts, not_before, enqueued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (queue or JOB_QUEUES.get(kind, DEFAULT_QUEUE), kind, json.dumps(payload or {}), JobStatus.QUEUED,
+                 max_attempts, now + delay, now))
+            return cur.lastrowid
+
+    def claim(self, queue: str, worker: str):
+        """Hand the next due job of 'queue' to 'worker' (status 'running'); None if there is none.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")  # write lock: no two workers get the same job
+            try:
+                row = self._conn.execute(_CLAIM_SQL, (queue, now)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET status = ?, worker = ?, started_at = ?, "
+                                       "attempts = attempts + 1 WHERE id = ?", (JobStatus.RUNNING, worker, now, row[0]))
+                self._conn.execute("COMMIT")
+            except sqlite3.DatabaseError:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None if row is None else self.job(row[0])
+
+    def complete(self, job: dict, result=None) -> bool:
+        """Mark a claimed job as done; False if the worker has lost it meanwhile (lease expired, s. requeue_lost()),
+        then the result is dropped.
+        """
+        with self._lock:
+            cur = self._conn.execute("UPDATE jobs SET status = ?, finished_at = ?, result = ?, error = NULL "
+                                     "WHERE " + _OWNED_SQL, (JobStatus.DONE, time.time(),
+                                                             json.dumps(result, default=str), *_owner(job)))
+            return cur.rowcount == 1
+
+    def fail(self, job: dict, error: str, retry_backoff: float = DEFAULT_RETRY_BACKOFF, retry: bool = True) -> bool:
+        """Requeue a job that raised an error - delayed by 'retry_backoff' * 2^(attempts - 1) - or mark it as failed
+        if it has no attempts left (or 'retry' is False). False if the worker has lost the job meanwhile.
+        """
+        with self._lock:
+            return self._fail(job, error, retry_backoff, retry, time.time())
+
+    def _fail(self, job: dict, error: str, retry_backoff: float, retry: bool, now: float) -> bool:
+        if retry and job["attempts"] < job["max_attempts"]:
+            cur = self._conn.execute("UPDATE jobs SET status = ?, not_before = ?, error = ? WHERE " + _OWNED_SQL,
+                                     (JobStatus.QUEUED, now + retry_backoff * 2 ** (job["attempts"] - 1), error,
+                                      *_owner(job)))
+        else:
+            cur = self._conn.execute("UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE " + _OWNED_SQL,
+                                     (JobStatus.FAILED, now, error, *_owner(job)))
+        return cur.rowcount == 1
+
+    def requeue_lost(self, lease: float = DEFAULT_LEASE, retry_backoff: float = DEFAULT_RETRY_BACKOFF) -> int:
+        """Jobs running longer than 'lease' seconds are assumed lost (worker died) and handled like failed ones (s.
+        fail()): queued again if they have attempts left, otherwise marked as failed - a job that kills its worker
+        is not retried forever. Returns the number of lost jobs.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT id, attempts, max_attempts, worker, started_at FROM jobs "
+                                          "WHERE status = ? AND started_at < ?",
+                                          (JobStatus.RUNNING, now - lease)).fetchall()
+                for row in rows:
+                    self._fail(dict(zip(("id", "attempts", "max_attempts", "worker", "started_at"), row)),
+                               "lease expired", retry_backoff, True, now)
+                self._conn.execute("COMMIT")
+            except sqlite3.DatabaseError:
+                self._conn.execute("ROLLBACK")
+                raise
+            return len(rows)
+
+    def job(self, job_id: int) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT {} FROM jobs WHERE id = ?".format(",".join(_COLUMNS)),
+                                     (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(_COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = None if job["result"] is None else json.loads(job["result"])
+        return job
+
+    def pending(self) -> dict:
+        """Number of queued and running jobs per queue, e.g. {"receipts": {"queued": 12, "running": 2}}.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT queue, status, COUNT(*) FROM jobs WHERE status IN (?, ?) "
+                                      "GROUP BY queue, status", (JobStatus.QUEUED, JobStatus.RUNNING)).fetchall()
+        pending = {}
+        for queue, status, cnt in rows:
+            pending.setdefault(queue, {JobStatus.QUEUED: 0, JobStatus.RUNNING: 0})[status] = cnt
+        return pending
+
+    def metrics(self, since: float = 0.0) -> list:
+        """Timings of the jobs finished since 'since' (epoch seconds) per kind and status, e.g.
+        {"kind": "receipt", "status": "done", "jobs": 120, "avg_wait": 0.4, "avg_run": 0.05, "max_run": 0.3,
+         "avg_attempts": 1.0}
+        """
+        with self._lock:
+            rows = self._conn.execute(_METRICS_SQL, (since,)).fetchall()
+        return [dict(zip(("kind", "status", "jobs", "avg_wait", "avg_run", "max_run", "avg_attempts"), row))
+                for row in rows]
+
+    def purge(self, older_than: float) -> int:
+        """Delete finished jobs older than 'older_than' seconds.
+        """
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                                      (JobStatus.DONE, JobStatus.FAILED, time.time() - older_than)).rowcount
+
+
+_handler_cache = {}
+
+
+def resolve_handler(handler_path: str):
+    if handler_path not in _handler_cache:
+        module_name, function_name = handler_path.split(":")
+        _handler_cache[handler_path] = getattr(importlib.import_module(module_name), function_name)
+    return _handler_cache[handler_path]
+
+
+def work(queue_file: Path, queue: str, handlers: dict, stop_event, worker: str = None,
+         poll_interval: float = DEFAULT_POLL_INTERVAL, retry_backoff: float = DEFAULT_RETRY_BACKOFF):
+    """Worker (process) main loop: run the jobs of one queue until 'stop_event' is set.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the pool, which lets the current job finish
+    worker = worker or "{}-{}".format(queue, os.getpid())
+    jobs = JobQueue(queue_file)
+    try:
+        while not stop_event.is_set():
+            job = jobs.claim(queue, worker)
+            if job is None:
+                stop_event.wait(poll_interval)
+                continue
+            if job["kind"] not in handlers:
+                jobs.fail(job, "no handler for job kind '{}'".format(job["kind"]), retry=False)
+                continue
+            try:
+                jobs.complete(job, resolve_handler(handlers[job["kind"]])(job["payload"]))
+            except Exception:
+                jobs.fail(job, traceback.format_exc(limit=5), retry_backoff)
+    finally:
+        jobs.close()
+
+
+class JobWorkerPool():
+    """Worker processes for the queues, e.g. {"receipts": 2, "exports": 1}: at most that many jobs of a queue run at
+    the same time. Processes are spawned (not forked), so they start without the state of the web process.
+    """
+
+    def __init__(self, queue_file: Path, queues: dict, handlers: dict = None,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, retry_backoff: float = DEFAULT_RETRY_BACKOFF,
+                 lease: float = DEFAULT_LEASE):
+        self.queue_file = Path(queue_file)
+        self._queues = queues
+        self._handlers = {**JOB_HANDLERS, **(handlers or {})}
+        self._poll_interval = poll_interval
+        self._retry_backoff = retry_backoff
+        self._lease = lease
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+        self._processes = {}  # worker name => process
+
+    def _spawn(self, queue: str, worker: str):
+        process = self._context.Process(target=work, name=worker, daemon=True,
+                                        args=(self.queue_file, queue, self._handlers, self._stop_event, worker,
+                                              self._poll_interval, self._retry_backoff))
+        process.start()
+        self._processes[worker] = (queue, process)
+
+    def start(self):
+        JobQueue(self.queue_file).close()  # create the schema once, before the workers race for it
+        for queue, worker_cnt in self._queues.items():
+            for cnt in range(worker_cnt):
+                self._spawn(queue, "{}-{}".format(queue, cnt + 1))
+        return self
+
+    def supervise(self) -> int:
+        """Requeue jobs of lost workers and restart dead worker processes; returns the number of requeued jobs.
+        Call periodically, e.g. from run_forever().
+        """
+        queue = JobQueue(self.queue_file)
+        try:
+            requeued = queue.requeue_lost(self._lease, self._retry_backoff)
+        finally:
+            queue.close()
+        for worker, (queue, process) in list(self._processes.items()):
+            if not process.is_alive() and not self._stop_event.is_set():
+                self._spawn(queue, worker)
+        return requeued
+
+    def run_forever(self, supervise_interval: float = 10.0):
+        try:
+            while not self._stop_event.wait(supervise_interval):
+                self.supervise()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self, timeout: float = 30.0):
+        """Let the workers finish their current job, then end them.
+        """
+        self._stop_event.set()
+        for queue, process in self._processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._processes = {}
+
+
+def create_pool(config: dict, root_path: Path = SCRIPT_PATH) -> JobWorkerPool:
+    """Build a pool from a configuration like config.yaml 'job_management'; relative paths start at 'root_path'.
+    """
+    return JobWorkerPool(Path(root_path, config["queue_file"]), config["queues"], config.get("handlers"),
+                         config.get("poll_interval_seconds", DEFAULT_POLL_INTERVAL),
+                         config.get("retry_backoff_seconds", DEFAULT_RETRY_BACKOFF),
+                         config.get("lease_seconds", DEFAULT_LEASE))
+
+
+def init(config: dict = None, **externals) -> JobWorkerPool:
+    """Entry point of the 'batch' container, s. load_modules() in acasa_web_1/main.py: starts the workers. Paths in
+    'config' are relative to the working directory of the container, without 'config', config.yaml is used.
+    """
+    if config is None:
+        return create_pool(_acasa_config()["job_management"]).start()
+    return create_pool(config, Path.cwd()).start()
+
+
+# Handlers of the built-in job kinds; they run in the worker processes and read config.yaml themselves.
+
+_acasa = {}
+
+
+def _acasa_config() -> dict:
+    if "config" not in _acasa:
+        with open(CONFIG_FILE, mode="r", encoding="UTF-8") as config_file:
+            _acasa["config"] = yaml.safe_load(config_file)
+    return _acasa["config"]
+
+
+def _acasa_db():
+    if "db" not in _acasa:
+        from db import create_proxy
+        _acasa["db"] = create_proxy(Path(SCRIPT_PATH, _acasa_config()["database"]["file_name"]))
+    return _acasa["db"]
+
+
+def receipt_job(payload: dict) -> list:
+    """payload: {"order_ids": [17, 18]} or {"order_id": 17}; renders PDF receipts, s. output_management.py.
+    """
+    from billing_management import vat_basis_points
+    import output_management as OUTPUT_MGMT
+    config = _acasa_config()
+    order_ids = payload.get("order_ids") or [payload["order_id"]]
+    output_cfg = config["output_management"]
+    return OUTPUT_MGMT.render_receipts(
+        OUTPUT_MGMT.receipt_data(_acasa_db(), order_ids),
+        Path(SCRIPT_PATH, output_cfg["output_file_directory"], OUTPUT_MGMT.RECEIPT_DIRECTORY),
+        output_cfg.get("font_file"), output_cfg.get("receipt_title", "ACASA"), output_cfg.get("receipt_footer", ""),
+        config["billing"]["currency"], vat_basis_points(config["billing"]))
+
+
+def export_job(payload: dict) -> dict:
+    """payload: {} (exports the orders added since the last export)
+    """
+    import export_management as EXPORT_MGMT
+    return EXPORT_MGMT.export_orders(_acasa_db(), _acasa_config()["export_management"])
+
+
+def import_job(payload: dict) -> list:
+    """payload: {"tables": ["products"], "workers": 2}; tables default to all of config.yaml 'csv_files'.
+    """
+    import import_management as IMPORT_MGMT
+    entities = _acasa_config()["csv_files"]
+    files = {name: (entities[name], Path(SCRIPT_PATH, "{}.csv".format(name)))
+             for name in payload.get("tables") or entities.keys()}
+    return IMPORT_MGMT.import_files(_acasa_db(), files, workers=payload.get("workers", 1))
+
+
+def _test_job(payload: dict) -> dict:
+    if payload.get("fail"):
+        raise ValueError("failed on purpose")
+    time.sleep(payload.get("sleep", 0))
+    return {"echo": payload.get("value")}
+
+
+class UnitTestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.queue_file = Path(self._tmp_dir.name, "jobs.db3")
+        self.jobs = JobQueue(self.queue_file)
+
+    def tearDown(self):
+        self.jobs.close()
+        self._tmp_dir.cleanup()
+
+    def test_claim_complete(self):
+        first = self.jobs.enqueue("test", {"value": 1}, queue="q")
+        self.jobs.enqueue("test", {"value": 2}, queue="q", delay=60)  # not due yet
+        job = self.jobs.claim("q", "w1")
+        self.assertEqual((job["id"], job["status"], job["attempts"], job["payload"]),
+                         (first, "running", 1, {"value": 1}))
+        self.assertIsNone(self.jobs.claim("q", "w2"))
+        self.assertEqual(self.jobs.pending(), {"q": {"queued": 1, "running": 1}})
+        self.assertTrue(self.jobs.complete(job, {"echo": 1}))
+        self.assertEqual(self.jobs.job(first)["result"], {"echo": 1})
+        self.assertEqual([(m["kind"], m["status"], m["jobs"]) for m in self.jobs.metrics()], [("test", "done", 1)])
+
+    def test_retry_and_lease(self):
+        job_id = self.jobs.enqueue("test", queue="q", max_attempts=2)
+        self.jobs.fail(self.jobs.claim("q", "w1"), "error 1", retry_backoff=0)
+        self.assertEqual(self.jobs.job(job_id)["status"], "queued")
+        self.jobs.fail(self.jobs.claim("q", "w1"), "error 2", retry_backoff=0)
+        self.assertEqual((self.jobs.job(job_id)["status"], self.jobs.job(job_id)["error"]), ("failed", "error 2"))
+        lost_id = self.jobs.enqueue("test", queue="q", max_attempts=2)
+        lost = self.jobs.claim("q", "w1")
+        self.assertEqual(self.jobs.requeue_lost(lease=0, retry_backoff=0), 1)
+        self.assertFalse(self.jobs.complete(lost, {"echo": 1}))  # lease lost: w1 must not finish it
+        self.assertEqual(self.jobs.claim("q", "w1")["id"], lost_id)  # same worker name (restarted), new lease
+        self.assertFalse(self.jobs.fail(lost, "late error"))
+        self.assertEqual(self.jobs.requeue_lost(lease=0, retry_backoff=0), 1)  # 2nd attempt lost: dead letter
+        self.assertEqual((self.jobs.job(lost_id)["status"], self.jobs.job(lost_id)["error"]),
+                         ("failed", "lease expired"))
+        self.assertIsNone(self.jobs.claim("q", "w2"))
+
+    def test_worker_processes(self):
+        ids = [self.jobs.enqueue("test", {"value": cnt, "sleep": 0.1}, queue="q") for cnt in range(4)]
+        failing_id = self.jobs.enqueue("test", {"fail": True}, queue="q", max_attempts=1)
+        unknown_id = self.jobs.enqueue("unknown", queue="q")
+        pool = JobWorkerPool(self.queue_file, {"q": 2}, {"test": "job_management:_test_job"},
+                             poll_interval=0.05).start()
+        try:
+            deadline = time.time() + 30
+            while self.jobs.pending() and time.time() < deadline:
+                time.sleep(0.1)
+        finally:
+            pool.stop()
+        self.assertEqual([self.jobs.job(job_id)["result"] for job_id in ids], [{"echo": cnt} for cnt in range(4)])
+        self.assertIn("failed on purpose", self.jobs.job(failing_id)["error"])
+        self.assertEqual(self.jobs.job(unknown_id)["status"], "failed")
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
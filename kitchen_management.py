@@ -0,0 +1,146 @@
+# ACASA Kitchen Management
+# The kitchen display shows the open orders, oldest first, with their items. Orders are open while their status is below
+# ORDER_SERVED; the partial index 'orders_open' (s. products_db.sql) holds only those rows, so the queue is read without
+# touching the ever growing history of served orders. A screen loads the queue once and afterwards asks for the orders
+# changed since the change log sequence number it has seen (s. change_management.py), so a refresh costs O(changes),
+# not O(open orders).
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+
+from db import DataObject, DbAccessException, SQLCode, SQLiteInstance
+
+ORDER_NEW = 0
+ORDER_PREPARING = 1
+ORDER_READY = 2
+ORDER_SERVED = 3
+ORDER_CANCELLED = 4
+STATUS_NAMES = {ORDER_NEW: "new", ORDER_PREPARING: "preparing", ORDER_READY: "ready", ORDER_SERVED: "served",
+                ORDER_CANCELLED: "cancelled"}
+KITCHEN_TABLES = ["orders", "order_items"]
+
+# The condition must match the one of the partial index literally, else SQLite cannot use the index
+_OPEN_ORDERS_SQL = """SELECT o.id, o.customer, o.status, o.order_date, i.item_id, p.name, i.amount
+            FROM orders o LEFT JOIN order_items i ON i.order_id = o.id LEFT JOIN products p ON p.id = i.item_id
+            WHERE o.status < {} ORDER BY o.id, i.item_id""".format(ORDER_SERVED)
+
+_ORDERS_SQL = """SELECT o.id, o.customer, o.status, o.order_date, i.item_id, p.name, i.amount
+            FROM orders o LEFT JOIN order_items i ON i.order_id = o.id LEFT JOIN products p ON p.id = i.item_id
+            WHERE o.id IN ({}) ORDER BY o.id, i.item_id"""
+
+# First sequence number still in the change log (the log may have been pruned, s. change_management.py)
+_FIRST_SEQ_SQL = """SELECT COALESCE((SELECT MIN(seq) FROM change_log),
+            (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'change_log'), 1)"""
+
+_LAST_SEQ_SQL = "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'change_log'), 0)"
+
+
+def _query(db: SQLiteInstance, sql: str, params: tuple = ()) -> list:
+    res = db.query(sql, params)
+    if isinstance(res, Exception):
+        raise DbAccessException("Kitchen queue could not be read: {}".format(res))
+    return res
+
+
+def _orders(rows: list) -> list:
+    orders = []
+    for order_id, customer, status, order_date, item_id, name, amount in rows: # sorted by order
+        if not orders or orders[-1]["id"] != order_id:
+            orders.append({"id": order_id, "customer": customer, "status": status,
+                           "status_name": STATUS_NAMES.get(status, str(status)), "order_date": order_date,
+                           "items": []})
+        if item_id is not None:
+            orders[-1]["items"].append({"id": item_id, "name": name, "amount": amount})
+    return orders
+
+
+def kitchen_queue(db: SQLiteInstance, since: int = None, limit: int = 1000) -> dict:
+    """The open orders (since=None), or what changed after the sequence number 'since' of an earlier result.
+
+    Args:
+        db (SQLiteInstance): Database with the change log enabled for 'orders' and 'order_items'.
+        since (int, optional): 'seq' of the previous result of the screen.
+        limit (int, optional): With more changes than this, the whole queue is returned instead.
+
+    Returns:
+        dict: E.g. {"seq": 812, "full": False, "orders": [{"id": 5, "customer": "Joe", "status": 1, "status_name":
+              "preparing", "order_date": "2023-02-24", "items": [{"id": 2001, "name": "Pizza", "amount": 2}]}],
+              "removed": [3]} - with "full" the orders replace the screen's queue, otherwise they replace the orders
+              with the same ID; "removed" are orders no longer open.
+    """
+    if since is not None and since + 1 >= _query(db, _FIRST_SEQ_SQL)[0][0]:
+        changes = db.changes(since, limit, KITCHEN_TABLES)
+        if len(changes) < limit:
+            order_ids = sorted({change["key"]["id"] if change["table"] == "orders" else change["key"]["order_id"]
+                                for change in changes})
+            orders = _orders(_query(db, _ORDERS_SQL.format(",".join(["?"] * len(order_ids))), tuple(order_ids))) \
+                if order_ids else []
+            open_orders = [order for order in orders if order["status"] < ORDER_SERVED]
+            open_ids = {order["id"] for order in open_orders}
+            return {"seq": changes[-1]["seq"] if changes else since, "full": False, "orders": open_orders,
+                    "removed": [order_id for order_id in order_ids if order_id not in open_ids]}
+    seq = _query(db, _LAST_SEQ_SQL)[0][0] # before the read: later changes are delivered (again) next time
+    return {"seq": seq, "full": True, "orders": _orders(_query(db, _OPEN_ORDERS_SQL)), "removed": []}
+
+
+def set_status(db: SQLiteInstance, order_id: int, status: int):
+    """Returns 1 (0: no such order) or an SQLCode on error; customers and screens learn about it from the change log.
+    """
+    if status not in STATUS_NAMES:
+        raise ValueError("Unknown order status: {}".format(status))
+    return db.update(DataObject("orders", {"id": order_id, "status": status}, {"id"}))
+
+
+class UnitTestKitchen(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript(Path(Path(__file__).parent, "products_db.sql").read_text(encoding="UTF-8"))
+            conn.execute("INSERT INTO products (id, name, price, category_id) VALUES (2001, 'Pizza Margarita', 499, 2)")
+            conn.executemany("INSERT INTO orders (id, customer, status, order_date) VALUES (?, ?, ?, '2023-02-24')",
+                             [(1, "Ann", ORDER_SERVED), (2, "Joe", ORDER_NEW), (3, "Bob", ORDER_PREPARING)])
+            conn.executemany("INSERT INTO order_items (order_id, item_id, amount) VALUES (?, 2001, ?)",
+                             [(1, 1), (2, 2), (3, 1)])
+        conn.close()
+        self.db = SQLiteInstance(db_path)
+        self.db.enable_change_log(KITCHEN_TABLES)
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_queue(self):
+        plan = self.db.query("EXPLAIN QUERY PLAN " + _OPEN_ORDERS_SQL)
+        self.assertIn("USING INDEX orders_open", plan[0][3])
+        queue = kitchen_queue(self.db)
+        self.assertEqual((queue["seq"], queue["full"]), (0, True))
+        self.assertEqual([(order["id"], order["status_name"], order["items"]) for order in queue["orders"]],
+                         [(2, "new", [{"id": 2001, "name": "Pizza Margarita", "amount": 2}]),
+                          (3, "preparing", [{"id": 2001, "name": "Pizza Margarita", "amount": 1}])])
+        self.assertEqual(kitchen_queue(self.db, queue["seq"])["orders"], [])
+
+    def test_incremental(self):
+        seq = kitchen_queue(self.db)["seq"]
+        self.assertEqual(set_status(self.db, 3, ORDER_SERVED), 1)
+        order_id = self.db.insert(DataObject("orders", {"id": None, "customer": "Eve", "order_date": "2023-02-24"},
+                                             {"id"}))
+        self.db.insert(DataObject("order_items", {"order_id": order_id, "item_id": 2001, "amount": 3},
+                                  {"order_id", "item_id"}))
+        update = kitchen_queue(self.db, seq)
+        self.assertEqual((update["full"], [order["id"] for order in update["orders"]], update["removed"]),
+                         (False, [4], [3]))
+        self.assertEqual(update["orders"][0]["items"], [{"id": 2001, "name": "Pizza Margarita", "amount": 3}])
+        self.assertEqual(kitchen_queue(self.db, update["seq"])["seq"], update["seq"])
+        self.assertTrue(kitchen_queue(self.db, seq, limit=2)["full"]) # too many changes
+        self.assertIsInstance(self.db._execute_sql("DELETE FROM change_log"), SQLCode)
+        self.assertTrue(kitchen_queue(self.db, seq)["full"]) # pruned behind the screen
+        with self.assertRaises(ValueError):
+            set_status(self.db, 2, 7)
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -1,35 +1,78 @@
 #!/usr/bin/python
 # -*- coding: UTF-8 -*-
 # Restaurant ACASA client utilities
-from arango import ArangoClient, version as arango_version
+# Importing this module has no side effects: configuration and database are loaded on first use (get_config(),
+# get_db_proxy()), and heavy libraries (arango, uvicorn, reportlab, wx, pyarrow) are imported by the menu option that
+# needs them, so e.g. the DB admin starts without them. Check with the 'prof' option (import-time report).
+import argparse
+from contextlib import contextmanager
 import csv
 import datetime
 import errors as ERR
+import json
 import os
 from pathlib import Path
-import uvicorn
-import yaml
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
 # modules
+import billing_management as BILLING_MGMT
 import license_management as L_M
-import output_management as OUTPUT_MGMT
-import order_management as ORDER_MGMT
-from acasa_admin.admin_gup import start_admin_app
-from db import create_proxy, DataObject
+import translation_management as TRANSL_MGMT
+from db import create_proxy, CHANGE_LOG_TABLE, DataObject, SQLCode, SQLCodes
 
-os.chdir(Path(__file__).parent)
-
-SCRIPT_PATH = Path(__name__).parent.resolve()
+SCRIPT_PATH = Path(__file__).parent.resolve()
 SQL_PATH = Path("{}{}products_db.sql".format(SCRIPT_PATH, os.sep)) # hard-coded
 ACASA_WEB_1_DEPLOYMENT_FOLDER = "acasa_web_1"
 
 # Metadata for CSV-import files: attributes must be in the given list!
 # Format: {table_name => [attribute1, attribute2, etc.]}
 CONFIG_FILE = Path("{}{}config.yaml".format(SCRIPT_PATH, os.sep))
+TRANSLATIONS_FILE = Path("{}{}translations.json".format(SCRIPT_PATH, os.sep))
 
 def show_environment():
-    print("Arango: ", arango_version)
+    try:
+        from arango import version as arango_version
+        print("Arango: ", arango_version)
+    except ImportError:
+        print("Arango: not installed")
     print("CSV: ", csv.__version__)
 
+# Modules reported by profile_imports(): the CLI itself and what its features pull in
+IMPORT_PROFILE_TARGETS = ["main", "db", "arango_pool", "order_management", "output_management", "export_management", 
+                          "web", "uvicorn", "acasa_admin.admin_gup"]
+
+def _import_times(statement: str) -> list:
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], 
+                          cwd=SCRIPT_PATH, capture_output=True, text=True)
+    timings = [] # (self_us, name)
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        timings.append((int(self_us), name.strip()))
+    if proc.returncode != 0:
+        raise ImportError((proc.stderr.strip().splitlines() or ["?"])[-1])
+    return timings
+
+def profile_imports(modules: list = None, top: int = 8):
+    """Import each module in a fresh interpreter with '-X importtime' and print what it adds to the interpreter's
+    startup: total import time and the most expensive single imports (self time).
+    """
+    startup = {name for self_us, name in _import_times("pass")}
+    for module in modules or IMPORT_PROFILE_TARGETS:
+        try:
+            timings = [timing for timing in _import_times("import {}".format(module)) if timing[1] not in startup]
+        except ImportError as imp_err:
+            print("{:<24} not importable: {}".format(module, imp_err))
+            continue
+        total_us = sum(self_us for self_us, name in timings)
+        print("{:<24} {:>8.1f} ms ({} modules)".format(module, total_us / 1000, len(timings)))
+        for self_us, name in sorted(timings, reverse=True)[:top]:
+            print("{:<24} {:>8.1f} ms   {}".format("", self_us / 1000, name))
+
 # load config.yaml 
 def load_config() -> dict:
     """ Load the menu from a YAML file.
@@ -40,6 +83,7 @@ def load_config() -> dict:
     Returns:
         dict: The configuration as dict.
     """
+    import yaml
     with open(CONFIG_FILE, mode = "r", encoding = "UTF-8") as openfile:
         cfg_text = openfile.read()
         config = yaml.safe_load(cfg_text)
@@ -47,9 +91,23 @@ def load_config() -> dict:
             raise ERR.LicenseError("Your license has probably expired.. :-)")
     return config
 
+# Databases created with prices as REAL are converted to cents; returns the steps that failed.
+def migrate_prices(db) -> list:
+    failed = []
+    if db.has_table("products") and BILLING_MGMT.needs_migration(db):
+        import report_management as REPORT_MGMT
+        for step, step_code in (("prices in cents", BILLING_MGMT.migrate_to_cents), 
+                                ("sales aggregates", REPORT_MGMT.rebuild_daily_sales)):
+            res_code = step_code(db)
+            if res_code is not SQLCodes.SUCCESS:
+                failed.append("{}: {}".format(step, res_code))
+                break
+    return failed
+
 # Initialize the database schema. The schema file resides in the current directory and 
 # must be splitted into a set of strings that are executed in their own transaction (no bulk).
-def create_schema():
+# Returns the statements that failed.
+def create_schema(verbose: bool = True) -> list:
     sql_stmts = list()
     with open(SQL_PATH, mode = "r", encoding = "UTF-8") as sql:
         current_str = ""
@@ -71,19 +129,36 @@ def create_schema():
             else:
                 current_str += line.strip("\n") # remove Zeilenumbruch    
    
+    failed = []
     for sql_stmt in sql_stmts:
-        res_code = db_proxy._execute_sql(sql_stmt)
-        print("SQL executed: {}, result is: {}".format(sql_stmt, res_code))
+        res_code = get_db_proxy()._execute_sql(sql_stmt)
+        if res_code is not SQLCodes.SUCCESS:
+            failed.append("{}: {}".format(sql_stmt.strip(), res_code))
+        if verbose:
+            print("SQL executed: {}, result is: {}".format(sql_stmt, res_code))
+    failed.extend(migrate_prices(get_db_proxy()))
+    res_code = enable_change_log(get_db_proxy())
+    if res_code is not SQLCodes.SUCCESS:
+        failed.append("change log: {}".format(res_code))
+    return failed
 
 # Load product data into SQL database; assume customer has no interface to SQLite3 but Excel (CSV)
-def load_csv(file_path: Path, fn: list) -> list:
-    ret_list = []
-    with open(file_path,mode="r") as csv_file:
-        csv_reader = csv.DictReader(csv_file, fieldnames=fn, delimiter="|")
-        next(csv_reader) # skip headers
-        for line in csv_reader:
-            ret_list.append(line)
-    return ret_list
+def import_csv_files(entities: dict, tables: list = None, file_path: Path = None, batch_size: int = 500, 
+                     workers: int = 1) -> list:
+    """Upsert the CSV files of the given tables (default: all in 'entities'), parsed by 'workers' processes and
+    written in foreign key order, every batch of rows in one transaction; s. import_management.py. Values are
+    converted to the column types, rows that cannot be converted end up in '<table>.rejected.csv'.
+
+    Returns:
+        list: Per table e.g. {"table": "products", "rows": 8, "batches": 1, "rejected": 0, "reject_file": None,
+              "errors": []}
+    """
+    import import_management as IMPORT_MGMT
+    files = {}
+    for entity_name in tables or entities.keys():
+        csv_path = file_path or Path("{}{}{}.csv".format(SCRIPT_PATH, os.sep, entity_name))
+        files[entity_name] = entities[entity_name], csv_path
+    return IMPORT_MGMT.import_files(get_db_proxy(), files, workers=workers, batch_size=batch_size)
 
 def start_db_admin(entities):
     while True:
@@ -93,6 +168,8 @@ def start_db_admin(entities):
         print("\t2. Load data from CSV.")
         print("\t3. Enter custom SQL.")
         print("\t4. Create web db (users, translations).")
+        print("\t5. Rebuild sales aggregates (backfill).")
+        print("\t6. Export new orders (columnar files).")
         # get hold of DB controller (facade)
 
         user_choice = input("\t>")
@@ -102,40 +179,85 @@ def start_db_admin(entities):
             create_schema()    
         elif user_choice == '2':
             print("Loading files.. ")
-            for entity_name in entities:
-                attrs = entities[entity_name]
-                csv_file_path = "{}{}{}.csv".format(SCRIPT_PATH.resolve(), os.sep, entity_name)
-                res_csv = load_csv(csv_file_path, attrs)
-
-                # convert to SQL string; TODO move this code to a mapping facade object!
-                for data_set in res_csv:
-                    
-                    # send to controller
-                    sql_code = db_proxy.upsert(entity_name, data_set, "id")
-                    print("SQL returned: ", sql_code)
+            for summary in import_csv_files(entities, workers=os.cpu_count()):
+                print("Imported: ", summary)
         elif user_choice == '3':
             custom_sql = input("SQL>")
-            res_csv = db_proxy._execute_sql(custom_sql)
+            res_csv = get_db_proxy()._execute_sql(custom_sql)
             print("SQL executed: {}, result is: {}".format(custom_sql, res_csv))
         elif user_choice == '4':
             create_user_schema(document_store())
-
-config = load_config()
-db_name = config['database']['file_name']
-db_path = os.path.join(os.path.dirname(__file__), db_name)
-db_proxy = create_proxy(db_path)
+        elif user_choice == '5':
+            import report_management as REPORT_MGMT
+            res_code = REPORT_MGMT.rebuild_daily_sales(get_db_proxy())
+            print("Sales aggregates rebuilt, result is: {}".format(res_code))
+        elif user_choice == '6':
+            import export_management as EXPORT_MGMT # pyarrow only needed here
+            summary = EXPORT_MGMT.export_orders(get_db_proxy(), get_config()["export_management"])
+            print("Export finished: {}".format(summary))
+
+# Loaded on first use, not on import (s. module comment)
+_config = None
+_db_proxy = None
+
+def get_config() -> dict:
+    global _config
+    if _config is None:
+        _config = load_config()
+        # built-in messages + translation file; replaced by the 'Translations' collection once loaded, 
+        # s. load_translations()
+        TRANSL_MGMT.install(TRANSL_MGMT.merge_files(_config['messages'], [TRANSLATIONS_FILE]), 
+                            _config['translations']['fallbacks'])
+    return _config
+
+def get_db_proxy():
+    global _db_proxy
+    if _db_proxy is None:
+        import report_management as REPORT_MGMT
+        db_name = get_config()['database']['file_name']
+        db_path = os.path.join(SCRIPT_PATH, db_name)
+        db_proxy = create_proxy(db_path)
+        # guard: amounts are computed in cents (s. billing_management), REAL prices would break totals and receipts;
+        # only databases not migrated yet see DDL here
+        if db_proxy.has_table("products") and BILLING_MGMT.needs_migration(db_proxy):
+            print("Converting prices to cents..", file=sys.stderr)
+            failed = migrate_prices(db_proxy)
+            if failed:
+                raise RuntimeError("Prices could not be converted to cents: {}".format("; ".join(failed)))
+            enable_change_log(db_proxy) # triggers of the replaced 'products' table
+        # keeps 'daily_sales' up to date; without the table every order item write would be rolled back
+        if db_proxy.has_table(REPORT_MGMT.DAILY_SALES_TABLE):
+            db_proxy.add_write_listener(REPORT_MGMT.DailySalesAggregate())
+        else:
+            print("Table '{}' is missing, sales aggregates are not maintained; pls. run 'main.py schema'.".format(
+                REPORT_MGMT.DAILY_SALES_TABLE), file=sys.stderr)
+        # triggers are created by 'main.py schema' only: no DDL on start (s. enable_change_log())
+        if get_config()['database'].get('change_log') and not db_proxy.has_table(CHANGE_LOG_TABLE):
+            print("Table '{}' is missing, changes are not recorded; pls. run 'main.py schema'.".format(
+                CHANGE_LOG_TABLE), file=sys.stderr)
+        _db_proxy = db_proxy
+    return _db_proxy
+
+# Invoked by schema creation; idempotent, i.e. only missing or outdated triggers are (re-)created.
+def enable_change_log(db) -> SQLCode:
+    tables = get_config()['database'].get('change_log') or []
+    return db.enable_change_log(tables) if tables else SQLCodes.SUCCESS
 
 # User database (Arango) #
 
-def arango_client(timeout: int = 12, max_retries: int = 3) -> ArangoClient:
-    arango_url = "http://{}:{}".format(config['arango']['host_name'], config['arango']['host_port']) # closure
-    arango_client = ArangoClient(arango_url)
-    arango_client.request_timeout = timeout
-    return arango_client
+# Shared by the whole process: same client (and pooled connections) on every call, s. arango_pool.py
+def arango_client(timeout: int = 12, max_retries: int = 3) -> "ArangoClient":
+    import arango_pool as ARANGO_POOL
+    config = get_config()
+    return ARANGO_POOL.registry.get_client(config['arango']['host_name'], config['arango']['host_port'],
+                                           timeout=timeout, max_retries=max_retries, 
+                                           pool_size=config['arango'].get('pool_size', ARANGO_POOL.DEFAULT_POOL_SIZE))
 
 def check_database_exists():
+    import arango_pool as ARANGO_POOL
+    config = get_config()
     try:
-        sys_db = arango_client().db('_system', username='root', password=config["arango"]["root_password"]) # closure
+        sys_db = ARANGO_POOL.registry.database(arango_client(), '_system', 'root', config["arango"]["root_password"])
         db_name = config["arango"]["db_name"]
         if not sys_db.has_database(db_name):
             sys_db.create_database(db_name)
@@ -145,11 +267,13 @@ def check_database_exists():
         return db_name
 
 def document_store():
+    import arango_pool as ARANGO_POOL
+    config = get_config()
     user_db_name = check_database_exists()
     if user_db_name == config["arango"]["db_name"]:
-        return arango_client().db(user_db_name, 
-                                  username=config["arango"]["app_user"], 
-                                  password=config["arango"]["app_password"])
+        return ARANGO_POOL.registry.database(arango_client(), user_db_name, 
+                                             config["arango"]["app_user"], 
+                                             config["arango"]["app_password"])
     else:
         raise RuntimeError("Couldn't get a handle to the document store!")
     
@@ -163,6 +287,8 @@ def create_user_schema(acasa_db):
         users.add_hash_index(fields=['name'], unique=False)
         users.truncate()
         insert_test_user(users)
+    # session lookup by cookie (s. get_user_for_cookie); no-op if the index exists already
+    users.add_hash_index(fields=['session_id'], unique=True, sparse=True)
 
     # 'Translations' collection
     if acasa_db.has_collection('Translations'):
@@ -175,92 +301,158 @@ def create_user_schema(acasa_db):
 def insert_test_user(user_coll):
     return user_coll.insert({"Name": "Joe Doe", "Age": 35})
 
+# Not-programmers edit translations.json; it is imported in bulk, then the local lookup table is swapped.
 def load_translations(transl_coll):
-    pass # TODO Find a way for not-programmers to enter translations easily..
+    config = get_config()
+    cnt = TRANSL_MGMT.load_translations(transl_coll, [TRANSLATIONS_FILE])
+    TRANSL_MGMT.refresh_from_store(transl_coll, base=config['messages'], fallbacks=config['translations']['fallbacks'])
+    print("{} translations imported.".format(cnt))
+
+# Change hook of the web servers (s. TRANSL_MGMT.refresh_periodically()): reloads only if the collection was modified
+def refresh_translations(transl_coll) -> bool:
+    config = get_config()
+    return TRANSL_MGMT.refresh_if_changed(transl_coll, base=config['messages'], 
+                                          fallbacks=config['translations']['fallbacks'])
 
 # global cache is shared between dynamic web pages and RESTful web services #
 def init_cache(global_cache: dict, db_inst):
+    load_catalogue(global_cache, db_inst)
+    import single_flight as SINGLE_FLIGHT
+    catalogue_flight = SINGLE_FLIGHT.SingleFlight() # concurrent refreshes load once
+    global_cache['refresh_catalogue'] = lambda: catalogue_flight.do( # on changes, s. web_portal
+        "catalogue", lambda: load_catalogue(global_cache, db_inst))
+    import change_management as CHANGE_MGMT
+    if get_config()['database'].get('change_log'): # push to the browsers, s. event_broker.py
+        global_cache['change_feed'] = CHANGE_MGMT.ChangeFeed(db_inst)
+    import kitchen_management as KITCHEN_MGMT
+    global_cache['kitchen_queue'] = lambda since=None: KITCHEN_MGMT.kitchen_queue(db_inst, since) # s. web_portal
+    import image_management as IMAGE_MGMT
+    global_cache['image_loader'] = lambda image_id: IMAGE_MGMT.load_image(db_inst, image_id) # originals, s. web_portal
+    global_cache['user_settings'] = {} # hmm...
+
+# Products/categories as shown and ordered; the version is set last, so a page cached under it shows the new data
+def load_catalogue(global_cache: dict, db_inst):
     _PROD_SQL = """SELECT p.name AS product_name, 
                 p.price AS Product_price, 
-                c.name AS category_name 
-            FROM products p, categories c 
-            WHERE p.category_id = c.id"""
+                c.name AS category_name,
+                pi.image_id AS image_id
+            FROM products p JOIN categories c ON p.category_id = c.id
+                LEFT JOIN product_images pi ON pi.product_id = p.id"""
     prods = db_inst.query(_PROD_SQL)
     prods_by_cat = dict()
-    for p_name, p_price, p_category in prods:
+    for p_name, p_price, p_category, image_id in prods:
             if not p_category in prods_by_cat:
                     prods_by_cat[p_category] = list()
-            prods_by_cat[p_category].append({"name": p_name, "price": p_price})
+            prods_by_cat[p_category].append({"name": p_name, "price": BILLING_MGMT.format_cents(p_price), 
+                                             "image": image_id})
     global_cache['prods'] = prods_by_cat # Cache all prods/categories in dict
-    global_cache['user_settings'] = {} # hmm...
-
-def create_web_server():
-    from web import create_instance, WebStore, ContextCache
-    class AcasaWebStore(WebStore): # class on-the-fly.. respect I/F!
-
-        def __init__(self, acasa_db: ArangoClient, needs_initialization: bool):
-                self._db = acasa_db
-
-        def is_prepared(self):
-                return False # Calls prepare(), s.b.
-
-        def prepare(self):
-            create_user_schema(self._db) # s.a.
-            return self
+    import order_management as ORDER_MGMT
+    global_cache['menu'] = ORDER_MGMT.MenuIndex(ProductDbMapper(db_inst).get_products()) # id/category/name lookups
+    ORDER_MGMT.reset_menu(global_cache['menu']) # order sessions of this process take the new menu, too
+    import change_management as CHANGE_MGMT
+    global_cache['catalogue_version'] = CHANGE_MGMT.last_change(db_inst, CHANGE_MGMT.CATALOGUE_TABLES) # page caches
+
+# Generated files downloadable by logged-in users only: [(URL prefix, directory)], sent by the portal through
+# file_server.py (s. web_portal 'downloads')
+def _downloads() -> list:
+    from output_management import RECEIPT_DIRECTORY
+    output_dir = Path(SCRIPT_PATH, get_config()["output_management"]["output_file_directory"])
+    export_dir = Path(SCRIPT_PATH, get_config()["export_management"]["export_directory"])
+    return [("/files/receipts/", Path(output_dir, RECEIPT_DIRECTORY)), ("/files/exports/", export_dir)]
+
+# The customer portal is deployed by acasa_web_1/main.py from its application.yml (user database, session cache,
+# translations, admission control, metrics..); it works in its own directory (relative paths there), the working
+# directory of this script is restored afterwards.
+@contextmanager
+def web_deployment():
+    cwd = os.getcwd()
+    try:
+        import importlib # not 'import acasa_web_1.main': the package exports the function main()
+        WEB_DEPLOYMENT = importlib.import_module("acasa_web_1.main") # the first import changes the directory, too
+        os.chdir(WEB_DEPLOYMENT.SCRIPT_PATH)
+        WEB_DEPLOYMENT.load_config()
+        WEB_DEPLOYMENT.install_injectables()
+        yield WEB_DEPLOYMENT
+    finally:
+        os.chdir(cwd)
+
+def _portal_module(web_deployment_cfg: dict) -> dict:
+    return web_deployment_cfg["container"]["wsgi"][0] # e.g. 'webportal-1'
+
+def create_web_server(build: bool = True, **externals):
+    """The portal on top of the catalogue cache of this process; 'build' False: the static assets and templates were
+    built before (s. _run_serve()). Given 'externals' replace injected ones, e.g. the 'user_database' in tests.
+    """
+    with web_deployment() as WEB_DEPLOYMENT:
+        from acasa_web_1.web_portal import ContextCache
+        ctx_cache = ContextCache()
+        init_cache(ctx_cache, get_db_proxy())
+        web_inst_1 = WEB_DEPLOYMENT.load_web_module(_portal_module(WEB_DEPLOYMENT.config), build=build,
+                                                    externals=dict(externals, global_cache=ctx_cache,
+                                                                   downloads=_downloads()))
+    return web_inst_1, ctx_cache # Make this function executable by uvicorn for cloud deployment, e.g. Heroku
 
-        def get_user_for_cookie(self, cookie):
-                self._db.aql.execute('FOR doc IN WebUsers RETURN doc')
+# ASGI application factory, e.g. 'uvicorn main:asgi_app --factory'; every worker process builds its own app, the static
+# assets and templates are built once before by 'main.py serve'
+def asgi_app():
+    web_app, ctx_cache = create_web_server(build=False)
+    return web_app
 
-        def create_user(self, name: str = "", email: str = ""):
-                pass
-        
-    acasa_doc_store = AcasaWebStore(document_store(), True) # inject
-    WEB_PATH = Path("{}{}{}".format(SCRIPT_PATH, os.sep, ACASA_WEB_1_DEPLOYMENT_FOLDER))
-    ctx_cache = ContextCache()
-    init_cache(ctx_cache, db_proxy) # nsn.. inversion of control possible? should be on deployment time..
-    web_inst_1 = create_instance(WEB_PATH, acasa_doc_store, ctx_cache)
-    return web_inst_1, ctx_cache # Make this function executable by uvicorn for cloud deployment, e.g. Heroku
+# Long-running work is left to the job workers (s. job_management.py); returns the job ID
+def enqueue_job(kind: str, payload: dict) -> int:
+    import job_management as JOB_MGMT
+    job_queue = JOB_MGMT.JobQueue(Path(SCRIPT_PATH, get_config()["job_management"]["queue_file"]))
+    try:
+        return job_queue.enqueue(kind, payload)
+    finally:
+        job_queue.close()
+
+# Catalogue as ordered from: {category: [{"id": .., "name": .., "price": ..}]} in menu order, prices in cents
+class ProductDbMapper():
+
+    def __init__(self, db):
+        self._db_facade = db
+
+    def get_products(self):
+        _sql = """SELECT 
+                    p.id AS product_id,
+                    p.name AS product_name,
+                    p.price AS product_price,
+                    c.name AS category_name 
+                FROM products p, categories c 
+                WHERE p.category_id = c.id
+                ORDER BY c.id, p.id
+                """
+        prods = self._db_facade.query(_sql)
+        prod_by_cat = dict()
+        for product_id, product_name, product_price, category_name in prods:
+            if not category_name in prod_by_cat:
+                prod_by_cat[category_name] = list()
+            prod_by_cat[category_name].append({"id": product_id, "name": product_name, "price": product_price})
+        return prod_by_cat  # Automatic JSON converting! :-)
 
 # Depricated! TODO Introduce integration tests
 def start_order_management(config, lang, sql_db):
-    class ProductDbMapper():
-
-        def __init__(self, db):
-            self._db_facade = db
-
-        def get_products(self):
-            _sql = """SELECT 
-                        p.id AS product_id,
-                        p.name AS product_name,
-                        p.price AS product_price,
-                        c.name AS category_name 
-                    FROM products p, categories c 
-                    WHERE p.category_id = c.id
-                    """
-            prods = self._db_facade.query(_sql)
-            prod_by_cat = dict()
-            for product_id, product_name, product_price, category_name in prods:
-                if not category_name in prod_by_cat:
-                    prod_by_cat[category_name] = list()
-                prod_by_cat[category_name].append({"id": product_id, "name": product_name, "price": product_price})
-            return prod_by_cat  # Automatic JSON converting! :-)
-        
+    import order_management as ORDER_MGMT
+    import output_management as OUTPUT_MGMT
     user_id = input("Pls. tell us your ID> ")
     # TODO verify integrity of ID
     order_items = ORDER_MGMT.take_order(config=config, language=lang, db_mapper=ProductDbMapper(sql_db))
     # Save order to DB:
     to_day = datetime.date.today()
-    order_obj = DataObject("orders", {"customer": user_id, "order_date": to_day})
-    order_id = sql_db.insert(order_obj)
-    for item in order_items:
-        amnt = order_items[item]
-        item_obj = DataObject("order_items", {"order_id": order_id, "item_id": item[2], "amount": amnt})
-        item_id = sql_db.insert(item_obj)
-
+    order_obj = DataObject("orders", {"id": None, "customer": user_id, "order_date": to_day.isoformat()}, {"id"})
+    item_objs = [DataObject("order_items", {"order_id": None, "item_id": item[2], "amount": order_items[item]},
+                            {"order_id", "item_id"}) for item in order_items]
+    order_id = sql_db.insert_with_details(order_obj, item_objs, "order_id") # one transaction, s. export_management
+    if isinstance(order_id, SQLCode):
+        print("The order could not be saved: {}".format(order_id))
+        return None
+
+    enqueue_job("receipt", {"order_id": order_id}) # PDF rendered by the job workers, s. 'jobs run'
     print()
     print("Quittung")
     sum_all = OUTPUT_MGMT.print_receipt(order_items)
-    print (f"Vielen Dank für Ihre Bestellung über {sum_all} € und auf Wiedersehen!")
+    print (f"Vielen Dank für Ihre Bestellung über {BILLING_MGMT.format_cents(sum_all, '€')} und auf Wiedersehen!")
     # return anything?
     return order_items
 
@@ -273,6 +465,7 @@ def print_menu():
     print("\tweb -> Run the sample web application (web-a-casa).")
     print("\tgui -> Open admin GUI.")
     print("\ttest -> Test: Take order (life test via command line)")
+    print("\tprof -> Profile import times (startup costs per feature).")
 
 def menu():
     ADMIN_LANGUAGE = "EN" # TODO Pass as program arg
@@ -288,24 +481,524 @@ def menu():
             print("Checking environment..")
             show_environment()
         elif user_choice == "dba":
-            start_db_admin(config["csv_files"])
+            start_db_admin(get_config()["csv_files"])
         elif user_choice == "web":
             print("Sorry, under construction!")
             #import sample
             #web_app, ctx_cache = create_web_server()
             # deployment must come before starting the Quart instance!!
-            #sample.install_api(web_app, db_proxy, ctx_cache)
+            #sample.install_api(web_app, get_db_proxy(), ctx_cache)
             # Running the ASGI runtime with uvicorn (should be similar to deploament on Heroku etc.)
+            #import uvicorn
             #runner = uvicorn.run(web_app, host="localhost", port=5000, log_level="info")
             #print("Running {}".format(runner))
         elif user_choice == "gui":
             print("Opening admin GUI") # TODO log
+            from acasa_admin.admin_gup import start_admin_app # wx
             start_admin_app()
         elif user_choice == "test":
             print("Starting order preview.")
-            order = start_order_management(config, ADMIN_LANGUAGE, db_proxy)
-            OUTPUT_MGMT.print_receipt(order)
+            import output_management as OUTPUT_MGMT
+            order = start_order_management(get_config(), ADMIN_LANGUAGE, get_db_proxy())
+            if order is not None: # None: the order could not be saved (reported above)
+                OUTPUT_MGMT.print_receipt(order)
+        elif user_choice == "prof":
+            profile_imports()
         else:
             print("You've entered an invalid choice.")
 
-menu() # main()
+# Non-interactive commands (deployment pipelines, parallel jobs) #
+
+@contextmanager
+def timed_step(step: str, as_json: bool = False, **details):
+    """Time one step of a command and report it when done: as one JSON line (--json) or as readable text. The 
+    yielded dict can be filled with further details, e.g. row counts; a "status" set there overrides "ok".
+    """
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield details
+    except Exception as ex:
+        status = "error"
+        details["error"] = str(ex)
+        raise
+    finally:
+        report = {"step": step, "status": status, "seconds": round(time.perf_counter() - start, 6), **details}
+        if as_json:
+            print(json.dumps(report, default=str), flush=True)
+        else:
+            print("{}: {} in {:.3f} s {}".format(step, report.pop("status"), report.pop("seconds"), 
+                                                {k: v for k, v in report.items() if k != "step"}))
+
+# Command handlers, s. build_arg_parser(): return the exit code (0: success, 1: failed, 2: invalid arguments)
+
+def _run_schema(args: argparse.Namespace) -> int:
+    as_json = args.json
+    with timed_step("schema", as_json) as details:
+        details["failed"] = create_schema(verbose=False)
+        if details["failed"]:
+            details["status"] = "error"
+    return 1 if details["failed"] else 0
+
+def _run_import(args: argparse.Namespace) -> int:
+    as_json = args.json
+    entities = get_config()["csv_files"]
+    tables = args.table or list(entities.keys())
+    if args.file is not None and len(tables) != 1:
+        print("--file requires exactly one --table")
+        return 2
+    for table in tables:
+        if table not in entities:
+            print("Unknown table: {} (configured: {})".format(table, ", ".join(entities)))
+            return 2
+    with timed_step("import", as_json, workers=args.workers) as details:
+        details["tables"] = import_csv_files(entities, tables, args.file, args.batch_size, args.workers)
+        details["rows"] = sum(summary["rows"] for summary in details["tables"])
+        if any(summary["errors"] or summary["rejected"] for summary in details["tables"]):
+            details["status"] = "error"
+    return 0 if details.get("status") is None else 1
+
+def _run_sql(args: argparse.Namespace) -> int:
+    as_json = args.json
+    with timed_step("sql", as_json, statement=args.statement) as details:
+        if args.statement.lstrip().upper().startswith(("SELECT", "WITH", "PRAGMA")):
+            res = get_db_proxy().query(args.statement)
+            if isinstance(res, Exception):
+                details["result"] = str(res)
+            else:
+                details["rows"] = len(res)
+                for row in res:
+                    print(json.dumps(list(row), default=str) if as_json else row)
+        else:
+            details["result"] = str(get_db_proxy()._execute_sql(args.statement))
+        if details.get("result", str(SQLCodes.SUCCESS)) != str(SQLCodes.SUCCESS):
+            details["status"] = "error"
+    return 0 if details.get("status") is None else 1
+
+def _run_serve(args: argparse.Namespace) -> int:
+    import uvicorn
+    as_json = args.json
+    with timed_step("serve", as_json, host=args.host, port=args.port, workers=args.workers):
+        with web_deployment() as WEB_DEPLOYMENT: # once for all workers, s. asgi_app()
+            WEB_DEPLOYMENT.build_web_module(_portal_module(WEB_DEPLOYMENT.config))
+        uvicorn.run("main:asgi_app", factory=True, host=args.host, port=args.port, workers=args.workers, 
+                    log_level="info")
+    return 0
+
+def _run_bench(args: argparse.Namespace) -> int:
+    import benchmarks
+    as_json = args.json
+    with timed_step("bench", as_json, names=args.names or list(benchmarks.BENCHMARKS)):
+        benchmarks.run(args.names)
+    return 0
+
+def _run_aggregates(args: argparse.Namespace) -> int:
+    import report_management as REPORT_MGMT
+    as_json = args.json
+    with timed_step("aggregates", as_json) as details:
+        details["result"] = str(REPORT_MGMT.rebuild_daily_sales(get_db_proxy()))
+        if details["result"] != str(SQLCodes.SUCCESS):
+            details["status"] = "error"
+    return 0 if details.get("status") is None else 1
+
+def _run_export(args: argparse.Namespace) -> int:
+    import export_management as EXPORT_MGMT
+    as_json = args.json
+    with timed_step("export", as_json) as details:
+        details.update(EXPORT_MGMT.export_orders(get_db_proxy(), get_config()["export_management"]))
+    return 0
+
+def _run_prof(args: argparse.Namespace) -> int:
+    profile_imports()
+    return 0
+
+def _run_jobs(args: argparse.Namespace) -> int:
+    import job_management as JOB_MGMT
+    as_json = args.json
+    jobs_cfg = get_config()["job_management"]
+    if args.action == "run":
+        with timed_step("jobs", as_json, action="run", queues=jobs_cfg["queues"]):
+            JOB_MGMT.create_pool(jobs_cfg, SCRIPT_PATH).start().run_forever()
+        return 0
+    if args.action == "enqueue" and not args.kind:
+        print("'jobs enqueue' requires a job kind, e.g. {}".format(", ".join(JOB_MGMT.JOB_HANDLERS)))
+        return 2
+    with timed_step("jobs", as_json, action=args.action) as details:
+        job_queue = JOB_MGMT.JobQueue(Path(SCRIPT_PATH, jobs_cfg["queue_file"]))
+        if args.action == "enqueue":
+            details["job_id"] = job_queue.enqueue(args.kind, args.payload)
+        else:
+            details["pending"] = job_queue.pending()
+            details["metrics"] = job_queue.metrics()
+        job_queue.close()
+    return 0
+
+def _run_receipts(args: argparse.Namespace) -> int:
+    import output_management as OUTPUT_MGMT
+    as_json = args.json
+    with timed_step("receipts", as_json) as details:
+        order_ids = list(args.order_ids)
+        if args.date:
+            order_ids += [row[0] for row in get_db_proxy().query("SELECT id FROM orders WHERE order_date = ?", 
+                                                                 (args.date,))]
+        billing_cfg = get_config()["billing"]
+        renderer = OUTPUT_MGMT.ReceiptRenderer(get_config()["output_management"], billing_cfg["currency"],
+                                               BILLING_MGMT.vat_basis_points(billing_cfg))
+        try:
+            details["files"] = len(renderer.render_batch(OUTPUT_MGMT.receipt_data(get_db_proxy(), order_ids)))
+        finally:
+            renderer.close()
+        details["directory"] = str(renderer.output_dir)
+    return 0
+
+def _run_settle(args: argparse.Namespace) -> int:
+    as_json = args.json
+    billing_cfg = get_config()["billing"]
+    with timed_step("settle", as_json) as details:
+        result = BILLING_MGMT.settlement(get_db_proxy(), args.date, args.to or args.date,
+                                         BILLING_MGMT.vat_basis_points(billing_cfg))
+        if as_json:
+            print(json.dumps(result))
+        else:
+            print("{} - {}: {} orders, {} items".format(result["from"], result["to"], result["orders"],
+                                                        result["items"]))
+            for key in ("gross", "vat", "net"):
+                print("  {:<6}{:>14}".format(key, BILLING_MGMT.format_cents(result[key], billing_cfg["currency"])))
+            for category_id, category in result["categories"].items():
+                print("  category {}: {} items, {}".format(category_id, category["items"], 
+                                                          BILLING_MGMT.format_cents(category["gross"])))
+        details["orders"] = result["orders"]
+    return 0
+
+def _run_image(args: argparse.Namespace) -> int:
+    import image_management as IMAGE_MGMT
+    as_json = args.json
+    with timed_step("image", as_json, product_id=args.product_id) as details:
+        if args.file is None:
+            details["result"] = str(IMAGE_MGMT.remove_image(get_db_proxy(), args.product_id))
+        else:
+            details["image_id"] = IMAGE_MGMT.store_image(get_db_proxy(), args.product_id, args.file.read_bytes())
+    return 0
+
+def _run_kitchen(args: argparse.Namespace) -> int:
+    import kitchen_management as KITCHEN_MGMT
+    as_json = args.json
+    with timed_step("kitchen", as_json) as details:
+        queue = KITCHEN_MGMT.kitchen_queue(get_db_proxy(), args.since)
+        if as_json:
+            print(json.dumps(queue))
+        else:
+            for order in queue["orders"]:
+                print("#{} {} ({}, {}): {}".format(order["id"], order["customer"], order["status_name"],
+                                                  order["order_date"], ", ".join("{} x {}".format(
+                                                      item["amount"], item["name"]) for item in order["items"])))
+            if queue["removed"]:
+                print("No longer open:", ", ".join("#{}".format(order_id) for order_id in queue["removed"]))
+        details.update({"seq": queue["seq"], "orders": len(queue["orders"])})
+    return 0
+
+def _run_status(args: argparse.Namespace) -> int:
+    import kitchen_management as KITCHEN_MGMT
+    as_json = args.json
+    statuses = {name: status for status, name in KITCHEN_MGMT.STATUS_NAMES.items()}
+    with timed_step("status", as_json, order_id=args.order_id) as details:
+        res = KITCHEN_MGMT.set_status(get_db_proxy(), args.order_id, statuses[args.status])
+        details["result"] = str(res)
+        if res != 1: # no such order or SQL error
+            details["status"] = "error"
+    return 0 if res == 1 else 1
+
+def _run_changes(args: argparse.Namespace) -> int:
+    import change_management as CHANGE_MGMT
+    as_json = args.json
+    with timed_step("changes", as_json, consumer=args.consumer) as details:
+        consumer = CHANGE_MGMT.ChangeConsumer(get_db_proxy(), args.consumer)
+        details["offset"] = consumer.offset
+        changes = consumer.poll(args.limit)
+        for change in changes:
+            print(json.dumps(change) if as_json else change)
+        details["changes"] = len(changes)
+        if args.commit and changes:
+            details["result"] = str(consumer.commit(changes[-1]["seq"]))
+    return 0
+
+def _run_menu(args: argparse.Namespace) -> int:
+    menu()
+    return 0
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="main.py", 
+                                     description="Acasa Restaurant Administration. Without a command, the "
+                                                 "interactive menu is started.")
+    parser.add_argument("--json", action="store_true", help="report every step as a JSON line (timings)")
+    parser.set_defaults(func=_run_menu)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.add_parser("menu", help="interactive menu (default)").set_defaults(func=_run_menu)
+    commands.add_parser("schema", help="create the database schema from products_db.sql").set_defaults(func=_run_schema)
+    import_cmd = commands.add_parser("import", help="import CSV files of the tables in config.yaml 'csv_files'")
+    import_cmd.set_defaults(func=_run_import)
+    import_cmd.add_argument("--table", action="append", help="table to import (repeatable), default: all")
+    import_cmd.add_argument("--file", type=Path, help="CSV file for a single --table, default: <table>.csv")
+    import_cmd.add_argument("--batch-size", type=int, default=500, help="rows per transaction")
+    import_cmd.add_argument("--workers", type=int, default=1, help="parser processes (one writer)")
+    sql_cmd = commands.add_parser("sql", help="execute one SQL statement; queries print their rows")
+    sql_cmd.set_defaults(func=_run_sql)
+    sql_cmd.add_argument("statement")
+    serve_cmd = commands.add_parser("serve", help="run the web application (uvicorn)")
+    serve_cmd.set_defaults(func=_run_serve)
+    serve_cmd.add_argument("--host", default="localhost")
+    serve_cmd.add_argument("--port", type=int, default=5000)
+    serve_cmd.add_argument("--workers", type=int, default=1)
+    bench_cmd = commands.add_parser("bench", help="run benchmarks (s. benchmarks.py)")
+    bench_cmd.set_defaults(func=_run_bench)
+    bench_cmd.add_argument("names", nargs="*", help="benchmarks to run, default: all")
+    commands.add_parser("aggregates", help="rebuild the sales aggregates (backfill)").set_defaults(func=_run_aggregates)
+    commands.add_parser("export", help="export new orders into columnar files").set_defaults(func=_run_export)
+    commands.add_parser("prof", help="profile import times").set_defaults(func=_run_prof)
+    jobs_cmd = commands.add_parser("jobs", help="batch jobs: run the workers, enqueue a job or show metrics")
+    jobs_cmd.set_defaults(func=_run_jobs)
+    jobs_cmd.add_argument("action", choices=["run", "enqueue", "stats"])
+    jobs_cmd.add_argument("kind", nargs="?", help="job kind for 'enqueue', e.g. receipt, export, import")
+    jobs_cmd.add_argument("--payload", type=json.loads, default={}, help="job payload (JSON) for 'enqueue'")
+    receipts_cmd = commands.add_parser("receipts", help="render PDF receipts of orders (process pool)")
+    receipts_cmd.set_defaults(func=_run_receipts)
+    receipts_cmd.add_argument("order_ids", nargs="*", type=int, help="orders, default: all of --date")
+    receipts_cmd.add_argument("--date", help="all orders of this day (YYYY-MM-DD)")
+    settle_cmd = commands.add_parser("settle", help="settlement (revenue, VAT, categories) of a day or period")
+    settle_cmd.set_defaults(func=_run_settle)
+    settle_cmd.add_argument("--date", default=datetime.date.today().isoformat(), help="day, default: today")
+    settle_cmd.add_argument("--to", help="last day of the period starting with --date")
+    image_cmd = commands.add_parser("image", help="assign a picture (JPEG, PNG, GIF, WebP) to a product")
+    image_cmd.set_defaults(func=_run_image)
+    image_cmd.add_argument("product_id", type=int)
+    image_cmd.add_argument("file", type=Path, nargs="?", help="picture file; without: remove the product's picture")
+    kitchen_cmd = commands.add_parser("kitchen", help="open orders, oldest first (kitchen display)")
+    kitchen_cmd.set_defaults(func=_run_kitchen)
+    kitchen_cmd.add_argument("--since", type=int, help="only orders changed after this sequence number")
+    status_cmd = commands.add_parser("status", help="set the status of an order (kitchen display)")
+    status_cmd.set_defaults(func=_run_status)
+    status_cmd.add_argument("order_id", type=int)
+    status_cmd.add_argument("status", choices=["new", "preparing", "ready", "served", "cancelled"])
+    changes_cmd = commands.add_parser("changes", help="print the change log (CDC) from a consumer's saved offset")
+    changes_cmd.set_defaults(func=_run_changes)
+    changes_cmd.add_argument("--consumer", default="cli", help="consumer name (offset), default: cli")
+    changes_cmd.add_argument("--limit", type=int, default=100)
+    changes_cmd.add_argument("--commit", action="store_true", help="save the offset behind the printed changes")
+    return parser
+
+def run_command(args: argparse.Namespace) -> int:
+    """Execute a parsed command line; returns the exit code (0: success).
+    """
+    return args.func(args)
+
+def main(argv: list = None) -> int:
+    os.chdir(SCRIPT_PATH) # relative paths in config.yaml, e.g. output directories
+    return run_command(build_arg_parser().parse_args(argv))
+
+class UnitTestMain(unittest.TestCase):
+
+    def setUp(self):
+        global _config, _db_proxy
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self._tmp_dir.name, "test.db3")
+        self._saved = _config, _db_proxy
+        _config = {"database": {"file_name": str(self.db_path), "change_log": []}} # absolute: SCRIPT_PATH ignored
+        _db_proxy = None
+
+    def tearDown(self):
+        global _config, _db_proxy
+        _config, _db_proxy = self._saved
+        self._tmp_dir.cleanup()
+
+    def _create_tables(self):
+        import sqlite3
+        with sqlite3.connect(self.db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, price MONEY, category_id INTEGER);
+                CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, customer TEXT NOT NULL,
+                    status INTEGER NOT NULL DEFAULT 0, order_date DATE);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    PRIMARY KEY (order_id, item_id));
+                INSERT INTO products VALUES (2001, 'Pizza Margarita', 499, 2000);
+            """)
+        conn.close()
+
+    def _order(self, db) -> list:
+        db.insert_with_details(DataObject("orders", {"id": None, "customer": "Joe", "order_date": "2023-02-24"},
+                                          {"id"}),
+                               [DataObject("order_items", {"order_id": None, "item_id": 2001, "amount": 2},
+                                           {"order_id", "item_id"})], "order_id")
+        return db.query("SELECT order_id, item_id, amount FROM order_items")
+
+    def test_sales_aggregate_only_with_table(self):
+        self._create_tables()
+        self.assertEqual(self._order(get_db_proxy()), [(1, 2001, 2)]) # items are not lost without 'daily_sales'
+        daily_sales_ddl = """CREATE TABLE daily_sales (sales_day DATE NOT NULL, product_id INTEGER NOT NULL,
+            category_id INTEGER, quantity INTEGER NOT NULL DEFAULT 0, revenue MONEY NOT NULL DEFAULT 0,
+            PRIMARY KEY (sales_day, product_id))"""
+        get_db_proxy()._execute_sql(daily_sales_ddl)
+        global _db_proxy
+        _db_proxy = None # next process start
+        self._order(get_db_proxy())
+        self.assertEqual(get_db_proxy().query("SELECT quantity, revenue FROM daily_sales"), [(2, 998)])
+
+    def test_prices_migrated_on_start(self):
+        import sqlite3
+        with sqlite3.connect(self.db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, price REAL,
+                    category_id INTEGER);
+                CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, customer TEXT NOT NULL,
+                    status INTEGER NOT NULL DEFAULT 0, order_date DATE);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    PRIMARY KEY (order_id, item_id));
+                INSERT INTO products VALUES (2001, 'Pizza Margarita', 4.99, 2000);
+            """)
+        conn.close()
+        self.assertEqual(self._order(get_db_proxy()), [(1, 2001, 2)])
+        self.assertFalse(BILLING_MGMT.needs_migration(get_db_proxy()))
+        self.assertEqual(get_db_proxy().query("SELECT price FROM products"), [(499,)])
+        settlement = BILLING_MGMT.settlement(get_db_proxy(), "2023-02-24", "2023-02-24")
+        self.assertEqual(BILLING_MGMT.format_cents(settlement["gross"]), "9.98")
+        self.assertEqual(get_db_proxy().query("SELECT quantity, revenue FROM daily_sales"), [(2, 998)])
+
+    def test_catalogue_replaces_menu(self):
+        import order_management as ORDER_MGMT
+        self._create_tables()
+        get_db_proxy()._execute_sql_list(["CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+                                          "CREATE TABLE product_images (product_id INTEGER PRIMARY KEY, image_id TEXT)",
+                                          "INSERT INTO categories VALUES (2000, 'Pizza')"])
+        ORDER_MGMT.reset_menu()
+        try:
+            global_cache = {}
+            load_catalogue(global_cache, get_db_proxy())
+            self.assertEqual(global_cache['prods'], {"Pizza": [{"name": "Pizza Margarita", "price": "4.99",
+                                                                "image": None}]})
+            self.assertIs(ORDER_MGMT.shared_menu(None), global_cache['menu'])
+            get_db_proxy()._execute_sql("UPDATE products SET price = 549")
+            load_catalogue(global_cache, get_db_proxy()) # on changes, s. init_cache()
+            self.assertEqual(ORDER_MGMT.shared_menu(None).items["2001"], ("Pizza Margarita", 549))
+        finally:
+            ORDER_MGMT.reset_menu()
+
+    def test_serve_app(self):
+        import asyncio
+        from web import WebStore
+        class UserStore(WebStore): # instead of Arango
+            is_prepared = prepare = lambda self: True
+            get_user_for_cookie = logout = lambda self, cookie: None
+            create_user = lambda self, name="", email="": None
+        self._create_tables()
+        get_db_proxy()._execute_sql_list(["CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+                                          "CREATE TABLE product_images (product_id INTEGER PRIMARY KEY, image_id TEXT)",
+                                          "INSERT INTO categories VALUES (2000, 'Pizza')"])
+        _config.update(output_management={"output_file_directory": self._tmp_dir.name},
+                       export_management={"export_directory": self._tmp_dir.name})
+        from output_management import RECEIPT_DIRECTORY
+        Path(self._tmp_dir.name, RECEIPT_DIRECTORY).mkdir()
+        Path(self._tmp_dir.name, RECEIPT_DIRECTORY, "receipt_1.pdf").write_bytes(b"%PDF")
+        cwd = os.getcwd()
+        web_app, ctx_cache = create_web_server(build=False, user_database=UserStore()) # like asgi_app()
+        self.assertEqual(os.getcwd(), cwd)
+
+        async def requests() -> list:
+            async with web_app.test_app() as test_app: # warm-up renders all pages
+                client = test_app.test_client()
+                return [await client.get("/menue"), await client.get("/files/receipts/receipt_1.pdf"),
+                        await client.get("/metrics", scope_base={"client": ("127.0.0.1", 50123)})]
+        menue, receipt, metrics = asyncio.run(requests())
+        self.assertEqual((menue.status_code, receipt.status_code, metrics.status_code), (200, 403, 200))
+        page = asyncio.run(menue.get_data(as_text=True))
+        self.assertIn("<h2>Menue: today</h2>", page)
+        self.assertIn("Pizza Margarita ... 4.99", page)
+
+    def test_import_loads_nothing(self):
+        proc = subprocess.run([sys.executable, "-c", "import sys, main; print(main._config, main._db_proxy, "
+                               "'yaml' in sys.modules, 'report_management' in sys.modules)"],
+                              cwd=SCRIPT_PATH, capture_output=True, text=True)
+        self.assertEqual(proc.stdout.split(), ["None", "None", "False", "False"], proc.stderr)
+
+    def test_singletons(self):
+        self._create_tables()
+        self.assertIs(get_config(), get_config())
+        self.assertIs(get_db_proxy(), get_db_proxy())
+
+    def test_sql_select_without_ddl(self):
+        import contextlib
+        import io
+        self._create_tables()
+        _config["database"]["change_log"] = ["products", "orders"] # configured, but 'schema' not run yet
+        schema_version = create_proxy(self.db_path).query("PRAGMA schema_version")
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            exit_code = run_command(build_arg_parser().parse_args(["sql", "SELECT id, price FROM products"]))
+        self.assertEqual(exit_code, 0)
+        self.assertIn("(2001, 499)", stdout.getvalue())
+        self.assertIn("main.py schema", stderr.getvalue())
+        self.assertEqual(get_db_proxy().query("PRAGMA schema_version"), schema_version) # no triggers, no tables
+        self.assertFalse(get_db_proxy().has_table(CHANGE_LOG_TABLE))
+
+    def _run(self, argv: list) -> tuple:
+        import contextlib
+        import io
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            exit_code = run_command(build_arg_parser().parse_args(argv))
+        return exit_code, stdout.getvalue().splitlines()
+
+    def test_arguments(self):
+        import contextlib
+        import io
+        parser = build_arg_parser()
+        self.assertIs(parser.parse_args([]).func, _run_menu)
+        args = parser.parse_args(["--json", "import", "--table", "products", "--table", "categories",
+                                  "--batch-size", "100"])
+        self.assertEqual((args.func, args.json, args.table, args.batch_size, args.workers),
+                         (_run_import, True, ["products", "categories"], 100, 1))
+        args = parser.parse_args(["jobs", "enqueue", "receipt", "--payload", '{"order_id": 5}'])
+        self.assertEqual((args.func, args.action, args.kind, args.payload), (_run_jobs, "enqueue", "receipt",
+                                                                            {"order_id": 5}))
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+            parser.parse_args(["status", "5", "eaten"])
+
+    def test_timed_step(self):
+        import contextlib
+        import io
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            with timed_step("step", True, table="products") as details:
+                details["rows"] = 3
+            with self.assertRaises(ValueError), timed_step("failing", True):
+                raise ValueError("no such table")
+            with timed_step("text") as details:
+                details["rows"] = 3
+        reports = stdout.getvalue().splitlines()
+        first, second = json.loads(reports[0]), json.loads(reports[1])
+        self.assertEqual((first["step"], first["status"], first["table"], first["rows"]),
+                         ("step", "ok", "products", 3))
+        self.assertIsInstance(first["seconds"], float)
+        self.assertEqual((second["status"], second["error"]), ("error", "no such table"))
+        self.assertRegex(reports[2], r"^text: ok in \d+\.\d{3} s \{'rows': 3\}$")
+
+    def test_schema_command(self):
+        exit_code, lines = self._run(["--json", "schema"])
+        report = json.loads(lines[-1])
+        self.assertEqual((exit_code, report["step"], report["status"], report["failed"]), (0, "schema", "ok", []))
+        self.assertTrue(get_db_proxy().has_table("products"))
+        self.assertEqual(self._run(["--json", "schema"])[0], 0) # repeatable
+
+    def test_sql_command(self):
+        self._create_tables()
+        exit_code, lines = self._run(["--json", "sql", "SELECT id, name FROM products"])
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(json.loads(lines[0]), [2001, "Pizza Margarita"])
+        self.assertEqual({key: value for key, value in json.loads(lines[1]).items() if key != "seconds"},
+                         {"step": "sql", "status": "ok", "statement": "SELECT id, name FROM products", "rows": 1})
+        exit_code, lines = self._run(["--json", "sql", "UPDATE products SET price = 549"])
+        self.assertEqual((exit_code, json.loads(lines[-1])["result"]), (0, str(SQLCodes.SUCCESS)))
+        exit_code, lines = self._run(["--json", "sql", "SELECT * FROM nowhere"])
+        self.assertEqual((exit_code, json.loads(lines[-1])["status"]), (1, "error"))
+
+if __name__ == "__main__":
+    sys.exit(main())
+
@@ -0,0 +1,328 @@
+# ACASA Metrics
+# Counters and histograms of this process in the Prometheus text format (s. exposition(); served on '/metrics' by
+# MetricsMiddleware): request latency per route, time spent in database calls (SQLite, Arango) in total and per
+# request, cache hits and misses. Recording has to be cheap enough for every request and database call: values are
+# kept per thread, so the hot path takes no lock (a lock is only taken for a thread's first value), and summed up when
+# scraped; histograms have fixed buckets, an observation is a bisect and two additions.
+import bisect
+import contextvars
+import functools
+import ipaddress
+import threading
+import time
+import unittest
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LOOPBACK = ("127.0.0.0/8", "::1/128") # default scrapers: the host itself (agent, sidecar)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric():
+
+    kind = None
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = [] # the values of every thread that recorded one
+        self._lock = threading.Lock()
+
+    def _values(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+            return values
+
+    def _snapshots(self) -> list:
+        with self._lock:
+            shards = list(self._shards)
+        return [list(shard.items()) for shard in shards] # copied by C code, other threads cannot interleave
+
+    def exposition(self) -> list:
+        return ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.kind)] + \
+            self._samples()
+
+
+class Counter(_Metric):
+
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        values = self._values()
+        values[labels] = values.get(labels, 0) + amount
+
+    def collect(self) -> dict:
+        totals = {}
+        for snapshot in self._snapshots():
+            for labels, value in snapshot:
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def _samples(self) -> list:
+        return ["{}{} {}".format(self.name, _labels(self.label_names, labels), value)
+                for labels, value in sorted(self.collect().items())]
+
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        values = self._values()
+        counts = values.get(labels)
+        if counts is None: # per bucket (not cumulative), +Inf, sum
+            counts = values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def collect(self) -> dict:
+        totals = {}
+        for snapshot in self._snapshots():
+            for labels, counts in snapshot:
+                total = totals.setdefault(labels, [0] * len(counts))
+                for pos, count in enumerate(list(counts)):
+                    total[pos] += count
+        return totals
+
+    def _samples(self) -> list:
+        samples = []
+        for labels, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append("{}_bucket{} {}".format(self.name, _labels(self.label_names, labels,
+                                                                          'le="{}"'.format(bound)), cumulative))
+            samples.append("{}_sum{} {}".format(self.name, _labels(self.label_names, labels), counts[-1]))
+            samples.append("{}_count{} {}".format(self.name, _labels(self.label_names, labels), cumulative))
+        return samples
+
+
+class Callback(_Metric):
+    """Values read when scraped, e.g. queue lengths; 'func' returns {label values: value}.
+    """
+
+    def __init__(self, name: str, help_text: str, kind: str, func, label_names: tuple = ()):
+        super().__init__(name, help_text, label_names)
+        self.kind = kind
+        self._func = func
+
+    def _samples(self) -> list:
+        return ["{}{} {}".format(self.name, _labels(self.label_names, labels), value)
+                for labels, value in sorted(self._func().items())]
+
+
+class Registry():
+
+    def __init__(self):
+        self._metrics = {} # name => metric
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, create):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = create()
+            return self._metrics[name]
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> Counter:
+        return self._get(name, lambda: Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        return self._get(name, lambda: Histogram(name, help_text, label_names, buckets))
+
+    def callback(self, name: str, help_text: str, kind: str, func, label_names: tuple = ()):
+        """Register (or replace, e.g. for a new app instance) a metric read from 'func' when scraped.
+        """
+        with self._lock:
+            self._metrics[name] = Callback(name, help_text, kind, func, label_names)
+
+    def exposition(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return "\n".join(line for metric in metrics for line in metric.exposition()) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.histogram("acasa_http_request_duration_seconds", "Time to answer a request.",
+                                   ("route", "method", "status"))
+HTTP_BACKEND_TIME = REGISTRY.histogram("acasa_http_request_backend_seconds",
+                                       "Time a request spent in database calls.", ("route", "backend"))
+BACKEND_CALLS = REGISTRY.histogram("acasa_backend_call_duration_seconds", "Duration of database calls.",
+                                   ("backend", "operation"))
+CACHE_LOOKUPS = REGISTRY.counter("acasa_cache_lookups_total", "Cache lookups by result (hit, miss).",
+                                 ("cache", "key", "result"))
+
+_request_backend_time = contextvars.ContextVar("acasa_request_backend_time", default=None)
+
+
+def observe_call(backend: str, operation: str, seconds: float):
+    """Record a database call, also for the current request (if any; the context is inherited by asyncio.to_thread()).
+    """
+    BACKEND_CALLS.observe(seconds, backend, operation)
+    spent = _request_backend_time.get()
+    if spent is not None:
+        spent[backend] = spent.get(backend, 0.0) + seconds
+
+
+def timed(backend: str, operation: str):
+    """Decorator recording the duration of every call, e.g. @timed("sqlite", "query").
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_call(backend, operation, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+class MetricsMiddleware():
+    """ASGI middleware recording every request (outermost, so that files and rejected requests are included) and
+    answering GET 'path' with the exposition - to clients of the 'allow'ed networks only (behind a proxy that is the
+    proxy's address), others get a 403. Routes are labelled by their first path segment ("/menue", "/images/*"), at
+    most 'max_routes' of them, so that arbitrary URLs cannot blow up the number of time series. Requests to 'untimed'
+    path prefixes - long-lived streams like '/events' - are not recorded: their duration is a connection time, not a
+    latency.
+    """
+
+    def __init__(self, app, path: str = "/metrics", max_routes: int = 100, allow: tuple = LOOPBACK,
+                 untimed: tuple = ()):
+        self.app = app
+        self.path = path
+        self.max_routes = max_routes
+        self._allow = tuple(ipaddress.ip_network(network) for network in allow)
+        self.untimed = tuple(untimed)
+        self._routes = set()
+
+    def allowed(self, scope) -> bool:
+        client = scope.get("client")
+        try:
+            address = ipaddress.ip_address(client[0]) if client else None
+        except ValueError: # e.g. a unix socket
+            return False
+        return address is not None and any(address in network for network in self._allow)
+
+    def route(self, path: str) -> str:
+        segments = path.split("/", 2)
+        route = "/" + segments[1] + ("/*" if len(segments) > 2 else "")
+        if route not in self._routes:
+            if len(self._routes) >= self.max_routes:
+                return "other"
+            self._routes.add(route)
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if scope["path"] == self.path and scope["method"] == "GET":
+            status, body = (200, REGISTRY.exposition().encode("UTF-8")) if self.allowed(scope) else (403, b"")
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type", CONTENT_TYPE.encode("latin-1")),
+                                    (b"content-length", str(len(body)).encode("latin-1"))]})
+            return await send({"type": "http.response.body", "body": body})
+        if scope["path"].startswith(self.untimed):
+            return await self.app(scope, receive, send)
+        status = [500] # if the app fails before answering
+        spent = {}
+        token = _request_backend_time.set(spent)
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            _request_backend_time.reset(token)
+            route = self.route(scope["path"])
+            HTTP_REQUESTS.observe(elapsed, route, scope["method"], str(status[0]))
+            for backend, seconds in spent.items():
+                HTTP_BACKEND_TIME.observe(seconds, route, backend)
+
+
+class UnitTestMetrics(unittest.TestCase):
+
+    def test_exposition(self):
+        registry = Registry()
+        counter = registry.counter("test_total", "Test.", ("key",))
+        histogram = registry.histogram("test_seconds", "Test.", (), buckets=(0.1, 1.0))
+        threads = [threading.Thread(target=lambda: [counter.inc('say "hi"') for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        registry.callback("test_waiting", "Test.", "gauge", lambda: {("reads",): 3}, ("class",))
+        self.assertEqual(registry.exposition().splitlines(), [
+            "# HELP test_seconds Test.", "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 2', 'test_seconds_bucket{le="1.0"} 3', 'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 3.65", "test_seconds_count 4",
+            "# HELP test_total Test.", "# TYPE test_total counter", 'test_total{key="say \\"hi\\""} 4000',
+            "# HELP test_waiting Test.", "# TYPE test_waiting gauge", 'test_waiting{class="reads"} 3'])
+
+    def test_middleware(self):
+        import asyncio
+
+        @timed("sqlite", "test_query") # the registry is shared with the other modules' tests
+        def query():
+            time.sleep(0.01)
+
+        async def app(scope, receive, send):
+            await asyncio.to_thread(query)
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        middleware = MetricsMiddleware(app, max_routes=2, allow=("10.0.0.0/8",) + LOOPBACK, untimed=("/events",))
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        async def scenario():
+            for path, client in (("/menue", None), ("/images/ab/320.webp", None), ("/events", None), ("/x", None),
+                                 ("/metrics", ("192.168.1.7", 5123)), ("/metrics", ("10.1.2.3", 5123))):
+                await middleware({"type": "http", "method": "GET", "path": path, "headers": [], "client": client},
+                                 None, send)
+        asyncio.run(scenario())
+        self.assertEqual([message["status"] for message in messages if message["type"] == "http.response.start"],
+                         [200] * 4 + [403, 200])
+        self.assertFalse([labels for labels in HTTP_REQUESTS.collect() if labels[0] == "/events"]) # streams
+        self.assertEqual(sum(HTTP_REQUESTS.collect()[("/images/*", "GET", "200")][:-1]), 1) # buckets, not sum
+        self.assertIn(("other", "GET", "200"), HTTP_REQUESTS.collect())
+        self.assertGreaterEqual(HTTP_BACKEND_TIME.collect()[("/menue", "sqlite")][-1], 0.01)
+        exposition = messages[-1]["body"].decode("UTF-8")
+        self.assertIn('acasa_backend_call_duration_seconds_count{backend="sqlite",operation="test_query"} 4',
+                      exposition) # the calls of streams are recorded
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -1,49 +1,151 @@
 # ACASA Order management
 # @Depricated! Will be replaced be Customer Portal Web Application (web)
+import threading
+from types import MappingProxyType
+import unittest
 
-def print_menu(repertoire: dict, messages: dict, currency_symbol: str = "€") -> dict:
+from billing_management import format_cents
+import translation_management as TRANSL_MGMT
+
+# The menu a customer orders from only changes with the catalogue, so it is indexed once and the same immutable
+# MenuIndex is shared by all order sessions (threads, too); a session only keeps its own selection.
+MAX_PREFIX_LENGTH = 12 # longer search terms are narrowed down from the 12 character prefix
+
+class MenuIndex():
+    """Read-only lookup structure of the menu, built from the repertoire like returned by 'get_products()', e.g.
+    {"Pizza": [{"id": 2001, "name": "Pizza Margarita", "price": 499}]} (prices in cents):
+
+    - items: {"2001": ("Pizza Margarita", 499)}, keyed by the number the customer enters
+    - categories: {"Pizza": ("2001",)}, in menu order
+    - search(): IDs of the items with a word starting with the given text, e.g. "marg" => ("2001",)
+    """
+    __slots__ = ("items", "categories", "_prefixes", "_lines")
+
+    def __init__(self, repertoire: dict):
+        items = {}
+        categories = {}
+        prefixes = {}
+        lines = [] # (line, unit appended?) - s. menu_lines()
+        for category, dishes in repertoire.items():
+            ids = []
+            lines.extend([(category, False), (len(category)*"~", False), ("", False)])
+            for dish in dishes:
+                item_id = str(dish["id"])
+                items[item_id] = dish["name"], dish["price"]
+                ids.append(item_id)
+                lines.extend([("  {}. {} à {}".format(item_id, dish["name"], format_cents(dish["price"])), True),
+                              ("", False)])
+                for word in set(dish["name"].lower().split()):
+                    for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                        prefixes.setdefault(word[:length], []).append(item_id)
+            categories[category] = tuple(ids)
+        object.__setattr__(self, "items", MappingProxyType(items))
+        object.__setattr__(self, "categories", MappingProxyType(categories))
+        object.__setattr__(self, "_prefixes", MappingProxyType({prefix: tuple(dict.fromkeys(ids))
+                                                                 for prefix, ids in prefixes.items()}))
+        object.__setattr__(self, "_lines", tuple(lines))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MenuIndex is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("MenuIndex is immutable")
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def search(self, text: str) -> tuple:
+        """IDs of the items having a word that starts with 'text' (case insensitive), in menu order.
+        """
+        words = text.lower().split()
+        if not words:
+            return ()
+        found = None
+        for word in words: # every word must match
+            ids = self._prefixes.get(word[:MAX_PREFIX_LENGTH], ())
+            if len(word) > MAX_PREFIX_LENGTH:
+                ids = tuple(item_id for item_id in ids if any(name_word.startswith(word) for name_word in
+                                                               self.items[item_id][0].lower().split()))
+            if found is None:
+                found = ids
+            else:
+                ids = frozenset(ids)
+                found = tuple(item_id for item_id in found if item_id in ids)
+        return found
+
+    def menu_lines(self, measure: str, currency_symbol: str) -> tuple:
+        """The printed menu; the lines are formatted when the index is built, only the currency and the measure of
+        the language are appended to the prices here.
+        """
+        unit = "{}/{}".format(" " + currency_symbol if currency_symbol else "", measure)
+        return tuple(line + unit if priced else line for line, priced in self._lines)
+
+_menu_index = None
+_menu_lock = threading.Lock()
+
+def shared_menu(db_mapper) -> MenuIndex:
+    """The MenuIndex of this process, built from 'db_mapper.get_products()' by the first session; s. reset_menu().
+    """
+    global _menu_index
+    if _menu_index is None:
+        with _menu_lock: # concurrent first sessions query the catalogue only once
+            if _menu_index is None:
+                _menu_index = MenuIndex(db_mapper.get_products())
+    return _menu_index
+
+def reset_menu(menu: MenuIndex = None):
+    """Forget the shared MenuIndex after the catalogue changed - the next session builds a new one - or replace it by
+    'menu', e.g. the one just built by main.load_catalogue().
+    """
+    global _menu_index
+    _menu_index = menu
+
+def print_menu(menu: MenuIndex, messages: dict, currency_symbol: str = "€") -> dict:
     """Print the menu to screen.
 
     Args:
-        repertoire (dict): Data containing the 'repertoire' and other settings of the company.
+        menu (MenuIndex): The indexed repertoire of the company, s. shared_menu().
         messages (dict): Data containing messages shown to the user.
         currency_symbol: The currency symbol
 
     Returns:
-        dict: A new dictionary that has the repertoire sorted by 'id' for better ordering, e.g. {"100": (Pizza Margarita,5.0)}
+        dict: The items by number the customer enters (read-only), e.g. {"100": (Pizza Margarita,500)} (prices in cents)
     """
     print(50*"~")
     print(25*" ","Menu")
     print(50*"~")
     print()
-    available_today = {} # restructured menu for selection of item per key like {"100": (Pizza Margarita,5.0)} etc.
-    for category in repertoire:
-        print(category) # prints key
-        print(len(category)*"~")
-        print()
-        for dish in repertoire[category]:
-            dish_fomratted = "  {}. {} à {}/{}".format(dish["id"], dish["name"], str(dish["price"]) + currency_symbol, messages['msr'])
-            print(dish_fomratted)
-            available_today[str(dish["id"])] = dish["name"], dish["price"] 
-            print()
-    return available_today
-
-def take_order(config: dict, language: str = "DE", db_mapper = None) -> dict:
+    print("\n".join(menu.menu_lines(messages['msr'], currency_symbol)))
+    return menu.items
+
+def select_item(selection: dict, menu: MenuIndex, item_id: str, amount: int) -> bool:
+    """Put 'amount' pieces of the item numbered 'item_id' into the selection of a session, like
+    {('Pizza Margerita',500,'100'):3} (3 = three pcs.); False if the menu has no such item.
+    """
+    item = menu.items.get(item_id)
+    if item is None:
+        return False
+    selection[(*item, item_id)] = amount # pack key as tuple
+    return True
+
+def take_order(config: dict, language: str = "DE", db_mapper = None, menu: MenuIndex = None) -> dict:
     """Prints available items and takes user input.
 
     Args:
         config (dict): A configuration
         language (str, optional): The messgaes dictionary. Defaults to "DE".
+        db_mapper (optional): Provides 'get_products()'; only needed when no 'menu' is given.
+        menu (MenuIndex, optional): The menu to order from, default: shared_menu().
 
     Returns:
         dict: A list of ordered items with amount (dictionary).
     """
-    assert db_mapper is not None
-    user_selection = {} # memoize user input, like {('Pizza Margerita',5.0,100):3} (3 = three pcs.)
+    assert db_mapper is not None or menu is not None
+    user_selection = {} # memoize user input, like {('Pizza Margerita',500,'100'):3} (3 = three pcs.)
     user_choice = '~upps!'
-    repertoire = db_mapper.get_products()
-    messages = config['messages'][language]
-    avail = print_menu(repertoire, messages, currency_symbol = config['billing']['currency'])
+    menu = menu or shared_menu(db_mapper)
+    messages = TRANSL_MGMT.messages(language) # compiled lookup table, s. main.py
+    avail = print_menu(menu, messages, currency_symbol = config['billing']['currency'])
     while True:
         if user_choice is 'w': # User entered unknown order number but does not want to continue
             break
@@ -52,9 +154,62 @@ def take_order(config: dict, language: str = "DE", db_mapper = None) -> dict:
             break
         elif bestell_nr in avail: # 'in' gives the keys for dict, so no need to call .getKeys() method
             bestell_anz = int(input(messages['how_many'].join(" >")))
-            user_selection[(*avail[bestell_nr],bestell_nr)] = bestell_anz # pack key as tuple
+            select_item(user_selection, menu, bestell_nr, bestell_anz)
         else: 
             user_choice = input(messages['unrecognized_input'].format(bestell_nr).join(" >"))
             if user_choice is '':
                 continue
-    return user_selection
\ No newline at end of file
+    return user_selection
+
+class UnitTestOrder(unittest.TestCase):
+
+    REPERTOIRE = {"Getränke": [{"id": 1001, "name": "Wasser", "price": 199}],
+                  "Pizza": [{"id": 2001, "name": "Pizza Margarita", "price": 499},
+                            {"id": 2002, "name": "Pizza Marinara", "price": 599}]}
+
+    def test_index(self):
+        menu = MenuIndex(self.REPERTOIRE)
+        self.assertEqual(len(menu), 3)
+        self.assertEqual(menu.items["2001"], ("Pizza Margarita", 499))
+        self.assertEqual(menu.categories["Pizza"], ("2001", "2002"))
+        self.assertEqual(menu.search("mar"), ("2001", "2002"))
+        self.assertEqual(menu.search("PIZZA marg"), ("2001",))
+        self.assertEqual(menu.search("bier"), ())
+        self.assertIn("  2002. Pizza Marinara à 5.99 €/Stk.", menu.menu_lines("Stk.", "€"))
+        self.assertIn("  1001. Wasser à 1.99/pcs.", menu.menu_lines("pcs.", ""))
+        self.assertEqual(menu.menu_lines("Stk.", "€")[:3], ("Getränke", "~~~~~~~~", ""))
+        with self.assertRaises(AttributeError):
+            menu.items = {}
+        with self.assertRaises(AttributeError):
+            menu.cache = {} # no room for state a session could fill
+        with self.assertRaises(TypeError):
+            menu.items["9999"] = ("Bier", 299)
+
+    def test_shared(self):
+        class Mapper():
+            calls = 0
+            def get_products(self):
+                Mapper.calls += 1
+                return UnitTestOrder.REPERTOIRE
+        reset_menu()
+        try:
+            self.assertIs(shared_menu(Mapper()), shared_menu(Mapper()))
+            self.assertEqual(Mapper.calls, 1)
+            with self.assertRaises(AttributeError):
+                del shared_menu(Mapper()).items
+            selection = {}
+            self.assertTrue(select_item(selection, shared_menu(Mapper()), "1001", 2))
+            self.assertFalse(select_item(selection, shared_menu(Mapper()), "4711", 1))
+            self.assertEqual(selection, {("Wasser", 199, "1001"): 2})
+            menu = MenuIndex({"Pizza": UnitTestOrder.REPERTOIRE["Pizza"]})
+            reset_menu(menu) # catalogue reloaded
+            self.assertIs(shared_menu(Mapper()), menu)
+            self.assertEqual(Mapper.calls, 1)
+        finally:
+            reset_menu()
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -1,18 +1,32 @@
 """
 * ACASA Output Managament Module
-* 
+*
 """
+from concurrent.futures import Future, ProcessPoolExecutor
+import functools
 import os
 from pathlib import Path
+import tempfile
+import threading
+import unittest
 #os.chdir(Path())
-# importing modules
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase import pdfmetrics
-from reportlab.lib import colors
+
+from billing_management import format_cents, receipt_totals
+# reportlab (canvas, TTFont, pdfmetrics, colors) is heavy - import it within the PDF functions only, so that printing
+# to screen and importing this module stay cheap.
+
+RECEIPT_DIRECTORY = "receipts" # below 'output_file_directory'
+RECEIPT_FONT = "ReceiptFont"
+FALLBACK_FONT = "Helvetica" # built into reportlab/PDF, no font file needed
+RECEIPTS_PER_TASK = 50 # receipts rendered per worker call; fewer round trips between the processes
+
+_RECEIPTS_SQL = """SELECT o.id, o.customer, o.order_date, p.name, p.price, i.amount
+            FROM orders o, order_items i, products p
+            WHERE i.order_id = o.id AND i.item_id = p.id AND o.id IN ({})
+            ORDER BY o.id, p.name"""
 
 # TODO convenience method, to replaced by queue
-def print_receipt(order: dict) -> float:
+def print_receipt(order: dict) -> int:
     sum_all = 0
     for bestell_pos in order.keys():
         item = bestell_pos[0]
@@ -24,5 +38,249 @@ def print_receipt(order: dict) -> float:
             ", Anzahl:",
             item_cnt,
             ", Summe: ",
-            sum_pos)
-    return sum_all
\ No newline at end of file
+            format_cents(sum_pos))
+    return sum_all
+
+def receipt_data(db, order_ids: list) -> list:
+    """Everything a receipt shows, read for many orders with one query, e.g. [{"order_id": 17, "customer": "Joe",
+    "order_date": "2023-02-24", "items": [("Pizza Margarita", 499, 2)]}] (prices in cents); unknown order IDs are
+    left out.
+    """
+    receipts = {}
+    for start in range(0, len(order_ids), 500): # SQLite limits the number of parameters
+        chunk = list(order_ids[start:start + 500])
+        rows = db.query(_RECEIPTS_SQL.format(",".join(["?"] * len(chunk))), tuple(chunk))
+        if isinstance(rows, Exception):
+            raise rows
+        for order_id, customer, order_date, name, price, amount in rows:
+            receipt = receipts.setdefault(order_id, {"order_id": order_id, "customer": customer,
+                                                     "order_date": order_date, "items": []})
+            receipt["items"].append((name, price, amount))
+    return [receipts[order_id] for order_id in order_ids if order_id in receipts]
+
+# PDF receipts. Everything that is the same for all receipts - fonts, measures, column positions, header and footer
+# text, fitted product names - is prepared once per (worker) process and cached; per receipt only the item lines are
+# drawn.
+
+_font_name = None
+
+def register_fonts(font_file: str = None) -> str:
+    """Register the receipt font once per process (TTF parsing is expensive); without a font file the built-in
+    Helvetica is used. Returns the font name to draw with.
+    """
+    global _font_name
+    if _font_name is None:
+        if font_file:
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.ttfonts import TTFont
+            pdfmetrics.registerFont(TTFont(RECEIPT_FONT, font_file))
+            _font_name = RECEIPT_FONT
+        else:
+            _font_name = FALLBACK_FONT
+    return _font_name
+
+class _ReceiptLayout():
+    """Pre-laid-out receipt for 80 mm thermal paper: measures in points, the page only grows with the item count.
+    """
+
+    def __init__(self, font_name: str, title: str, footer: str, currency: str, vat_bp: int):
+        from reportlab.lib.units import mm
+        self.font_name = font_name
+        self.font_size = 9
+        self.width = 80 * mm
+        self.margin = 4 * mm
+        self.line_height = 4.2 * mm
+        self.title = title
+        self.footer = footer
+        self.currency = currency
+        self.vat_bp = vat_bp
+        self.amount_x = self.width - 28 * mm # right aligned columns
+        self.sum_x = self.width - self.margin
+        self.name_width = self.amount_x - self.margin - 10 * mm
+        self.header_lines = 4 # title, order, date, rule
+        self.footer_lines = 4 # rule, total, VAT, footer text
+
+    def height(self, item_cnt: int) -> float:
+        return (self.header_lines + item_cnt + self.footer_lines) * self.line_height + 2 * self.margin
+
+    @functools.lru_cache(maxsize=4096) # the menu is small: every product name is measured once per process
+    def fit(self, text: str) -> str:
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        if stringWidth(text, self.font_name, self.font_size) <= self.name_width:
+            return text
+        while text and stringWidth(text + "..", self.font_name, self.font_size) > self.name_width:
+            text = text[:-1]
+        return text + ".."
+
+@functools.lru_cache(maxsize=8)
+def _receipt_layout(font_name: str, title: str, footer: str, currency: str, vat_bp: int) -> _ReceiptLayout:
+    return _ReceiptLayout(font_name, title, footer, currency, vat_bp)
+
+def _draw_receipt(layout: _ReceiptLayout, receipt: dict, file_path: Path):
+    from reportlab.pdfgen import canvas
+    height = layout.height(len(receipt["items"]))
+    pdf = canvas.Canvas(str(file_path), pagesize=(layout.width, height))
+    pdf.setTitle("{} {}".format(layout.title, receipt["order_id"]))
+    y = height - layout.margin - layout.line_height
+    pdf.setFont(layout.font_name, layout.font_size + 3)
+    pdf.drawCentredString(layout.width / 2, y, layout.title)
+    pdf.setFont(layout.font_name, layout.font_size)
+    y -= layout.line_height
+    pdf.drawString(layout.margin, y, "# {} - {}".format(receipt["order_id"], receipt.get("customer") or ""))
+    y -= layout.line_height
+    pdf.drawString(layout.margin, y, str(receipt.get("order_date") or ""))
+    y -= layout.line_height / 2
+    pdf.line(layout.margin, y, layout.sum_x, y)
+    y -= layout.line_height
+    for name, price, amount in receipt["items"]:
+        pdf.drawString(layout.margin, y, layout.fit(name))
+        pdf.drawRightString(layout.amount_x, y, "{} x {}".format(amount, format_cents(price)))
+        pdf.drawRightString(layout.sum_x, y, format_cents(amount * price))
+        y -= layout.line_height
+    y += layout.line_height / 2
+    pdf.line(layout.margin, y, layout.sum_x, y)
+    y -= layout.line_height
+    pdf.setFont(layout.font_name, layout.font_size + 1)
+    totals = receipt_totals(receipt["items"], layout.vat_bp)
+    pdf.drawRightString(layout.sum_x, y, format_cents(totals["gross"], layout.currency))
+    pdf.setFont(layout.font_name, layout.font_size)
+    y -= layout.line_height
+    vat_text = "MwSt. {}% {}".format(format_cents(layout.vat_bp), format_cents(totals["vat"])) # bp print like cents
+    pdf.drawRightString(layout.sum_x, y, vat_text)
+    y -= layout.line_height
+    pdf.drawCentredString(layout.width / 2, y, layout.footer)
+    pdf.showPage()
+    pdf.save()
+
+def render_receipts(receipts: list, output_dir: Path, font_file: str = None, title: str = "ACASA",
+                    footer: str = "", currency: str = "€", vat_bp: int = 0) -> list:
+    """Render receipts (s. receipt_data()) into '<output_dir>/receipt-<order_id>.pdf' in THIS process; files are
+    written under a unique temporary name and renamed, so readers never see half-written PDFs and concurrent renders
+    of the same receipt do not collide.
+
+    Returns:
+        list: Paths of the written files (str), in the order of 'receipts'.
+    """
+    layout = _receipt_layout(register_fonts(font_file), title, footer, currency, vat_bp)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for receipt in receipts:
+        file_path = Path(output_dir, "receipt-{}.pdf".format(receipt["order_id"]))
+        tmp_fd, tmp_path = tempfile.mkstemp(suffix=".tmp", prefix=file_path.stem + "-", dir=output_dir)
+        os.close(tmp_fd) # reportlab opens the file by name
+        try:
+            _draw_receipt(layout, receipt, tmp_path)
+            os.replace(tmp_path, file_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        paths.append(str(file_path))
+    return paths
+
+def _init_worker(font_file: str):
+    register_fonts(font_file)
+
+class ReceiptRenderer():
+    """Renders receipts in a pool of processes, so neither order intake nor the web loop wait for reportlab; fonts are
+    registered once per worker (initializer), the layout is cached per worker.
+    Args:
+        output_config (dict): config.yaml 'output_management' ('output_file_directory', optional 'font_file',
+            'receipt_title', 'receipt_footer', 'receipt_workers').
+        currency (str, optional): Shown with the total, s. config.yaml 'billing'.
+        vat_bp (int, optional): VAT rate included in the prices, in basis points, s. billing_management.
+    """
+
+    def __init__(self, output_config: dict, currency: str = "€", vat_bp: int = 0):
+        self.output_dir = Path(output_config["output_file_directory"], RECEIPT_DIRECTORY)
+        self._font_file = output_config.get("font_file")
+        self._options = {"title": output_config.get("receipt_title", "ACASA"),
+                         "footer": output_config.get("receipt_footer", ""), "currency": currency, "vat_bp": vat_bp}
+        self._pool = ProcessPoolExecutor(max_workers=output_config.get("receipt_workers"),
+                                         initializer=_init_worker, initargs=(self._font_file,))
+
+    def submit_batch(self, receipts: list) -> Future:
+        """Start rendering and return at once; the future's result is the list of written files. Usable from asyncio
+        via asyncio.wrap_future().
+        """
+        tasks = [self._pool.submit(render_receipts, receipts[start:start + RECEIPTS_PER_TASK], self.output_dir,
+                                   self._font_file, **self._options)
+                 for start in range(0, len(receipts), RECEIPTS_PER_TASK)]
+        batch = Future()
+        pending = [len(tasks)]
+
+        def task_done(task: Future):
+            if batch.done():
+                return
+            if task.exception() is not None:
+                batch.set_exception(task.exception())
+                return
+            pending[0] -= 1
+            if pending[0] == 0:
+                batch.set_result([path for done_task in tasks for path in done_task.result()])
+
+        if not tasks:
+            batch.set_result([])
+        for task in tasks:
+            task.add_done_callback(task_done)
+        return batch
+
+    def render_batch(self, receipts: list) -> list:
+        """Like submit_batch(), but waits for the files.
+        """
+        return self.submit_batch(receipts).result()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+
+class UnitTestReceipts(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = Path(self._tmp_dir.name, RECEIPT_DIRECTORY)
+        self.receipts = [{"order_id": order_id, "customer": "Joe", "order_date": "2023-02-24",
+                          "items": [("Pizza Margarita", 499, 2), ("Tiramisu " * 10, 350, 1)]}
+                         for order_id in (17, 18)]
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def test_render(self):
+        paths = render_receipts(self.receipts, self.output_dir, footer="Grazie!", vat_bp=1900)
+        self.assertEqual(paths, [str(Path(self.output_dir, "receipt-17.pdf")),
+                                 str(Path(self.output_dir, "receipt-18.pdf"))])
+        for path in paths:
+            self.assertEqual(Path(path).read_bytes()[:5], b"%PDF-")
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["receipt-17.pdf", "receipt-18.pdf"])
+
+    def test_concurrent_renders(self):
+        errors = []
+
+        def render():
+            try:
+                render_receipts(self.receipts[:1], self.output_dir)
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=render) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(os.listdir(self.output_dir), ["receipt-17.pdf"]) # no temporary files left
+
+    def test_renderer(self):
+        renderer = ReceiptRenderer({"output_file_directory": self._tmp_dir.name, "receipt_workers": 2})
+        try:
+            self.assertEqual(len(renderer.render_batch(self.receipts * 30)), 60)
+            self.assertEqual(renderer.render_batch([]), [])
+        finally:
+            renderer.close()
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ["receipt-17.pdf", "receipt-18.pdf"])
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
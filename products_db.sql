@@ -15,7 +15,7 @@ CREATE TABLE IF NOT EXISTS categories (
 CREATE TABLE IF NOT EXISTS products (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL,
-    price REAL,
+    price MONEY,
     category_id INTEGER,
     FOREIGN KEY (category_id) REFERENCES categories(id)
 );
@@ -26,7 +26,9 @@ CREATE TABLE IF NOT EXISTS orders (
     status INTEGER NOT NULL DEFAULT 0,
     order_date DATE
 );
-CREATE TABLE order_items (
+-- Open orders only (status below 3 = served, s. kitchen_management.py), read oldest first by the kitchen display
+CREATE INDEX IF NOT EXISTS orders_open ON orders (id) WHERE status < 3;
+CREATE TABLE IF NOT EXISTS order_items (
     order_id INTEGER,
     item_id INTEGER,
     amount INTEGER,
@@ -34,3 +36,28 @@ CREATE TABLE order_items (
     FOREIGN KEY (item_id) REFERENCES products(id)
     PRIMARY KEY (order_id,item_id)
 );
+
+-- Materialized per day x product sales figures; maintained on every order item written (s. report_management.py)
+CREATE TABLE IF NOT EXISTS daily_sales (
+    sales_day DATE NOT NULL,
+    product_id INTEGER NOT NULL,
+    category_id INTEGER,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue MONEY NOT NULL DEFAULT 0,
+    PRIMARY KEY (sales_day, product_id)
+);
+
+-- Product pictures, stored once per content (id: SHA-256 of the data), s. image_management.py
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    content_type TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS product_images (
+    product_id INTEGER PRIMARY KEY,
+    image_id TEXT NOT NULL,
+    FOREIGN KEY (product_id) REFERENCES products(id),
+    FOREIGN KEY (image_id) REFERENCES images(id)
+);
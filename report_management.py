@@ -0,0 +1,126 @@
+# ACASA Report Management
+# Dashboards read the 'daily_sales' table (one row per day x product) instead of rescanning all 'order_items'; the table
+# is maintained incrementally by a WriteListener registered on the SQLiteInstance, s. main.py.
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+
+from db import DataObject, SQLCode, SQLiteInstance, WriteListener, WriteOperations
+
+DAILY_SALES_TABLE = "daily_sales"
+
+# Price is taken from 'products' at the time the item is written, so later price changes do not alter past revenue.
+_ADD_ITEM_SQL = """INSERT INTO daily_sales (sales_day, product_id, category_id, quantity, revenue)
+            SELECT o.order_date, p.id, p.category_id, ?, ? * p.price
+            FROM orders o, products p
+            WHERE o.id = ? AND p.id = ?
+            ON CONFLICT (sales_day, product_id) DO UPDATE SET
+                quantity = quantity + excluded.quantity,
+                revenue = revenue + excluded.revenue"""
+
+_CLEAR_SQL = "DELETE FROM daily_sales"
+
+_REBUILD_SQL = """INSERT INTO daily_sales (sales_day, product_id, category_id, quantity, revenue)
+            SELECT o.order_date, p.id, p.category_id, SUM(i.amount), SUM(i.amount * p.price)
+            FROM order_items i, orders o, products p
+            WHERE i.order_id = o.id AND i.item_id = p.id
+            GROUP BY o.order_date, p.id"""
+
+_DAILY_SALES_SQL = """SELECT s.sales_day, p.name AS product_name, c.name AS category_name, s.quantity, s.revenue
+            FROM daily_sales s
+            LEFT JOIN products p ON s.product_id = p.id
+            LEFT JOIN categories c ON s.category_id = c.id
+            WHERE s.sales_day BETWEEN ? AND ?
+            ORDER BY s.sales_day, c.name, p.name"""
+
+_SALES_BY_CATEGORY_SQL = """SELECT s.sales_day, c.name AS category_name, SUM(s.quantity), SUM(s.revenue)
+            FROM daily_sales s
+            LEFT JOIN categories c ON s.category_id = c.id
+            WHERE s.sales_day BETWEEN ? AND ?
+            GROUP BY s.sales_day, c.name
+            ORDER BY s.sales_day, c.name"""
+
+
+class DailySalesAggregate(WriteListener):
+    """Adds every inserted order item to the aggregate row of its (day, product). Runs in the transaction of the item
+    itself, so aggregates never get out of sync with committed items. Updates and deletes of order items are not
+    reflected - use rebuild_daily_sales() after such corrections.
+    """
+
+    def on_write(self, cursor, operation: str, data_object: DataObject):
+        if operation != WriteOperations.INSERT or data_object.table_name() != "order_items":
+            return
+        item = data_object.merge_columns()
+        cursor.execute(_ADD_ITEM_SQL, (item["amount"], item["amount"], item["order_id"], item["item_id"]))
+
+
+def rebuild_daily_sales(db: SQLiteInstance) -> SQLCode:
+    """Recompute the aggregates from all order items (backfill, or after corrections of past orders).
+
+    Args:
+        db (SQLiteInstance): The database holding orders and aggregates.
+
+    Returns:
+        SQLCode: SQLCodes.SUCCESS or the error; on error, the previous aggregates are kept.
+    """
+    return db._execute_sql_list([_CLEAR_SQL, _REBUILD_SQL])
+
+
+def daily_sales(db: SQLiteInstance, from_day: str, to_day: str) -> list:
+    """Sales per day and product, e.g. [('2023-02-24', 'Pizza Margarita', 'Pizzas', 3, 1497), ..] (revenue in cents).
+    """
+    return db.query(_DAILY_SALES_SQL, (from_day, to_day))
+
+
+def sales_by_category(db: SQLiteInstance, from_day: str, to_day: str) -> list:
+    """Sales per day and category, e.g. [('2023-02-24', 'Pizzas', 5, 2695), ..] (revenue in cents).
+    """
+    return db.query(_SALES_BY_CATEGORY_SQL, (from_day, to_day))
+
+
+class UnitTestDailySales(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        db_path = Path(self._tmp_dir.name, "test.db3")
+        with sqlite3.connect(db_path) as conn:
+            conn.executescript("""
+                CREATE TABLE categories (id INTEGER PRIMARY KEY, name TEXT);
+                CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT, price MONEY, category_id INTEGER);
+                CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, customer TEXT NOT NULL,
+                    status INTEGER NOT NULL DEFAULT 0, order_date DATE);
+                CREATE TABLE order_items (order_id INTEGER, item_id INTEGER, amount INTEGER,
+                    PRIMARY KEY (order_id, item_id));
+                CREATE TABLE daily_sales (sales_day DATE NOT NULL, product_id INTEGER NOT NULL, category_id INTEGER,
+                    quantity INTEGER NOT NULL DEFAULT 0, revenue MONEY NOT NULL DEFAULT 0,
+                    PRIMARY KEY (sales_day, product_id));
+                INSERT INTO categories VALUES (2000, 'Pizzas');
+                INSERT INTO products VALUES (2001, 'Pizza Margarita', 499, 2000);
+            """)
+        conn.close()
+        self.db = SQLiteInstance(db_path)
+        self.db.add_write_listener(DailySalesAggregate())
+
+    def tearDown(self):
+        self._tmp_dir.cleanup()
+
+    def _order(self, amount: int):
+        order_id = self.db.insert(DataObject("orders", {"id": None, "customer": "Joe", "order_date": "2023-02-24"},
+                                             {"id"}))
+        self.db.insert(DataObject("order_items", {"order_id": order_id, "item_id": 2001, "amount": amount},
+                                  {"order_id", "item_id"}))
+
+    def test_incremental_equals_rebuild(self):
+        self._order(2)
+        self._order(3)
+        incremental = daily_sales(self.db, "2023-02-24", "2023-02-24")
+        self.assertEqual(incremental, [("2023-02-24", "Pizza Margarita", "Pizzas", 5, 2495)])
+        rebuild_daily_sales(self.db)
+        self.assertEqual(daily_sales(self.db, "2023-02-24", "2023-02-24"), incremental)
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
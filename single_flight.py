@@ -0,0 +1,131 @@
+# ACASA Single Flight
+# Coalesces concurrent computations of the same thing: the first caller for a key computes, callers arriving while it
+# runs wait for and share its result (or exception) instead of computing again. A cold or invalidated cache (catalogue,
+# rendered pages) is thus rebuilt once, however many requests arrive at the same time. Nothing is cached here - the
+# key is free again as soon as the computation has finished; callers put the result into their cache themselves.
+# SingleFlight is for threads (e.g. the change feed, CLI), AsyncSingleFlight for coroutines on one event loop (web).
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+import unittest
+
+
+class SingleFlight():
+    """Thread-safe; do() blocks the callers of a key until the first one has computed the value.
+    """
+
+    def __init__(self):
+        self._flights = {} # key => Future
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """Returns func() - computed by this or a concurrent caller of 'key'; raises what func() raised.
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return future.result()
+
+
+class AsyncSingleFlight():
+    """For coroutines of one event loop; the computation runs as a task of its own, so a caller that is cancelled (the
+    client went away) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._flights = {} # key => asyncio.Task
+        self.calls = 0
+        self.coalesced = 0
+
+    def start(self, key, coro_func) -> asyncio.Task:
+        """The running computation of 'key', or a new one of 'coro_func()'; e.g. to revalidate in the background.
+        """
+        task = self._flights.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return task
+        self.calls += 1
+        task = self._flights[key] = asyncio.ensure_future(coro_func())
+        task.add_done_callback(lambda done: self._done(key, done))
+        return task
+
+    def _done(self, key, task: asyncio.Task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled() and task.exception() is not None: # retrieved: no warning if nobody waited
+            print("Single flight {} failed: {}".format(key, task.exception()))
+
+    async def do(self, key, coro_func):
+        return await asyncio.shield(self.start(key, coro_func))
+
+    def in_flight(self, key) -> bool:
+        return key in self._flights
+
+
+class UnitTestSingleFlight(unittest.TestCase):
+
+    def test_threads(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def rebuild():
+            started.set()
+            release.wait(5)
+            return {"menu": 1}
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            leader = executor.submit(flight.do, "catalogue", rebuild)
+            started.wait(5)
+            followers = [executor.submit(flight.do, "catalogue", rebuild) for _ in range(19)]
+            while flight.coalesced < 19:
+                time.sleep(0.001)
+            release.set()
+            results = [leader.result()] + [follower.result() for follower in followers]
+        self.assertEqual((flight.calls, flight.coalesced), (1, 19))
+        self.assertTrue(all(result is results[0] for result in results)) # the same object for everybody
+        with self.assertRaises(ZeroDivisionError): # not cached: the next call computes (and fails) again
+            flight.do("catalogue", lambda: 1 / 0)
+        self.assertEqual(flight.calls, 2)
+
+    def test_async(self):
+        async def scenario():
+            flight = AsyncSingleFlight()
+            renders = []
+
+            async def render():
+                renders.append(1)
+                await asyncio.sleep(0.01)
+                return b"<html>"
+
+            pages = await asyncio.gather(*[flight.do(("/menue", "DE"), render) for _ in range(100)])
+            self.assertEqual((len(renders), pages[0], len(set(pages))), (1, b"<html>", 1))
+            waiter = asyncio.ensure_future(flight.do("/", render))
+            await asyncio.sleep(0)
+            waiter.cancel() # e.g. the client disconnected
+            self.assertEqual(await flight.do("/", render), b"<html>")
+            self.assertEqual((len(renders), flight.in_flight("/")), (2, False))
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
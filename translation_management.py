@@ -0,0 +1,244 @@
+# ACASA Translation Management
+# Translations are maintained in JSON files like translations.json ({"DE": {"key": "text", ..}, "EN": {..}}), imported
+# in bulk into the Arango 'Translations' collection and served from a process-local lookup table: one flat dict per
+# language with the fallback languages already merged in, so a lookup is a single dict access without database hits.
+# Every process checks the collection's revision periodically (s. refresh_periodically()) and reloads it on changes.
+import asyncio
+import json
+from pathlib import Path
+import sys
+import tempfile
+import threading
+import unittest
+
+DEFAULT_LANGUAGE = "EN"
+IMPORT_BATCH_SIZE = 1000
+
+
+def read_translation_file(file_path: Path) -> list:
+    """Read a translation file into documents for the 'Translations' collection, e.g.
+    {"_key": "DE.how_many", "language": "DE", "key": "how_many", "text": "Wie viele?"}
+    """
+    with open(file_path, mode="r", encoding="UTF-8") as transl_file:
+        content = transl_file.read().strip()
+    by_language = json.loads(content) if content else {}
+    return [{"_key": "{}.{}".format(language, key), "language": language, "key": key, "text": text}
+            for language in by_language for key, text in by_language[language].items()]
+
+
+def load_translations(transl_coll, file_paths: list, batch_size: int = IMPORT_BATCH_SIZE) -> int:
+    """Import translation files into the 'Translations' collection; existing keys are replaced.
+
+    Args:
+        transl_coll (_type_): The Arango collection.
+        file_paths (list): Translation files (JSON).
+        batch_size (int, optional): Documents per import_bulk call. Defaults to IMPORT_BATCH_SIZE.
+
+    Returns:
+        int: Number of documents imported.
+    """
+    docs = []
+    for file_path in file_paths:
+        docs.extend(read_translation_file(file_path))
+    for start in range(0, len(docs), batch_size):
+        transl_coll.import_bulk(docs[start:start + batch_size], on_duplicate="replace", halt_on_error=True)
+    return len(docs)
+
+
+class TranslationTable():
+    """Immutable once built: per language one dict 'key => text' in which the fallback chain is already resolved
+    (e.g. DE -> EN: keys missing in DE are taken from EN). Keys are interned.
+    Args:
+        by_language (dict): {"DE": {"key": "text"}, ..}
+        fallbacks (dict, optional): {"DE": ["EN"], ..}; languages without entry fall back to DEFAULT_LANGUAGE.
+        revision (str, optional): Identifies the source state, s. refresh_if_changed().
+    """
+
+    def __init__(self, by_language: dict, fallbacks: dict = None, revision: str = None):
+        self.revision = revision
+        fallbacks = fallbacks or {}
+        self._compiled = {}
+        for language in by_language:
+            chain = [language] + list(fallbacks.get(language, [DEFAULT_LANGUAGE]))
+            compiled = {}
+            for chain_language in reversed(chain):  # most specific language last, so it wins
+                for key, text in by_language.get(chain_language, {}).items():
+                    compiled[sys.intern(key)] = text
+            self._compiled[language] = compiled
+        self._default = self._compiled.get(DEFAULT_LANGUAGE, {})
+
+    def messages(self, language: str) -> dict:
+        return self._compiled.get(language, self._default)
+
+    def text(self, key: str, language: str = DEFAULT_LANGUAGE) -> str:
+        return self.messages(language).get(key, key)  # untranslated keys show up as themselves
+
+    def languages(self) -> list:
+        return list(self._compiled.keys())
+
+
+_table = TranslationTable({})
+_refresh_lock = threading.Lock()
+
+
+def current() -> TranslationTable:
+    return _table
+
+
+def install(by_language: dict, fallbacks: dict = None, revision: str = None) -> TranslationTable:
+    """Build a new table and swap it in; readers holding the old table keep using it consistently.
+    """
+    global _table
+    new_table = TranslationTable(by_language, fallbacks, revision)
+    _table = new_table  # atomic reference swap
+    return new_table
+
+
+def messages(language: str) -> dict:
+    return _table.messages(language)
+
+
+def text(key: str, language: str = DEFAULT_LANGUAGE) -> str:
+    return _table.text(key, language)
+
+
+def merge_files(by_language: dict, file_paths: list) -> dict:
+    """Add the contents of translation files to 'by_language' (e.g. built-in messages), returns a new dict.
+    """
+    merged = {language: dict(by_language[language]) for language in by_language}
+    for file_path in file_paths:
+        for doc in read_translation_file(file_path):
+            merged.setdefault(doc["language"], {})[doc["key"]] = doc["text"]
+    return merged
+
+
+def refresh_from_store(transl_coll, base: dict = None, fallbacks: dict = None) -> TranslationTable:
+    """Re-read the whole 'Translations' collection (on top of 'base') and swap the table in.
+    """
+    with _refresh_lock:
+        revision = transl_coll.revision()
+        by_language = {language: dict(base[language]) for language in base or {}}
+        for doc in transl_coll.all():
+            by_language.setdefault(doc["language"], {})[doc["key"]] = doc["text"]
+        return install(by_language, fallbacks, revision)
+
+
+def refresh_if_changed(transl_coll, base: dict = None, fallbacks: dict = None) -> bool:
+    """Change notification hook: cheap revision check, full reload only if the collection was modified.
+    """
+    if transl_coll.revision() == _table.revision:
+        return False
+    refresh_from_store(transl_coll, base, fallbacks)
+    return True
+
+
+async def refresh_periodically(refresh, interval: float = 30.0):
+    """Web servers: run 'refresh' (e.g. refresh_if_changed() of the collection) every 'interval' seconds in a thread,
+    until the task is cancelled; failures are reported and retried next time.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(refresh)
+        except Exception as ex:
+            print("Translations not refreshed: {}".format(ex))
+
+
+def refresh_while_serving(web_app, refresh, interval: float = 30.0):
+    """Run refresh_periodically() while the (Quart) web_app serves; 'refresh' None: nothing to do.
+    """
+    if refresh is None:
+        return
+    tasks = []
+
+    @web_app.before_serving
+    async def start_translation_refresh():
+        tasks.append(asyncio.ensure_future(refresh_periodically(refresh, interval)))
+
+    @web_app.after_serving
+    async def stop_translation_refresh():
+        for task in tasks:
+            task.cancel()
+
+
+def best_language(accept_languages) -> str:
+    """The language of the current table the client prefers ('Accept-Language', e.g. Quart's request.accept_languages).
+    """
+    return accept_languages.best_match(_table.languages(), default=DEFAULT_LANGUAGE)
+
+
+def translator(language_func):
+    """Template global: {{ t('key') }} in the language returned by 'language_func' (e.g. the request's), or
+    {{ t('key', 'DE') }}; always from the table installed at the time of the call.
+    """
+    def translate(key, language=None):
+        return _table.text(key, language or language_func())
+    return translate
+
+
+class UnitTestTranslations(unittest.TestCase):
+
+    class _Collection():
+
+        def __init__(self, docs: list):
+            self.docs = docs
+            self.rev = "1"
+
+        def revision(self):
+            return self.rev
+
+        def all(self):
+            return iter(self.docs)
+
+    def tearDown(self):
+        install({})
+
+    def test_fallbacks(self):
+        table = install({"EN": {"hello": "Hello", "bye": "Bye"}, "DE": {"hello": "Hallo"}, "FR": {"hello": "Salut"}},
+                        {"DE": ["EN"], "FR": []})
+        self.assertEqual([text("hello", "DE"), text("bye", "DE"), text("bye", "FR"), text("hello", "IT")],
+                         ["Hallo", "Bye", "bye", "Hello"]) # FR without fallback, IT unknown: default language
+        self.assertIs(current(), table)
+        translate = translator(lambda: "DE")
+        self.assertEqual((translate("hello"), translate("hello", "EN")), ("Hallo", "Hello"))
+
+    def test_files_and_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = Path(tmp_dir, "translations.json")
+            file_path.write_text(json.dumps({"DE": {"how_many": "Wie viele?"}}), encoding="UTF-8")
+            docs = read_translation_file(file_path)
+            self.assertEqual(docs, [{"_key": "DE.how_many", "language": "DE", "key": "how_many",
+                                     "text": "Wie viele?"}])
+            merged = merge_files({"DE": {"yes": "Ja"}}, [file_path])
+        self.assertEqual(merged, {"DE": {"yes": "Ja", "how_many": "Wie viele?"}})
+        collection = self._Collection(docs)
+        self.assertTrue(refresh_if_changed(collection, base={"DE": {"yes": "Ja"}}))
+        self.assertEqual((text("how_many", "DE"), text("yes", "DE")), ("Wie viele?", "Ja"))
+        self.assertFalse(refresh_if_changed(collection)) # same revision: nothing reloaded
+        collection.docs, collection.rev = [dict(docs[0], text="Wieviel?")], "2"
+        refreshed = []
+        hooks = {}
+
+        class WebApp(): # the serving hooks of Quart
+
+            def before_serving(self, func):
+                hooks["before"] = func
+
+            def after_serving(self, func):
+                hooks["after"] = func
+
+        refresh_while_serving(WebApp(), lambda: refreshed.append(refresh_if_changed(collection)), interval=0.01)
+
+        async def scenario():
+            await hooks["before"]()
+            while len(refreshed) < 2:
+                await asyncio.sleep(0.01)
+            await hooks["after"]()
+        asyncio.run(scenario())
+        self.assertEqual((refreshed[:2], text("how_many", "DE")), ([True, False], "Wieviel?"))
+
+
+if __name__ == "__main__":
+    print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
+    print("Will run unit test now..")
+    unittest.main()
@@ -1,14 +1,28 @@
 # Shared web objects
 from abc import ABC, abstractmethod
+import asyncio
+from collections import OrderedDict
 import importlib
+import logging
 import os
 from pathlib import Path
-from quart import Quart, session, render_template, request
+from quart import Quart, g, session, redirect, render_template, request
 import random
+import threading
+import time
+import unittest
 import yaml
+import admission_control as ADMISSION
+import file_server as FILE_SERVER
+import metrics as METRICS
+import translation_management as TRANSL_MGMT
 
 SCRIPT_PATH = Path(__name__).parent.resolve()
 
+LOG = logging.getLogger(__name__)
+
+SESSION_COOKIE_NAME = "acasa_session"
+
 DEFAULT_CONFIG = { # Defaults taken from Quart API
     "import_name": "DEFAULT",
     "static_url_path": "/",
@@ -33,7 +47,19 @@ class ContextCache(dict):
         self._protected_dict = dict()
 
     def __getitem__(self, key):
-        return self._protected_dict[key]
+        try:
+            value = self._protected_dict[key]
+        except KeyError:
+            METRICS.CACHE_LOOKUPS.inc("context", key, "miss")
+            raise
+        METRICS.CACHE_LOOKUPS.inc("context", key, "hit")
+        return value
+
+    def get(self, key, default = None): # dict.get() would not see the protected dict
+        try:
+            return self[key]
+        except KeyError:
+            return default
     
     def __setitem__(self, key, value):
         self._protected_dict[key] = value
@@ -70,7 +96,114 @@ class WebStore(ABC):
     def create_user(self, name: str = "", email: str = ""):
         raise NotImplementedError("Should not happen..")
 
-def create_instance(root: Path = SCRIPT_PATH, doc_store: WebStore = None, global_cache: ContextCache = None) -> Quart:
+    @abstractmethod
+    def logout(self, cookie):
+        """End the session belonging to the cookie; afterwards get_user_for_cookie() must not find the user any more.
+        """
+        raise NotImplementedError("Should not happen..")
+
+class CachingWebStore(WebStore):
+    """
+        Session resolution layer around another WebStore: resolved users are kept in a local LRU with TTL, unknown 
+        cookies are cached as well (shorter TTL), so authenticated page loads usually do not hit the document store.
+        logout() (route '/logout') drops the cached entry before and after delegating; a lookup that was running
+        meanwhile does not put its (outdated) result into the cache. Note: each worker process has its own cache, so a
+        logout in another worker becomes effective here at the latest after 'ttl' seconds.
+    Args:
+        delegate (WebStore): The store that actually resolves sessions (e.g. Arango).
+        max_entries (int): Size of the LRU.
+        ttl (float): Seconds a resolved user is served from the cache.
+        negative_ttl (float): Seconds an unknown cookie is remembered as unknown.
+    """
+    _UNKNOWN = object() # negative cache entry
+    NOT_CACHED = object() # s. cached_user()
+
+    def __init__(self, delegate: WebStore, max_entries: int = 10000, ttl: float = 300.0, negative_ttl: float = 30.0):
+        super().__init__()
+        self._delegate = delegate
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._sessions = OrderedDict() # cookie => (expires_at, user or _UNKNOWN)
+        self._generation = 0 # incremented by invalidate(); lookups started before are not cached
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_prepared(self):
+        return self._delegate.is_prepared()
+
+    def prepare(self):
+        self._delegate.prepare()
+        return self
+
+    def cached_user(self, cookie):
+        """The user of the cookie if cached (None: known to be unknown), else NOT_CACHED; never asks the delegate, so
+        it can be called on the event loop.
+        """
+        with self._lock:
+            entry = self._sessions.get(cookie)
+            if entry is None or entry[0] <= time.monotonic():
+                return self.NOT_CACHED
+            self._sessions.move_to_end(cookie)
+            self.hits += 1
+        METRICS.CACHE_LOOKUPS.inc("session", "user", "hit")
+        return None if entry[1] is self._UNKNOWN else entry[1]
+
+    def get_user_for_cookie(self, cookie):
+        user = self.cached_user(cookie)
+        if user is not self.NOT_CACHED:
+            return user
+        now = time.monotonic()
+        with self._lock:
+            self.misses += 1
+            generation = self._generation
+        METRICS.CACHE_LOOKUPS.inc("session", "user", "miss")
+        user = self._delegate.get_user_for_cookie(cookie)
+        with self._lock:
+            if generation != self._generation: # invalidated (e.g. logout) while looking up
+                return user
+            if user is None:
+                self._sessions[cookie] = (now + self._negative_ttl, self._UNKNOWN)
+            else:
+                self._sessions[cookie] = (now + self._ttl, user)
+            self._sessions.move_to_end(cookie)
+            while len(self._sessions) > self._max_entries:
+                self._sessions.popitem(last=False)
+        return user
+
+    def create_user(self, name: str = "", email: str = ""):
+        return self._delegate.create_user(name, email)
+
+    def logout(self, cookie):
+        self.invalidate(cookie)
+        try:
+            return self._delegate.logout(cookie)
+        finally:
+            self.invalidate(cookie) # cached by a lookup that started between invalidate() and the delegate's logout
+
+    def invalidate(self, cookie = None):
+        """Forget one cookie, or all of them if None is given.
+        """
+        with self._lock:
+            self._generation += 1
+            if cookie is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(cookie, None)
+
+async def user_for_cookie(store: WebStore, cookie):
+    """The user of a session cookie; a CachingWebStore answers cached sessions at once, only lookups in the document
+    store (blocking) run in a thread.
+    """
+    if isinstance(store, CachingWebStore):
+        user = store.cached_user(cookie)
+        if user is not CachingWebStore.NOT_CACHED:
+            return user
+    return await asyncio.to_thread(store.get_user_for_cookie, cookie)
+
+def create_instance(root: Path = SCRIPT_PATH, doc_store: WebStore = None, global_cache: ContextCache = None,
+                    file_mounts: list = None, admission: dict = None, metrics_allow: list = None) -> Quart:
     """
         A deployment must have a predefined structure, e.g. the config file must be named 'config.yaml' and must have an
         entry 'quart' etc.
@@ -78,6 +211,11 @@ def create_instance(root: Path = SCRIPT_PATH, doc_store: WebStore = None, global
         root (Path, optional): _description_. Defaults to SCRIPT_PATH.
         doc_store (Documentstore, optional): _description_. Defaults to None.
         global_cache (ContextCache, optional): _description_. Defaults to None.
+        file_mounts (list, optional): More folders to serve, as file_server.Mount (e.g. receipts). Defaults to None.
+        admission (dict, optional): Limits of concurrent requests, s. admission_control.from_config(). Defaults to
+            None (unlimited).
+        metrics_allow (list, optional): Networks that may scrape GET /metrics, e.g. ["10.0.0.0/8"]. Defaults to None
+            (the host itself).
 
     Raises:
         RuntimeError: If no web database is provided.
@@ -117,24 +255,137 @@ def create_instance(root: Path = SCRIPT_PATH, doc_store: WebStore = None, global
     )
     
     _apply_configuration(web_app, config, doc_store)
+    # edited translations are picked up while running, s. main.py 'refresh_translations'
+    TRANSL_MGMT.refresh_while_serving(web_app, global_cache.get('refresh_translations'),
+                                      config.get("translation_refresh_seconds", 30))
 
     # TODO this is just an intermediate solution: __init__.py cannot implement an I/F!
     root_package = os.path.basename(os.path.normpath(root_resolved))
     rp = importlib.import_module(root_package)
     site_map = rp.apply_routes(web_app, render_template, global_cache)
 
+    # Under a rush the excess requests are rejected at once (503) instead of slowing down all, s. admission_control.py
+    if admission is not None:
+        web_app.asgi_app = ADMISSION.AdmissionControl(web_app.asgi_app, **ADMISSION.from_config(admission))
+    # Files bypass Quart: sent zero-copy (sendfile/mmap) with ranges and an open-file cache, s. file_server.py
+    web_app.asgi_app = FILE_SERVER.FileServer(web_app.asgi_app,
+                                              [FILE_SERVER.Mount(static_url_path, static_path)] + (file_mounts or []))
+    # Outermost, so that files and rejected requests are measured as well; GET /metrics for Prometheus, s. metrics.py
+    web_app.asgi_app = METRICS.MetricsMiddleware(web_app.asgi_app, allow=metrics_allow or METRICS.LOOPBACK,
+                                                 untimed=ADMISSION.UNLIMITED_PATHS)
+
     return web_app
 
 # apply cross-cutting concerns, e.g. authentication against a database
 def _apply_configuration(web_app, config, app_store):
-    print("Applying the configuration  to the web_app instance.. (TODO)")
+    LOG.info("Applying the configuration to the web_app instance %s", web_app.name)
 
-    #@web_app.route("/")
-    def check_cookie():
-        print("Req-Headers:", request.access_control_request_headers)
+    # Resolve the user once per request; app_store should cache (s. CachingWebStore), as this runs on every request.
+    # Only a lookup in the document store blocks and runs in a thread, s. user_for_cookie().
+    @web_app.before_request
+    async def resolve_user():
+        cookie = request.cookies.get(SESSION_COOKIE_NAME)
+        g.user = await user_for_cookie(app_store, cookie) if cookie else None
+        g.language = TRANSL_MGMT.best_language(request.accept_languages)
+
+    @web_app.context_processor
+    async def inject_user():
+        return {"user": g.get("user")}
+
+    @web_app.route("/logout", methods=["POST"])
+    async def logout():
+        cookie = request.cookies.get(SESSION_COOKIE_NAME)
+        if cookie:
+            await asyncio.to_thread(app_store.logout, cookie)
+        response = redirect("/")
+        response.delete_cookie(SESSION_COOKIE_NAME)
+        return response
+
+    # In templates: {{ t('menu_today') }}; served from the process-local table, no database hit
+    web_app.add_template_global(TRANSL_MGMT.translator(lambda: g.get("language", TRANSL_MGMT.DEFAULT_LANGUAGE)), "t")
 
 # everything executed when module is imported (initialization)
 
+class UnitTestCachingWebStore(unittest.TestCase):
+
+    class _Store(WebStore):
+
+        def __init__(self):
+            super().__init__()
+            self.sessions = {"c1": {"name": "Joe"}}
+            self.lookups = 0
+            self.looking_up = threading.Event()
+            self.release = threading.Event()
+            self.release.set()
+
+        def is_prepared(self):
+            return True
+
+        def prepare(self):
+            return self
+
+        def get_user_for_cookie(self, cookie):
+            self.lookups += 1
+            user = self.sessions.get(cookie)
+            self.looking_up.set()
+            self.release.wait(5)
+            return user
+
+        def create_user(self, name: str = "", email: str = ""):
+            pass
+
+        def logout(self, cookie):
+            self.sessions.pop(cookie, None)
+
+    def test_cache(self):
+        store = self._Store()
+        cache = CachingWebStore(store, max_entries=2)
+        self.assertEqual([cache.get_user_for_cookie(cookie) for cookie in ("c1", "c1", "xx", "xx")],
+                         [{"name": "Joe"}, {"name": "Joe"}, None, None])
+        self.assertEqual((store.lookups, cache.hits, cache.misses), (2, 2, 2))
+        self.assertEqual((cache.cached_user("c1"), cache.cached_user("xx")), ({"name": "Joe"}, None))
+        self.assertIs(cache.cached_user("c2"), CachingWebStore.NOT_CACHED)
+        self.assertEqual(asyncio.run(user_for_cookie(cache, "c1")), {"name": "Joe"})
+        self.assertEqual(store.lookups, 2) # answered from the cache
+        cache.logout("c1")
+        self.assertIsNone(cache.get_user_for_cookie("c1"))
+
+    def test_no_stale_entry_after_logout(self):
+        store = self._Store()
+        cache = CachingWebStore(store)
+        store.release.clear()
+        lookup = threading.Thread(target=cache.get_user_for_cookie, args=("c1",))
+        lookup.start()
+        store.looking_up.wait(5) # the lookup has read the session, but not cached it yet
+        cache.logout("c1")
+        store.release.set()
+        lookup.join()
+        self.assertIsNone(cache.get_user_for_cookie("c1"))
+
+    def test_logout_route(self):
+        store = self._Store()
+        cache = CachingWebStore(store)
+        web_app = Quart(__name__)
+        _apply_configuration(web_app, {}, cache)
+
+        @web_app.route("/")
+        async def index():
+            return (g.user or {}).get("name", "-")
+
+        async def scenario():
+            client = web_app.test_client()
+            client.set_cookie("localhost", SESSION_COOKIE_NAME, "c1")
+            self.assertEqual(await (await client.get("/")).get_data(as_text=True), "Joe")
+            response = await client.post("/logout")
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(SESSION_COOKIE_NAME + "=;", response.headers["Set-Cookie"])
+            client.set_cookie("localhost", SESSION_COOKIE_NAME, "c1") # e.g. an old tab
+            self.assertEqual(await (await client.get("/")).get_data(as_text=True), "-")
+        asyncio.run(scenario())
+
+
 if __name__ == "__main__":
     print("This is a library and cannot be invoked directly; pls. use 'import' from another program.")
-    # raise error?
\ No newline at end of file
+    # raise error?
+    print("Will run unit test now..")
+    unittest.main()